@@ -45,6 +45,7 @@ setup(
         "console_scripts": [
             "sg_copy_to_derivatives = spinegeneric.cli.copy_to_derivatives:main",
             "sg_create_mosaic = spinegeneric.cli.create_mosaic:main",
+            "sg_detect_outliers = spinegeneric.cli.detect_outliers:main",
             "sg_deface_using_r = spinegeneric.cli.deface_spineGeneric_usingR:main",
             "sg_generate_figure = spinegeneric.cli.generate_figure:main",
             "sg_manual_correction = spinegeneric.cli.manual_correction:main",
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# On-disk cache of results, keyed by a hash of their inputs
+
+
+import os
+import shutil
+import pickle
+import hashlib
+import logging
+import tempfile
+
+
+def hash_inputs(fnames, params):
+    """
+    Compute a hash of the content of files and of parameters.
+    :param fnames: list of str: input files. A missing file is hashed as such.
+    :param params: parameters with a deterministic repr (e.g. tuple of str, int, bool)
+    :return: str: hexadecimal digest
+    """
+    h = hashlib.sha256()
+    for fname in fnames:
+        h.update(os.path.basename(fname).encode("utf-8"))
+        if os.path.isfile(fname):
+            with open(fname, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+        else:
+            h.update(b"\0missing\0")
+    h.update(repr(params).encode("utf-8"))
+    return h.hexdigest()
+
+
+def list_files(path, exclude=()):
+    """
+    List the files of a folder and its subfolders, in a deterministic order (e.g. to hash the source of a package).
+    :param path: str: folder
+    :param exclude: list of str: names of subfolders to skip. Folders '__pycache__' are always skipped.
+    :return: list of str: files
+    """
+    fnames = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d not in exclude and d != "__pycache__")
+        fnames += [os.path.join(root, file) for file in sorted(files) if not file.endswith((".pyc", ".pyo"))]
+    return fnames
+
+
+class ResultCache:
+    """
+    On-disk cache. Each entry holds a picklable payload and copies of output files, and is stored under
+    <path_cache>/<namespace>/<key>/. Only the max_entries most recent entries of each namespace are kept.
+    """
+
+    FNAME_PAYLOAD = "payload.pkl"
+
+    def __init__(self, path_cache, max_entries=10):
+        self.path_cache = path_cache
+        self.max_entries = max_entries
+
+    def get(self, namespace, key, path_out=os.curdir):
+        """
+        Fetch an entry and restore its output files.
+        :param namespace: str
+        :param key: str: output of hash_inputs()
+        :param path_out: str: folder where output files are restored
+        :return: payload, or None if the entry is not in the cache
+        """
+        path_entry = os.path.join(self.path_cache, namespace, key)
+        try:
+            with open(os.path.join(path_entry, self.FNAME_PAYLOAD), "rb") as f:
+                payload, fnames = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning("Ignoring unreadable cache entry {}: {}".format(path_entry, e))
+            return None
+        for fname in fnames:
+            shutil.copy2(os.path.join(path_entry, fname), os.path.join(path_out, fname))
+        # Mark entry as recently used
+        os.utime(path_entry)
+        return payload
+
+    def put(self, namespace, key, payload, fnames):
+        """
+        Store an entry.
+        :param namespace: str
+        :param key: str: output of hash_inputs()
+        :param payload: picklable object
+        :param fnames: list of str: output files to store along with the payload
+        :return:
+        """
+        path_namespace = os.path.join(self.path_cache, namespace)
+        os.makedirs(path_namespace, exist_ok=True)
+        # Write entry in a temporary folder, then move it, so that a partially written entry is never read
+        path_tmp = tempfile.mkdtemp(dir=path_namespace, prefix=".tmp")
+        for fname in fnames:
+            shutil.copy2(fname, os.path.join(path_tmp, os.path.basename(fname)))
+        with open(os.path.join(path_tmp, self.FNAME_PAYLOAD), "wb") as f:
+            pickle.dump((payload, [os.path.basename(fname) for fname in fnames]), f)
+        path_entry = os.path.join(path_namespace, key)
+        shutil.rmtree(path_entry, ignore_errors=True)
+        os.replace(path_tmp, path_entry)
+        self._prune(path_namespace)
+
+    def _prune(self, path_namespace):
+        """Remove the least recently used entries of a namespace"""
+        entries = [
+            os.path.join(path_namespace, entry) for entry in os.listdir(path_namespace) if not entry.startswith(".")
+        ]
+        entries.sort(key=os.path.getmtime, reverse=True)
+        for path_entry in entries[self.max_entries:]:
+            shutil.rmtree(path_entry, ignore_errors=True)
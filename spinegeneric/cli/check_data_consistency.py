@@ -6,20 +6,10 @@
 #
 # Authors: Alexandru Foias, Julien Cohen-Adad
 import argparse
-import pandas as pd
 import os
 from pprint import pprint
 import spinegeneric as sg
 import spinegeneric.utils
-from pandas_schema import Column, Schema
-from pandas_schema.validation import (
-    LeadingWhitespaceValidation,
-    TrailingWhitespaceValidation,
-    InRangeValidation,
-    InListValidation,
-    DateFormatValidation,
-    MatchesPatternValidation,
-)
 
 
 def get_parser():
@@ -43,6 +33,17 @@ def main():
     # Parse input arguments
     parser = get_parser()
     args = parser.parse_args()
+    # Imported here, so that the startup of the script (e.g. 'sg_check_data_consistency -h') stays fast
+    import pandas as pd
+    from pandas_schema import Column, Schema
+    from pandas_schema.validation import (
+        LeadingWhitespaceValidation,
+        TrailingWhitespaceValidation,
+        InRangeValidation,
+        InListValidation,
+        DateFormatValidation,
+        MatchesPatternValidation,
+    )
 
     data_path = args.path_in
 
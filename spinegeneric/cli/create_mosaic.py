@@ -20,47 +20,158 @@
 import os
 import glob
 import argparse
-import numpy as np
-import nibabel as nib
-import matplotlib.pyplot as plt
-from skimage.exposure import equalize_adapthist, rescale_intensity
-from skimage.transform import resize
-
-from spinalcordtoolbox.image import Image
-import spinalcordtoolbox.reports.slice as qcslice
-from spinalcordtoolbox.resampling import resample_nib
+import contextlib
+import functools
+import concurrent.futures
 
 from spinegeneric.utils import add_suffix
 
+# Note: heavy libraries (numpy, nibabel, matplotlib, skimage, spinalcordtoolbox) are imported in the functions that
+# need them, so that the startup of the script (e.g. 'sg_create_mosaic -h') stays fast.
+
+# Maximum size of the blocks read from a file to extract a slice that is not contiguous in the file (bytes)
+READ_BLOCK_SIZE = 2 ** 20
+# Renderers of the mosaic (see save_mosaic()), and output formats of the direct renderer (lossless)
+RENDERERS = ["matplotlib", "direct"]
+DIRECT_FORMATS = [".png", ".webp"]
+
 
 def scale_intensity(data, out_min=0, out_max=255):
     """Scale intensity of data in a range defined by [out_min, out_max], based on the 2nd and 98th percentiles."""
+    import numpy as np
+    from skimage.exposure import rescale_intensity
+
     p2, p98 = np.percentile(data, (2, 98))
     return rescale_intensity(data, in_range=(p2, p98), out_range=(out_min, out_max))
 
 
 def get_mosaic(images, n_col, n_row=1):
+    """
+    Arrange images in a mosaic of n_row x n_col tiles (row by row), in a single reshape/transpose. Missing tiles
+    are left blank (zero).
+    :param images: 3D array (dim_x, dim_y, n_images), with n_images <= n_row * n_col
+    :param n_col: int: number of columns
+    :param n_row: int: number of rows
+    :return: 2D array (dim_x * n_row, dim_y * n_col), with the dtype of images
+    """
+    import numpy as np
+
     dim_x, dim_y, dim_z = images.shape
+    tiles = np.zeros((n_row * n_col, dim_x, dim_y), dtype=images.dtype)
+    tiles[:dim_z] = np.moveaxis(images, -1, 0)
+    return tiles.reshape(n_row, n_col, dim_x, dim_y).transpose(0, 2, 1, 3).reshape(n_row * dim_x, n_col * dim_y)
+
+
+class MosaicWriter:
+    """
+    Assemble tiles of the same shape into pages of n_row x n_col tiles, and write each page as soon as it is full,
+    so that only the tiles of the current page are kept in memory (in a single preallocated array, arranged into the
+    page by get_mosaic()).
+    Pages are named after fname, with a suffix ('_000', '_001', ...) if there are several pages.
+    """
+
+    def __init__(self, fname, n_col, n_row, n_tiles, renderer="matplotlib", upscale=1):
+        """
+        :param fname: str: output file
+        :param n_col: int: number of columns of each page
+        :param n_row: int: number of rows of each page
+        :param n_tiles: int: total number of tiles (to name the pages)
+        :param renderer: str: renderer of the pages (see save_mosaic())
+        :param upscale: int: upscale factor of the pages (see save_mosaic())
+        """
+        self.fname = fname
+        self.n_col = n_col
+        self.n_row = n_row
+        self.renderer = renderer
+        self.upscale = upscale
+        self.n_pages = -(-n_tiles // (n_col * n_row))
+        self.i_page = 0
+        self.n_filled = 0
+        self.tiles = None
 
-    matrix_sz = (int(dim_x * n_row), int(dim_y * n_col))
+    def add(self, tile):
+        """
+        Add a tile to the current page, and write the page if it is full.
+        :param tile: 2D array, with the shape (and dtype) of the first tile
+        """
+        import numpy as np
 
-    matrix = np.zeros(matrix_sz)
-    for i in range(dim_z):
-        start_col = (i % n_col) * dim_y
-        end_col = start_col + dim_y
+        if self.tiles is None:
+            self.tiles = np.zeros((self.n_row * self.n_col,) + tile.shape, dtype=tile.dtype)
+        self.tiles[self.n_filled] = tile
+        self.n_filled += 1
+        if self.n_filled == len(self.tiles):
+            self.flush()
 
-        start_row = int(np.floor(i / n_col) % n_row) * dim_x
-        end_row = start_row + dim_x
+    def flush(self):
+        """Write the current page (remaining tiles are blank), if it has tiles"""
+        import numpy as np
 
-        matrix[start_row:end_row, start_col:end_col] = images[:, :, i]
+        if not self.n_filled:
+            return
+        mosaic = get_mosaic(np.moveaxis(self.tiles[: self.n_filled], 0, -1), self.n_col, self.n_row)
+        if self.n_pages == 1:
+            fname_out = self.fname
+        else:
+            fname_out = (
+                os.path.splitext(self.fname)[0]
+                + "_"
+                + str(self.i_page).zfill(3)
+                + os.path.splitext(self.fname)[1]
+            )
+        save_mosaic(mosaic, fname_out, self.renderer, self.upscale)
+        print("\nCreated: {}".format(fname_out))
+        self.i_page += 1
+        self.n_filled = 0
 
-    return matrix
+
+def save_mosaic(mosaic, fname, renderer="matplotlib", upscale=1):
+    """
+    Save a mosaic as an image.
+    :param mosaic: 2D array of uint8
+    :param fname: str: output file
+    :param renderer: str:
+      direct: the pixels of the mosaic are written as is (one pixel per pixel of the tiles), in a lossless format
+        defined by the file extension (see DIRECT_FORMATS). Writing is linear in the number of pixels, and the output
+        is byte-reproducible.
+      matplotlib: the mosaic is drawn in a matplotlib figure (bilinear interpolation), saved at 300 dpi in any format
+        supported by matplotlib.
+    :param upscale: int: with renderer 'direct', each pixel is repeated upscale x upscale times
+    """
+    if renderer == "matplotlib":
+        import matplotlib.pyplot as plt
+
+        plt.figure()
+        plt.subplot(1, 1, 1)
+        plt.axis("off")
+        plt.imshow(mosaic, interpolation="bilinear", cmap="gray", aspect="equal")
+        plt.savefig(fname, dpi=300, bbox_inches="tight", pad_inches=0)
+        plt.close()
+        return
+
+    import cv2
+
+    if upscale > 1:
+        mosaic = mosaic.repeat(upscale, axis=0).repeat(upscale, axis=1)
+    ext = os.path.splitext(fname)[1].lower()
+    if ext == ".png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, 6]
+    elif ext == ".webp":
+        # A quality above 100 selects the lossless mode of WebP
+        params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+    else:
+        raise ValueError("Unsupported format for the direct renderer: {}".format(fname))
+    if not cv2.imwrite(fname, mosaic, params):
+        raise IOError("Could not write {}".format(fname))
 
 
 def equalized(a, winsize):
     """
     Perform histogram equalization using CLAHE.
     """
+    import numpy as np
+    from skimage.exposure import equalize_adapthist
+
     min_, max_ = a.min(), a.max()
     b = (np.float32(a) - min_) / (max_ - min_)
     b[b >= 1] = 1  # 1+eps numerical error may happen (#1691)
@@ -78,8 +189,193 @@ def equalized(a, winsize):
     return np.array(c * (max_ - min_) + min_, dtype=a.dtype)
 
 
+def read_mid_slice(fname, orientation, axis):
+    """
+    Read the mid-slice of a NIfTI image, as if the image was reoriented first, without loading the volume: the
+    index of the slice in the file is derived from the header (affine and shape), only this plane is read (through
+    the lazy array proxy of nibabel), and only this plane is reoriented.
+    :param fname: str: NIfTI file
+    :param orientation: str: orientation of the image, with the convention of SCT (each letter is the side the axis
+      starts from). Example: 'RPI'
+    :param axis: int: axis (of the reoriented image) along which the mid-slice is taken
+    :return: data: 2D array of float: mid-slice, with the two other axes of the reoriented image
+    :return: affine: affine of the reoriented image
+    :return: zooms: tuple: pixel size of the mid-slice, along the two other axes (mm)
+    """
+    import numpy as np
+    import nibabel as nib
+    import nibabel.openers
+    import nibabel.orientations
+
+    # Only the header is read here
+    nii = nib.load(fname)
+    shape = nii.shape[:3]
+    # Axis codes of nibabel are the sides the axes point to
+    opposite = {"R": "L", "L": "R", "A": "P", "P": "A", "S": "I", "I": "S"}
+    # transform[i] = (axis of the reoriented image, flip) of the i-th axis of the file
+    transform = nib.orientations.ornt_transform(
+        nib.orientations.io_orientation(nii.affine),
+        nib.orientations.axcodes2ornt([opposite[code] for code in orientation]),
+    )
+    affine = nii.affine @ nib.orientations.inv_ornt_aff(transform, shape)
+    # Axis of the file along which the slice is taken, and index of the mid-slice in the file
+    source = int(np.flatnonzero(transform[:, 0] == axis)[0])
+    index = shape[source] // 2
+    if transform[source, 1] == -1:
+        index = shape[source] - 1 - index
+    slicer = [slice(None)] * 3 + [0] * (len(nii.shape) - 3)
+    slicer[source] = index
+    # Reads go through a single file object, so that compressed files are decompressed (at most) once
+    with nib.openers.ImageOpener(fname) as fobj:
+        dataobj = type(nii).from_stream(fobj.fobj).dataobj
+        if source == 2:
+            # The plane is contiguous in the file
+            data = np.asarray(dataobj[tuple(slicer)], dtype=np.float64)
+        else:
+            # The plane is scattered across the file: read it by blocks of slices (along the last axis of the file),
+            # so that at most READ_BLOCK_SIZE bytes are loaded at once
+            n_slices = max(1, READ_BLOCK_SIZE // (shape[0] * shape[1] * nii.get_data_dtype().itemsize))
+            blocks = []
+            for start in range(0, shape[2], n_slices):
+                slicer[2] = slice(start, start + n_slices)
+                blocks.append(np.asarray(dataobj[tuple(slicer)], dtype=np.float64))
+            data = np.concatenate(blocks, axis=-1)
+    # Reorient the plane: flip its axes, then sort them as in the reoriented image
+    others = [i for i in range(3) if i != source]
+    for i_data, i in enumerate(others):
+        if transform[i, 1] == -1:
+            data = np.flip(data, i_data)
+    data = np.ascontiguousarray(data.transpose(np.argsort(transform[others, 0])))
+    zooms = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    return data, affine, tuple(zooms[[i for i in range(3) if i != axis]])
+
+
+def extract_slice(file, plane, segmentation, winsize):
+    """
+    Extract the mid-slice of an image, with histogram equalization (CLAHE) and intensities scaled in [0, 255]
+    (stored as uint8, so that the tiles of a mosaic take little memory).
+    Only the mid-slice is read from the file (see read_mid_slice()). Subjects are independent from each other, so
+    this can run in worker processes (see -jobs).
+    :param file: str: image file
+    :param plane: str: 'ax' (axial mid-slice, cropped around the spinal cord segmentation) or 'sag' (sagittal
+      mid-slice)
+    :param segmentation: str: suffix of the segmentation file (only used with plane='ax')
+    :param winsize: int: window size of CLAHE
+    :return: 2D array of uint8
+    """
+    import numpy as np
+    import nibabel as nib
+    from skimage.transform import resize
+
+    if plane == "ax":
+        from spinalcordtoolbox.image import Image
+        import spinalcordtoolbox.reports.slice as qcslice
+
+        file_seg = add_suffix(file, segmentation)
+        # Extract the mid-slice (axial slice of the image in RPI orientation)
+        img_data, img_affine, _ = read_mid_slice(file, "RPI", 2)
+        seg_data, seg_affine, _ = read_mid_slice(file_seg, "RPI", 2)
+        nii_mid = nib.nifti2.Nifti2Image(img_data, img_affine)
+        nii_mid_seg = nib.nifti2.Nifti2Image(seg_data, seg_affine)
+        img_mid = Image(
+            img_data,
+            hdr=nii_mid.header,
+            dim=nii_mid.header.get_data_shape(),
+        )
+        seg_mid = Image(
+            seg_data,
+            hdr=nii_mid_seg.header,
+            dim=nii_mid_seg.header.get_data_shape(),
+        )
+        # Instantiate spinalcordtoolbox.reports.slice.Axial class
+        qcslice_cur = qcslice.Axial([img_mid, seg_mid])
+        # Find center of mass of the segmentation
+        center_x_lst, center_y_lst = qcslice_cur.get_center()
+        # Select the mid-slice
+        mid_slice = qcslice_cur.get_slice(qcslice_cur._images[0].data, 0)
+        # Crop image around SC seg
+        mid_slice = qcslice_cur.crop(
+            mid_slice, int(center_x_lst[0]), int(center_y_lst[0]), 20, 20
+        )
+    elif plane == "sag":
+        # Extract the mid-slice (sagittal slice of the image in RSP orientation)
+        mid_slice, _, (size_si, size_ap) = read_mid_slice(file, "RSP", 0)
+        # check if data is not isotropic resolution: resample the AP axis with the resolution of the SI axis (linear
+        # interpolation), on the mid-slice only
+        if not np.isclose(size_si, size_ap):
+            mid_slice = resize(
+                mid_slice,
+                (mid_slice.shape[0], int(round(mid_slice.shape[1] * size_ap / size_si))),
+                order=1,
+                preserve_range=True,
+                anti_aliasing=False,
+            )
+
+    # Histogram equalization using CLAHE
+    slice_cur = equalized(mid_slice, winsize)
+    # Scale intensities of all slices (ie of all subjects) in a common range of values
+    return np.round(scale_intensity(slice_cur)).astype(np.uint8)
+
+
+def get_address_space():
+    """
+    Address space (virtual memory) of the current process, in bytes. Only available on Linux.
+    :return: int, or 0 if it is not available
+    """
+    import resource
+
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError):
+        return 0
+
+
+def limit_memory(max_memory):
+    """
+    Limit the memory (address space) of the current process, so that a worker of -jobs fails with a MemoryError
+    instead of exhausting the memory of the node. The limit applies to the memory allocated in addition to the
+    address space of the process when it starts (e.g. libraries and buffers inherited from the parent process), which
+    can be much larger than its resident memory.
+    :param max_memory: int: maximum memory in MB, or None (no limit)
+    """
+    if max_memory is None:
+        return
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        print("WARNING: -max-memory is not supported on this platform.")
+        return
+    max_bytes = get_address_space() + max_memory * 1024 ** 2
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        max_bytes = min(max_bytes, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (max_bytes, hard))
+
+
+def init_worker(max_memory):
+    """
+    Initializer of the processes of -jobs: load the libraries used by extract_slice(), then limit the memory (see
+    limit_memory()). Libraries are loaded (and the linear algebra routines called once) first, so that the limit only
+    applies to the memory used for the images: loading a library maps it in the address space, and some routines
+    allocate buffers at their first call, where a failed allocation can hang instead of raising a MemoryError.
+    :param max_memory: int: maximum memory in MB, or None (no limit)
+    """
+    import numpy as np
+    import nibabel.orientations
+    import skimage.exposure  # noqa: F401
+    import skimage.transform  # noqa: F401
+
+    nibabel.orientations.io_orientation(np.eye(4))
+    limit_memory(max_memory)
+
+
 def main():
     args = get_parameters()
+    import numpy as np
+    from skimage.transform import resize
+
     print(args)
     im_string = args.input
     # i_folder = args.input_folder
@@ -89,101 +385,38 @@ def main():
     nb_row = int(args.row)
     winsize = int(args.winsize_CLAHE)
     o_fname = args.output
+    jobs = os.cpu_count() if args.jobs == -1 else args.jobs
     # List input folders
     files = glob.glob(
         os.path.join(args.input_folder, "**/sub" + im_string), recursive=True
     )
     files.sort()
-    # Initialize list that will store each mosaic element
-    slice_lst = []
-    for file in files:
-        print("Processing ({}/{}): {}".format(files.index(file), len(files), file))
-        if plane == "ax":
-            file_seg = add_suffix(file, args.segmentation)
-            # Extract the mid-slice
-            img, seg = Image(file).change_orientation("RPI"), Image(
-                file_seg
-            ).change_orientation("RPI")
-            mid_slice_idx = int(float(img.dim[2]) // 2)
-            nii_mid = nib.nifti2.Nifti2Image(
-                img.data[:, :, mid_slice_idx], img.hdr.get_best_affine()
-            )
-            nii_mid_seg = nib.nifti2.Nifti2Image(
-                seg.data[:, :, mid_slice_idx], seg.hdr.get_best_affine()
-            )
-            img_mid = Image(
-                img.data[:, :, mid_slice_idx],
-                hdr=nii_mid.header,
-                dim=nii_mid.header.get_data_shape(),
-            )
-            seg_mid = Image(
-                seg.data[:, :, mid_slice_idx],
-                hdr=nii_mid_seg.header,
-                dim=nii_mid_seg.header.get_data_shape(),
-            )
-            # Instantiate spinalcordtoolbox.reports.slice.Axial class
-            qcslice_cur = qcslice.Axial([img_mid, seg_mid])
-            # Find center of mass of the segmentation
-            center_x_lst, center_y_lst = qcslice_cur.get_center()
-            # Select the mid-slice
-            mid_slice = qcslice_cur.get_slice(qcslice_cur._images[0].data, 0)
-            # Crop image around SC seg
-            mid_slice = qcslice_cur.crop(
-                mid_slice, int(center_x_lst[0]), int(center_y_lst[0]), 20, 20
-            )
-        elif plane == "sag":
-            sag_im = Image(file).change_orientation("RSP")
-            # check if data is not isotropic resolution
-            if not np.isclose(sag_im.dim[5], sag_im.dim[6]):
-                sag_im = resample_nib(
-                    sag_im.copy(),
-                    new_size=[sag_im.dim[4], sag_im.dim[5], sag_im.dim[5]],
-                    new_size_type="mm",
+    # Extract the mid-slice of each subject. Subjects are independent from each other, so they can be processed in
+    # parallel: slices are returned in the order of the files, whatever the number of jobs.
+    extract = functools.partial(extract_slice, plane=plane, segmentation=args.segmentation, winsize=winsize)
+    with contextlib.ExitStack() as stack:
+        if jobs > 1:
+            executor = stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(
+                    max_workers=jobs, initializer=init_worker, initargs=(args.max_memory,)
                 )
-            mid_slice_idx = int(sag_im.dim[0] // 2)
-            mid_slice = sag_im.data[mid_slice_idx, :, :]
-            del sag_im
-
-        # Histogram equalization using CLAHE
-        slice_cur = equalized(mid_slice, winsize)
-        # Scale intensities of all slices (ie of all subjects) in a common range of values
-        slice_cur = scale_intensity(slice_cur)
-
-        # Resize all slices with the shape of the first loaded slice
-        if slice_lst:
-            slice_cur = resize(slice_cur, slice_lst[0].shape, anti_aliasing=True)
-
-        slice_lst.append(slice_cur)
-
-    # Create a 2d array containing the samples to display
-    data = np.stack(slice_lst, axis=-1)
-    nb_img = data.shape[2]
-    nb_items_mosaic = nb_column * nb_row
-    nb_mosaic = np.ceil(float(nb_img) / nb_items_mosaic)
-    for i in range(int(nb_mosaic)):
-        if nb_mosaic == 1:
-            fname_out = o_fname
-        else:
-            fname_out = (
-                os.path.splitext(o_fname)[0]
-                + "_"
-                + str(i).zfill(3)
-                + os.path.splitext(o_fname)[1]
             )
-        # create mosaic
-        idx_end = (
-            (i + 1) * nb_items_mosaic if (i + 1) * nb_items_mosaic <= nb_img else nb_img
-        )
-        data_mosaic = data[:, :, (i * nb_items_mosaic):idx_end]
-        mosaic = get_mosaic(data_mosaic, nb_column, nb_row)
-        # save mosaic
-        plt.figure()
-        plt.subplot(1, 1, 1)
-        plt.axis("off")
-        plt.imshow(mosaic, interpolation="bilinear", cmap="gray", aspect="equal")
-        plt.savefig(fname_out, dpi=300, bbox_inches="tight", pad_inches=0)
-        plt.close()
-        print("\nCreated: {}".format(fname_out))
+            slices = executor.map(extract, files)
+        else:
+            slices = map(extract, files)
+        # Tiles are written page by page, as soon as a page is full
+        writer = MosaicWriter(o_fname, nb_column, nb_row, len(files), args.renderer, args.upscale)
+        shape = None
+        for i, (file, slice_cur) in enumerate(zip(files, slices)):
+            print("Processing ({}/{}): {}".format(i, len(files), file))
+            # Resize all slices with the shape of the first loaded slice
+            if shape is None:
+                shape = slice_cur.shape
+            elif slice_cur.shape != shape:
+                slice_cur = resize(slice_cur, shape, anti_aliasing=True, preserve_range=True)
+                slice_cur = np.round(slice_cur).astype(np.uint8)
+            writer.add(slice_cur)
+        writer.flush()
 
 
 def get_parameters():
@@ -238,7 +471,57 @@ def get_parameters():
     parser.add_argument(
         "-o", "--output", required=False, default="mosaic.png", help="Output fname."
     )
+    parser.add_argument(
+        "-renderer",
+        "--renderer",
+        required=False,
+        default="matplotlib",
+        choices=RENDERERS,
+        help="How the mosaic is written: "
+        "matplotlib --> matplotlib figure (bilinear interpolation) saved at 300 dpi, in any format supported by "
+        "matplotlib; "
+        "direct --> pixels of the tiles written as is (fast and reproducible), in a lossless format defined by the "
+        "extension of the output file ({}).".format(", ".join(DIRECT_FORMATS)),
+    )
+    parser.add_argument(
+        "-upscale",
+        "--upscale",
+        type=int,
+        required=False,
+        default=1,
+        help="Integer upscale factor of the mosaic, with '-renderer direct' (each pixel is repeated).",
+    )
+    parser.add_argument(
+        "-jobs",
+        "--jobs",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of subjects processed in parallel. Set to -1 to use all available cores. The order of the "
+        "subjects in the mosaic does not depend on the number of jobs.",
+    )
+    parser.add_argument(
+        "-max-memory",
+        "--max_memory",
+        type=int,
+        required=False,
+        help="Maximum memory that each process of -jobs can allocate, in MB, in addition to the memory it uses when "
+        "it starts (libraries). It is a limit of the address space (virtual memory), not of the resident memory: "
+        "libraries (e.g. numpy, OpenCV) and threads reserve address space that they might not use, so leave some "
+        "headroom (e.g. 1024 MB for typical anatomical images). A subject that needs more memory stops the script "
+        "with a MemoryError. By default, no limit.",
+    )
     args = parser.parse_args()
+    if args.renderer == "direct" and os.path.splitext(args.output)[1].lower() not in DIRECT_FORMATS:
+        parser.error(
+            "Unsupported format for '-renderer direct': {}. Supported formats: {} (or use '-renderer matplotlib')".format(
+                args.output, ", ".join(DIRECT_FORMATS)
+            )
+        )
+    if args.upscale < 1:
+        parser.error("-upscale must be a positive integer.")
+    if args.upscale != 1 and args.renderer != "direct":
+        parser.error("-upscale requires '-renderer direct'.")
     return args
 
 
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+#
+# Detect outlier subjects and sites in the csv results output by process_data.sh, and write the candidates in a yaml
+# file that can be used with 'sg_generate_figure -exclude' (after review).
+#
+# For usage, type: sg_detect_outliers -h
+#
+
+import os
+import argparse
+
+import yaml
+
+import spinegeneric as sg
+import spinegeneric.utils
+import spinegeneric.metrics
+
+# Note: heavy libraries (numpy, pandas) are imported in the functions that need them, so that the startup of the
+# script (e.g. 'sg_detect_outliers -h') stays fast.
+
+COVARIATES = ["age", "sex"]
+# Iglewicz and Hoaglin (1993): robust z-scores larger than 3.5 (in absolute value) are potential outliers
+THRESHOLD = 3.5
+# Robust z-scores within groups (site, vendor) with fewer subjects are not computed
+MIN_SUBJECTS = 5
+# Robust z-scores of site medians within vendors with fewer sites are not computed
+MIN_SITES = 3
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Detect outlier subjects and sites, for all the metrics output by process_data.sh (see "
+        "config/metrics.json). Each value is scored with robust z-scores (median and MAD) within its site and "
+        "within its vendor, and each site is scored with the robust z-score of its median within its vendor. "
+        "Candidates are written in a yaml file with the same format as the file of 'sg_generate_figure -exclude', "
+        "with their scores as comments.",
+        formatter_class=sg.utils.SmartFormatter,
+        prog=os.path.basename(__file__).strip(".py"),
+    )
+    parser.add_argument(
+        "-path-results",
+        metavar=sg.utils.Metavar.folder,
+        help="Folder that includes all the output csv files (generated by process_data.sh) and participants.tsv. "
+        "By default, takes the current folder.",
+    )
+    parser.add_argument(
+        "-exclude",
+        metavar=sg.utils.Metavar.file,
+        help="Yaml file listing the subjects and sites already excluded (same format as 'sg_generate_figure "
+        "-exclude'). They are not scored, and they are copied to the output file.",
+    )
+    parser.add_argument(
+        "-o",
+        default="exclude_candidates.yml",
+        metavar=sg.utils.Metavar.file,
+        help="Output yaml file. The path is relative to the current folder.",
+    )
+    parser.add_argument(
+        "-threshold",
+        type=float,
+        default=THRESHOLD,
+        metavar=sg.utils.Metavar.float,
+        help="Subjects and sites with a robust z-score larger than this threshold (in absolute value) are "
+        "candidates for exclusion.",
+    )
+    parser.add_argument(
+        "-adjust",
+        nargs="+",
+        choices=COVARIATES,
+        default=[],
+        help="Covariates of participants.tsv whose linear effect is removed from the values (within each metric) "
+        "before scoring. Example: -adjust age sex",
+    )
+    parser.add_argument(
+        "-duplicates",
+        choices=["latest", "error"],
+        default="latest",
+        help="How to handle duplicated measures of a file (see 'sg_generate_figure -duplicates').",
+    )
+    return parser
+
+
+def load_results(metrics, dict_exclude_subj, duplicates="latest"):
+    """
+    Gather the values of all metrics in a single long table, without the subjects and sites already excluded.
+    :param metrics: OrderedDict: key: metric name, value: Metric
+    :param dict_exclude_subj: dict of subjects/sites to exclude, per metric
+    :param duplicates: str: policy for duplicated measures (see drop_duplicate_results())
+    :return: pandas DataFrame with columns: metric, subject, val, site, vendor, age, sex (empty if there are no csv
+      files, e.g. if the processing failed before writing them)
+    """
+    import pandas as pd
+    import spinegeneric.results
+
+    tables = []
+    for metric in metrics.values():
+        if not os.path.isfile(metric.file):
+            print("{} file is missing. Skipping to the next metric.".format(metric.file))
+            continue
+        results = spinegeneric.results.load_results_csv(metric.file, metric.field)
+        results, _ = spinegeneric.results.drop_duplicate_results(results, duplicates)
+        tables.append(
+            pd.DataFrame(
+                {
+                    "metric": metric.name,
+                    "subject": results["Filename"].str.split(os.sep).str[-3].values,
+                    "val": results[metric.field].values,
+                }
+            )
+        )
+    participants = pd.read_csv("participants.tsv", sep="\t").drop_duplicates("participant_id")
+    participants = participants.set_index("participant_id").reindex(columns=["institution_id", "manufacturer"] + COVARIATES)
+    if not tables:
+        tables = [pd.DataFrame({"metric": pd.Series(dtype=object), "subject": pd.Series(dtype=object),
+                                "val": pd.Series(dtype="float64")})]
+    results = pd.concat(tables, ignore_index=True)
+    results = results[results["val"].notna()].join(participants, on="subject", how="inner").rename(
+        columns={"institution_id": "site", "manufacturer": "vendor"}
+    )
+    # Discard the subjects and sites listed in the exclusion file
+    excluded = [(metric, entry) for metric, entries in dict_exclude_subj.items() for entry in entries or []]
+    excluded = pd.MultiIndex.from_arrays([[metric for metric, _ in excluded], [entry for _, entry in excluded]])
+    is_excluded = pd.MultiIndex.from_arrays([results["metric"], results["subject"]]).isin(excluded) | (
+        pd.MultiIndex.from_arrays([results["metric"], results["site"]]).isin(excluded)
+    )
+    return results[~is_excluded].reset_index(drop=True)
+
+
+def detect_outliers(results, threshold=THRESHOLD, adjust=()):
+    """
+    Score all the values of all metrics in a single vectorized pass: robust z-scores of each value within its
+    (metric, site) and within its (metric, vendor), and robust z-score of the median of each (metric, site) among the
+    sites of its vendor.
+    :param results: pandas DataFrame output by load_results()
+    :param threshold: float: candidates have a z-score larger than threshold, in absolute value
+    :param adjust: list of str: covariates (see COVARIATES) whose linear effect is removed within each metric
+    :return: subjects: pandas DataFrame of the candidate subjects, with columns: metric, subject, site, vendor, val,
+      z_site, z_vendor, sorted by decreasing score. Subjects of candidate sites are not listed.
+    :return: sites: pandas DataFrame of the candidate sites, with columns: metric, site, vendor, median, z_vendor,
+      sorted by decreasing score
+    """
+    import numpy as np
+    import pandas as pd
+    import spinegeneric.stats
+
+    if results.empty:
+        return (
+            pd.DataFrame(columns=["metric", "subject", "site", "vendor", "val", "z_site", "z_vendor"]),
+            pd.DataFrame(columns=["metric", "site", "vendor", "median", "z_vendor"]),
+        )
+    metric_id, metrics = pd.factorize(results["metric"])
+    site_id, sites = pd.factorize(pd.MultiIndex.from_arrays([results["metric"], results["site"]]))
+    vendor_id, vendors = pd.factorize(pd.MultiIndex.from_arrays([results["metric"], results["vendor"]]))
+    values = results["val"].values
+    if adjust:
+        covariates = spinegeneric.stats.encode_covariates(results, adjust)
+        values = spinegeneric.stats.adjust_covariates(values, covariates, metric_id, len(metrics))
+
+    z_site, site_median, _ = spinegeneric.stats.robust_zscore(values, site_id, len(sites), MIN_SUBJECTS)
+    z_vendor = spinegeneric.stats.robust_zscore(values, vendor_id, len(vendors), MIN_SUBJECTS)[0]
+    subjects = results[["metric", "subject", "site", "vendor", "val"]].assign(z_site=z_site, z_vendor=z_vendor)
+    # NaN scores (small groups, or no dispersion) are never candidates
+    score = np.nan_to_num(np.fmax(np.abs(z_site), np.abs(z_vendor)), nan=0)
+    subjects = subjects.iloc[np.argsort(-score, kind="stable")]
+    subjects = subjects[np.sort(score)[::-1] > threshold]
+
+    # Vendor of each site
+    site_vendor_id = np.zeros(len(sites), dtype=np.int64)
+    site_vendor_id[site_id] = vendor_id
+    z_site_vendor = spinegeneric.stats.robust_zscore(site_median, site_vendor_id, len(vendors), MIN_SITES)[0]
+    sites = pd.DataFrame(
+        {
+            "metric": sites.get_level_values(0),
+            "site": sites.get_level_values(1),
+            "vendor": vendors.get_level_values(1)[site_vendor_id],
+            "median": site_median,
+            "z_vendor": z_site_vendor,
+        }
+    )
+    sites = sites[sites["z_vendor"].abs() > threshold].sort_values(
+        "z_vendor", key=lambda z: -z.abs(), kind="stable"
+    )
+    # Subjects of candidate sites would be excluded with their site
+    is_site_candidate = pd.MultiIndex.from_arrays([subjects["metric"], subjects["site"]]).isin(
+        pd.MultiIndex.from_arrays([sites["metric"], sites["site"]])
+    )
+    return subjects[~is_site_candidate], sites
+
+
+def write_exclude_yaml(fname, metrics, subjects, sites, dict_exclude_subj, threshold=THRESHOLD, fname_exclude=None):
+    """
+    Write the candidates for exclusion in a yaml file that can be used with 'sg_generate_figure -exclude', with
+    their scores as comments.
+    :param fname: str: output yaml file
+    :param metrics: OrderedDict: key: metric name, value: Metric (defines the order of the metrics in the file)
+    :param subjects: pandas DataFrame of candidate subjects, output by detect_outliers()
+    :param sites: pandas DataFrame of candidate sites, output by detect_outliers()
+    :param dict_exclude_subj: dict of subjects/sites already excluded, per metric (copied to the output file)
+    :param threshold: float: threshold used by detect_outliers()
+    :param fname_exclude: str: file of dict_exclude_subj (for the comments)
+    :return: int: number of candidates
+    """
+    lines = [
+        "# Candidate subjects and sites to exclude, output by sg_detect_outliers (robust z-score larger than {}).".format(
+            threshold
+        ),
+        "# z_site: robust z-score (median/MAD) of the subject within its site. z_vendor: robust z-score of the subject",
+        "# (or of the median of the site) within its vendor. Review the candidates before using this file with",
+        "# 'sg_generate_figure -exclude'.",
+    ]
+    n_candidates = 0
+    for metric in list(metrics) + [metric for metric in dict_exclude_subj if metric not in metrics]:
+        entries = []
+        for entry in dict_exclude_subj.get(metric) or []:
+            entries.append("    - {}  # listed in {}".format(entry, fname_exclude))
+        for row in sites[sites["metric"] == metric].itertuples():
+            entries.append("    - {}  # site: median={:.4g}, z_vendor={:.2f}".format(row.site, row.median, row.z_vendor))
+        for row in subjects[subjects["metric"] == metric].itertuples():
+            entries.append(
+                "    - {}  # value={:.4g}, z_site={:.2f}, z_vendor={:.2f}".format(
+                    row.subject, row.val, row.z_site, row.z_vendor
+                )
+            )
+        n_candidates += len(entries) - len(dict_exclude_subj.get(metric) or [])
+        if entries:
+            lines += [metric + ":"] + entries
+    with open(fname, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return n_candidates
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    dict_exclude_subj = {}
+    if args.exclude is not None:
+        with open(args.exclude, "r") as f:
+            dict_exclude_subj = yaml.safe_load(f) or {}
+    # The output file is relative to the current folder, which might change with -path-results
+    fname_out = os.path.abspath(args.o)
+    if args.path_results is not None:
+        os.chdir(args.path_results)
+
+    metrics = spinegeneric.metrics.discover_metrics()
+    results = load_results(metrics, dict_exclude_subj, args.duplicates)
+    subjects, sites = detect_outliers(results, args.threshold, args.adjust)
+    n_candidates = write_exclude_yaml(
+        fname_out, metrics, subjects, sites, dict_exclude_subj, args.threshold, args.exclude
+    )
+    print("{} candidates ({} subjects, {} sites) among {} values of {} metrics.".format(
+        n_candidates, len(subjects), len(sites), len(results), results["metric"].nunique()
+    ))
+    print("Created: {}".format(fname_out))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,33 +11,29 @@
 import os
 import argparse
 import importlib.resources
-import tqdm
 import sys
-import csv
-import pandas as pd
 import subprocess
 from textwrap import dedent
 import yaml
 import math
 
-import numpy as np
-from scipy import ndimage
-from scipy.stats import f_oneway
 from collections import OrderedDict
-from collections import defaultdict
 import logging
-import matplotlib.pyplot as plt
-from matplotlib.offsetbox import OffsetImage, AnnotationBbox
-import matplotlib.patches as patches
-from sklearn.linear_model import LinearRegression
-from statsmodels.stats.multicomp import pairwise_tukeyhsd
+import logging.handlers
+import concurrent.futures
+import contextlib
+import functools
+import time
+import zlib
 
 import spinegeneric as sg
 import spinegeneric.utils
 import spinegeneric.flags
+import spinegeneric.cache
+import spinegeneric.metrics
 
-from plotly.subplots import make_subplots
-import plotly.graph_objs as go
+# Note: heavy libraries (numpy, pandas, scipy, matplotlib, sklearn, statsmodels, plotly) are imported in the functions
+# that need them, so that the startup of the script (e.g. 'sg_generate_figure -h') stays fast.
 
 # Initialize logging
 logger = logging.getLogger(__name__)
@@ -46,6 +42,22 @@ hdlr = logging.StreamHandler(sys.stdout)
 logging.root.addHandler(hdlr)
 
 FNAME_LOG = "log_stats.txt"
+FNAME_DASHBOARD = "dashboard.html"
+STATS_FORMATS = [".json", ".parquet"]
+# Output formats of figures. 'thumb' is a low resolution png (file suffix: '_thumb.png')
+FIGURE_FORMATS = ["png", "svg", "pdf", "thumb"]
+THUMB_DPI = 30
+CACHE_DIR = ".cache_sg_generate_figure"
+# Above this number of subjects, figures show the distribution of the values of each site (box: quartiles, whiskers:
+# 5th and 95th percentiles) instead of drawing each subject
+MAX_SUBJECTS = 2000
+# With -watch: interval between two checks of the csv files, in seconds
+WATCH_POLL_INTERVAL = 2
+# With -harmonize: covariates of participants.tsv whose effect is preserved, and output folder (harmonized values of
+# each metric, and fitted parameters)
+HARMONIZATION_COVARIATES = ["age", "sex", "height", "weight"]
+DIR_HARMONIZED = "harmonized"
+FNAME_HARMONIZATION_PARAMS = "harmonization.json"
 
 # country dictionary: key: site, value: country name
 # Flags are downloaded from: https://emojipedia.org/
@@ -116,86 +128,6 @@ vendor_to_color = {
     "Siemens": "limegreen",
 }
 
-# fetch contrast based on csv file
-file_to_metric = {
-    "csa-SC_T1w.csv": "csa_t1",
-    "csa-SC_T2w.csv": "csa_t2",
-    "csa-GM_T2s.csv": "csa_gm",
-    "MTR.csv": "mtr",
-    "MTsat.csv": "mtsat",
-    "T1.csv": "t1",
-    "DWI_FA.csv": "dti_fa",
-    "DWI_MD.csv": "dti_md",
-    "DWI_RD.csv": "dti_rd",
-}
-
-# fetch metric field
-metric_to_field = {
-    "csa_t1": "MEAN(area)",
-    "csa_t2": "MEAN(area)",
-    "csa_gm": "MEAN(area)",
-    "dti_fa": "WA()",
-    "dti_md": "WA()",
-    "dti_rd": "WA()",
-    "mtr": "WA()",
-    "mtsat": "WA()",
-    "t1": "WA()",
-}
-
-# fetch metric field
-metric_to_label = {
-    "csa_t1": "Cord CSA from T1w [$mm^2$]",
-    "csa_t2": "Cord CSA from T2w [$mm^2$]",
-    "csa_gm": "Gray Matter CSA [$mm^2$]",
-    "dti_fa": "Fractional anisotropy",
-    "dti_md": "Mean diffusivity [$mm^2.s^{-1}$]",
-    "dti_rd": "Radial diffusivity [$mm^2.s^{-1}$]",
-    "mtr": "Magnetization transfer ratio [%]",
-    "mtsat": "Magnetization transfer saturation [%]",
-    "t1": "T1 [ms]",
-}
-
-# fetch metric field for Plotly
-# need to create new label so superscripts can display, since Plotly does not understand Latex,
-metric_to_label_plotly = {
-    "csa_t1": "Cord CSA from T1w [mm<sup>2</sup>]",
-    "csa_t2": "Cord CSA from T2w [mm<sup>2</sup>]",
-    "csa_gm": "Gray Matter CSA [mm<sup>2</sup>]",
-    "dti_fa": "Fractional anisotropy",
-    "dti_md": "Mean diffusivity [mm<sup>2</sup>s<sup>-1</sup>]",
-    "dti_rd": "Radial diffusivity [mm<sup>2</sup>s<sup>-1</sup>]",
-    "mtr": "Magnetization transfer ratio [%]",
-    "mtsat": "Magnetization transfer saturation [%]",
-    "t1": "T1 [ms]",
-}
-
-# fetch metric field for Plotly
-# need to create new label so superscripts can display, since Plotly does not understand Latex
-metric_to_label_plotly = {
-    "csa_t1": "Cord CSA from T1w [mm<sup>2</sup>]",
-    "csa_t2": "Cord CSA from T2w [mm<sup>2</sup>]",
-    "csa_gm": "Gray Matter CSA [mm<sup>2</sup>]",
-    "dti_fa": "Fractional anisotropy",
-    "dti_md": "Mean diffusivity [mm<sup>2</sup>s<sup>-1</sup>]",
-    "dti_rd": "Radial diffusivity [mm<sup>2</sup>s<sup>-1</sup>]",
-    "mtr": "Magnetization transfer ratio [%]",
-    "mtsat": "Magnetization transfer saturation [%]",
-    "t1": "T1 [ms]",
-}
-
-# scaling factor (for display)
-scaling_factor = {
-    "csa_t1": 1,
-    "csa_t2": 1,
-    "csa_gm": 1,
-    "dti_fa": 1,
-    "dti_md": 1000,
-    "dti_rd": 1000,
-    "mtr": 1,
-    "mtsat": 1,
-    "t1": 1000,
-}
-
 # FIGURE PARAMETERS
 FONTSIZE = 15
 TICKSIZE = 10
@@ -205,8 +137,9 @@ LABELSIZE = 15
 def get_parser():
     parser = argparse.ArgumentParser(
         description="Generate figures for the spine-generic project. Statistical resuls are output in the file '{}'. "
-        "The following metrics will be computed:\n {}".format(
-            FNAME_LOG, list(metric_to_field.keys())
+        "The following metrics will be computed (if their csv file is present, see config/metrics.json), along with "
+        "the other csv files output by sct_process_segmentation or sct_extract_metric:\n {}".format(
+            FNAME_LOG, list(spinegeneric.metrics.load_registry().keys())
         ),
         formatter_class=sg.utils.SmartFormatter,
     )
@@ -233,6 +166,69 @@ def get_parser():
         action="store_true",
         help="Write statistical results into sentences for easy copy/paste into a manuscript.",
     )
+    parser.add_argument(
+        "-output-stats",
+        nargs="+",
+        metavar=sg.utils.Metavar.file,
+        help="Write statistical results into a table, for all metrics: statistics per site, per vendor and per "
+        "metric (mean, std, COV, 95%% CI, ANOVA), Tukey test, excluded subjects and sites, and age of participants. "
+        "Values are not scaled (same units as the csv files). The format is defined by the file extension: {}. "
+        "Several files can be listed. Example: stats.json stats.parquet".format(", ".join(STATS_FORMATS)),
+    )
+    parser.add_argument(
+        "-output-influence",
+        metavar=sg.utils.Metavar.file,
+        help="Write the influence of each subject and each site on the statistics of its vendor, for all metrics: "
+        "vendor mean, inter-site COV, intra-site COV and ANOVA F across sites, with and without the subject (or "
+        "site), ranked by influence within each metric. This helps choosing the subjects and sites of -exclude, "
+        "without running the analysis for each candidate. Values are not scaled. The format is defined by the file "
+        "extension: {}.".format(", ".join(STATS_FORMATS)),
+    )
+    parser.add_argument(
+        "-n-boot",
+        type=int,
+        default=0,
+        metavar=sg.utils.Metavar.int,
+        help="Number of bootstrap resamples for the 95%% confidence intervals of the mean, inter-site COV and "
+        "intra-site COV of each vendor (sites are resampled within vendor). By default, no bootstrap. Example: 10000",
+    )
+    parser.add_argument(
+        "-n-perm",
+        type=int,
+        default=0,
+        metavar=sg.utils.Metavar.int,
+        help="Number of permutations for the p-values of the ANOVAs across sites (subjects are shuffled across the "
+        "sites of their vendor) and across vendors (sites are shuffled across vendors). By default, only parametric "
+        "p-values are computed. Example: 10000",
+    )
+    parser.add_argument(
+        "-seed",
+        type=int,
+        default=0,
+        metavar=sg.utils.Metavar.int,
+        help="Seed of the random number generator of -n-boot and -n-perm. Results are reproducible for a given "
+        "seed, whatever the number of jobs.",
+    )
+    parser.add_argument(
+        "-harmonize",
+        nargs="*",
+        choices=HARMONIZATION_COVARIATES,
+        metavar="COVARIATE",
+        help="Harmonize the values of all metrics across sites (ComBat: location and scale of each site, with "
+        "empirical Bayes shrinkage across metrics), preserving the effect of the listed covariates of "
+        "participants.tsv (choices: {}). The harmonized values of each metric, and the fitted parameters ({}), are "
+        "written in the folder '{}'. The inter-site and intra-site COVs of the harmonized values are logged and "
+        "added to -output-stats. Example: -harmonize age sex".format(
+            ", ".join(HARMONIZATION_COVARIATES), FNAME_HARMONIZATION_PARAMS, DIR_HARMONIZED
+        ),
+    )
+    parser.add_argument(
+        "-harmonization-params",
+        metavar=sg.utils.Metavar.file,
+        help="Harmonize with the parameters fitted by a previous run of -harmonize, instead of fitting them (e.g. to "
+        "harmonize new subjects of the same sites without changing the harmonized values of the other subjects). "
+        "Values of sites that were not fitted are not harmonized.",
+    )
     parser.add_argument(
         "-exclude",
         required=False,
@@ -253,80 +249,160 @@ def get_parser():
             """
         ),
     )
+    parser.add_argument(
+        "-duplicates",
+        choices=["latest", "sct-version", "error"],
+        default="latest",
+        help="R|How to handle duplicated measures of a file (same subject, file, vertebral levels and label), which "
+        "happen when a subject is processed again and its results are appended to the csv files:\n"
+        "  latest: keep the most recent measure (column 'Timestamp').\n"
+        "  sct-version: keep the measures output by the SCT version defined with -sct-version.\n"
+        "  error: stop if duplicated measures are found.\n"
+        "Dropped measures are listed in the log.",
+    )
+    parser.add_argument(
+        "-sct-version",
+        metavar=sg.utils.Metavar.str,
+        help="SCT version of the measures to keep (see column 'SCT Version' of the csv files), with "
+        "'-duplicates sct-version'.",
+    )
     parser.add_argument(
         "-v",
         action="store_true",
         help="Increase verbosity; interactive figure (for debugging).",
     )
+    parser.add_argument(
+        "-formats",
+        default="png",
+        metavar=sg.utils.Metavar.list,
+        help="Comma-separated list of output formats of the figures, among: {}. Each figure is built once and "
+        "written in all formats. 'thumb' is a low resolution png, written with the suffix '_thumb'. "
+        "Example: png,pdf,thumb".format(",".join(FIGURE_FORMATS)),
+    )
+    parser.add_argument(
+        "-max-subjects",
+        type=int,
+        default=MAX_SUBJECTS,
+        metavar=sg.utils.Metavar.int,
+        help="Maximum number of individual subjects drawn on a figure. Above this number, the values of each site "
+        "are summarized with a box plot (box: quartiles, whiskers: 5th and 95th percentiles), so that the size of "
+        "the output does not depend on the number of subjects.",
+    )
     parser.add_argument(
         "-output-html",
         action="store_true",
-        help="Generate interactive graph in .html with Plotly",
+        help="Generate interactive graph in .html with Plotly (one file per figure). The plotly.js library is "
+        "written once in the file 'plotly.min.js', which is shared by all html files.",
+    )
+    parser.add_argument(
+        "-output-dashboard",
+        action="store_true",
+        help="Generate a single html page '{}' with all interactive Plotly figures (one tab per figure). The page is "
+        "self-contained: it can be moved or shared without other files.".format(FNAME_DASHBOARD),
+    )
+    parser.add_argument(
+        "-no-cache",
+        action="store_true",
+        help="Recompute all metrics. By default, the results of a metric (statistics and figures) are fetched from "
+        "the cache folder '{}' if its inputs (csv file, participants.tsv, excluded subjects/sites, options, code of "
+        "spinegeneric) did not change since a previous run.".format(CACHE_DIR),
+    )
+    parser.add_argument(
+        "-jobs",
+        type=int,
+        default=1,
+        metavar=sg.utils.Metavar.int,
+        help="Number of metrics processed in parallel. Set to -1 to use all available cores. The order of the "
+        "output log does not depend on the number of jobs.",
+    )
+    parser.add_argument(
+        "-watch",
+        action="store_true",
+        help="Follow the csv files while they are being appended to (e.g. while sct_run_batch is running), until "
+        "interrupted with Ctrl+C. Only the lines appended since the previous check are parsed. The number of "
+        "subjects, mean, std and COV of the sites that received new results are logged, and the figures and "
+        "statistics (including -output-stats and -output-dashboard) are refreshed at most every -watch-interval "
+        "seconds. Options -jobs and -no-cache are ignored.",
+    )
+    parser.add_argument(
+        "-watch-interval",
+        type=float,
+        default=600,
+        metavar=sg.utils.Metavar.float,
+        help="With -watch: minimum interval between two refreshes of the figures and statistics, in seconds.",
     )
     return parser
 
 
-def aggregate_per_site(dict_results, metric, dict_exclude_subj):
+def get_exclusions(metric, dict_exclude_subj):
+    """
+    Subjects and sites to exclude for a metric. Entries of the exclusion file that start with 'sub-' are subjects,
+    the other entries are sites.
+    :param metric: str: metric name
+    :param dict_exclude_subj: dict of subjects/sites to exclude, per metric
+    :return: subjects: list of str
+    :return: sites: list of str
+    """
+    entries = [str(entry) for entry in dict_exclude_subj.get(metric) or []]
+    subjects = [entry for entry in entries if entry.startswith("sub-")]
+    sites = [entry for entry in entries if not entry.startswith("sub-")]
+    return subjects, sites
+
+
+def aggregate_per_site(results, metric, dict_exclude_subj):
     """
     Aggregate metrics per site.
-    folder.
-    :param dict_results:
-    :param metric: Metric type
-    :return:
+    The metric table is joined with participants.tsv in a single indexed merge (keyed by subject), instead of
+    looking up each row of the csv file in the participants table.
+    :param results: pandas DataFrame with columns 'Filename' and the metric field (see load_results_csv)
+    :param metric: Metric
+    :param dict_exclude_subj: dict of subjects/sites to exclude, per metric
+    :return: df: Pandas structure indexed by site, with columns: site, vendor, model
+    :return: site_values: SiteValues: values and subjects of each site
+    :return: subjects_removed: list of subjects removed because they are listed in the exclusion file
     """
+    import spinegeneric.results
+
     # Build Panda DF of participants based on participants.tsv file
     participants = load_participants_file()
 
     # Fetch specific field for the selected metric
-    metric_field = metric_to_field[metric]
-    # Build a dictionary that aggregates values per site
-    results_agg = {}
-    # Loop across lines and fill dict of aggregated results
-    subjects_removed = []
-    for i in tqdm.tqdm(
-        range(len(dict_results)),
-        unit="iter",
-        unit_scale=False,
-        desc="Loop across subjects",
-        ascii=True,
-        ncols=80,
-    ):
-        filename = dict_results[i]["Filename"]
-        logger.debug("Filename: " + filename)
-        # Fetch metadata for the site
-        # dataset_description = read_dataset_description(filename, path_data)
-        # cluster values per site
-        subject = fetch_subject(filename)
-        # check if subject needs to be discarded
-        if not remove_subject(subject, metric, dict_exclude_subj):
-            # Fetch index of row corresponding to subject
-            rowIndex = participants[participants["participant_id"] == subject].index
-            # Add column "val" with metric value
-            participants.loc[rowIndex, "val"] = dict_results[i][metric_field]
-            site = participants["institution_id"][rowIndex].array[0]
-            if site not in results_agg.keys():
-                # if this is a new site, initialize sub-dict
-                results_agg[site] = {}
-                results_agg[site][
-                    "site"
-                ] = site  # need to duplicate in order to be able to sort using vendor AND site with Pandas
-                results_agg[site]["vendor"] = participants["manufacturer"][
-                    rowIndex
-                ].array[0]
-                results_agg[site]["model"] = participants["manufacturers_model_name"][
-                    rowIndex
-                ].array[0]
-                results_agg[site]["val"] = []
-                results_agg[site]["subject"] = []
-            # add val for site (ignore None)
-            val = dict_results[i][metric_field]
-            if val != "None":
-                results_agg[site]["val"].append(float(val))
-                results_agg[site]["subject"].append(subject)
-        else:
-            subjects_removed.append(subject)
+    metric_field = metric.field
+    results = results[["Filename", metric_field]].rename(columns={metric_field: "val"})
+    # Fetch subject from filename (i.e., the folder two levels above the file)
+    results["subject"] = results["Filename"].str.split(os.sep).str[-3]
+
+    # Discard subjects listed in the exclusion file
+    is_removed = results["subject"].isin(get_exclusions(metric.name, dict_exclude_subj)[0])
+    subjects_removed = results["subject"][is_removed].tolist()
     logger.info("Subjects removed: {}".format(subjects_removed))
-    return results_agg
+    results = results[~is_removed]
+
+    # Fetch site, vendor and model of each subject
+    participants = participants.drop_duplicates("participant_id").set_index("participant_id")
+    is_unknown = ~results["subject"].isin(participants.index)
+    if is_unknown.any():
+        logger.warning(
+            "Subjects missing from participants.tsv: {}".format(results["subject"][is_unknown].tolist())
+        )
+    results = results.join(
+        participants[["institution_id", "manufacturer", "manufacturers_model_name"]],
+        on="subject",
+        how="inner",
+    )
+
+    # Build a DF of sites (sites are listed by order of appearance in the csv file)
+    df = results.drop_duplicates("institution_id").rename(
+        columns={"institution_id": "site", "manufacturer": "vendor", "manufacturers_model_name": "model"}
+    )[["site", "vendor", "model"]]
+    # need to duplicate site in order to be able to sort using vendor AND site with Pandas
+    df.index = df["site"].values
+    # Aggregate values per site (ignore None values)
+    results = results[results["val"].notna()]
+    site_values = spinegeneric.results.SiteValues.from_long(
+        results["institution_id"], results["val"], results["subject"], sites=df.index
+    )
+    return df, site_values, subjects_removed
 
 
 def add_stats_per_vendor(
@@ -347,6 +423,9 @@ def add_stats_per_vendor(
     :param color
     :param show_ci: Bool: Show 95% confidence interval
     """
+    import numpy as np
+    import matplotlib.patches as patches
+
     # add stats as strings
     if cov_intra == 0:
         txt = "{0:.2f} $\\pm$ {1:.2f}\nCOV inter:{2:.2f}%".format(
@@ -383,75 +462,131 @@ def add_stats_per_vendor(
     return ax
 
 
-def compute_statistics(df):
+def compute_statistics(df, site_values, n_boot=0, n_perm=0, rng=None):
     """
     Compute statistics such as mean, std, COV, etc.
+    Statistics are computed with grouped reductions, so that site and vendor statistics are each obtained in a
+    single pass, whatever the number of sites.
     :param df Pandas structure
+    :param site_values SiteValues: values of each site
+    :param n_boot: int: number of bootstrap resamples for the confidence intervals of the vendor mean and COVs (0: no
+      bootstrap)
+    :param n_perm: int: number of permutations for the p-values of the ANOVAs (0: no permutation test)
+    :param rng: numpy.random.Generator used for the bootstrap and permutations
     """
+    import numpy as np
+    import pandas as pd
+    from statsmodels.stats.multicomp import pairwise_tukeyhsd
+    import spinegeneric.stats
+    import spinegeneric.variance
+
     vendors = ["GE", "Philips", "Siemens"]
-    mean_per_row = []
-    std_per_row = []
     stats = {}
-    # Compute statistics within site
-    for site in df.index:
-        mean_per_row.append(np.mean(df["val"][site]))
-        std_per_row.append(np.std(df["val"][site]))
-    # Update Dataframe
-    df[
-        "mean"
-    ] = mean_per_row  # mean within each site (e.g., if there are 35 sites, this will be a vector of length 35)
-    df["std"] = std_per_row
-    df["cov"] = np.array(std_per_row) / np.array(mean_per_row)
-    # Compute intra-vendor COV
+    # Compute statistics within site (e.g., if there are 35 sites, these are vectors of length 35)
+    stats_per_site = pd.DataFrame(
+        {"n": site_values.counts, "mean": site_values.mean(), "std": site_values.std()},
+        index=site_values.sites,
+    ).reindex(df.index)
+    df["n"] = stats_per_site["n"]
+    df["mean"] = stats_per_site["mean"]
+    df["std"] = stats_per_site["std"]
+    df["cov"] = df["std"] / df["mean"]
+
+    # Compute statistics within vendor, based on the within-site values of the sites that are not excluded
+    df_included = df[~df["exclude"]]
+    mean_per_vendor = df_included.groupby("vendor")["mean"]
+    n_site = mean_per_vendor.size().reindex(vendors, fill_value=0)
+    # mean within vendor (mean of the within-site means)
+    mean = mean_per_vendor.mean().reindex(vendors)
+    # std within vendor (std of the within-site means)
+    std = mean_per_vendor.std(ddof=0).reindex(vendors)
+    stats["mean"] = mean.to_dict()
+    stats["std"] = std.to_dict()
+    # 95% confidence interval
+    stats["95ci"] = (1.96 * std / np.sqrt(n_site)).to_dict()
+    # within-vendor inter-site COV (based on the within-site means)
+    stats["cov_inter"] = (std / mean).to_dict()
+    # intra-site COV, averaged across all the sites within the same vendor
+    stats["cov_intra"] = df_included.groupby("vendor")["cov"].mean().reindex(vendors).to_dict()
+
+    # ANOVA: category=[site], one ANOVA per vendor
+    anova_site = spinegeneric.stats.anova_oneway(
+        n=df_included["n"],
+        mean=df_included["mean"],
+        ssw=df_included["n"] * df_included["std"] ** 2,
+        anova_id=df_included["vendor"],
+    ).reindex(vendors)
+    stats["anova_site"] = {}
     for vendor in vendors:
-        # init dict
-        if "cov_inter" not in stats.keys():
-            stats["cov_inter"] = {}
-        if "cov_intra" not in stats.keys():
-            stats["cov_intra"] = {}
-        if "mean" not in stats.keys():
-            stats["mean"] = {}
-        if "std" not in stats.keys():
-            stats["std"] = {}
-        if "95ci" not in stats.keys():
-            stats["95ci"] = {}
-        if "anova_site" not in stats.keys():
-            stats["anova_site"] = {}
-        # fetch within-site mean values for a specific vendor
-        val_per_vendor = df["mean"][(df["vendor"] == vendor) & ~df["exclude"]]
-        # compute mean within vendor (mean of the within-site means)
-        stats["mean"][vendor] = np.mean(val_per_vendor)
-        # compute std within vendor (std of the within-site means)
-        stats["std"][vendor] = np.std(val_per_vendor)
-        # compute 95% confidence interval
-        stats["95ci"][vendor] = (
-            1.96 * np.std(val_per_vendor) / np.sqrt(len(val_per_vendor))
-        )
-        # compute within-vendor inter-site COV (based on the within-site means)
-        stats["cov_inter"][vendor] = np.std(val_per_vendor) / np.mean(val_per_vendor)
-        # compute intra-site COV, and average it across all the sites within the same vendor
-        stats["cov_intra"][vendor] = np.mean(
-            df["std"][(df["vendor"] == vendor) & ~df["exclude"]].values
-            / df["mean"][(df["vendor"] == vendor) & ~df["exclude"]].values
+        stats["anova_site"][vendor] = spinegeneric.stats.F_onewayResult(
+            float(anova_site["statistic"][vendor]), float(anova_site["pvalue"][vendor])
         )
-        # ANOVA: category=[site]
-        values_per_site = [
-            df["val"][(df["vendor"] == vendor) & (df["site"] == i_site)][0]
-            for i_site in df["site"][(df["vendor"] == vendor) & ~df["exclude"]]
-        ]
-        stats["anova_site"][vendor] = f_oneway(*values_per_site)
         logger.info(
             "ANOVA[site] for {}: {}".format(vendor, stats["anova_site"][vendor])
         )
 
     # ANOVA: category=[vendor]
-    stats["anova_vendor"] = f_oneway(
-        *[
-            df["mean"][(df["vendor"] == i_vendor) & ~df["exclude"]]
-            for i_vendor in vendors
-        ]
+    anova_vendor = spinegeneric.stats.anova_oneway(
+        n=n_site, mean=mean, ssw=n_site * std ** 2, anova_id=np.zeros(len(vendors))
+    ).iloc[0]
+    stats["anova_vendor"] = spinegeneric.stats.F_onewayResult(
+        float(anova_vendor["statistic"]), float(anova_vendor["pvalue"])
     )
     logger.info("ANOVA[vendor]: {}".format(stats["anova_vendor"]))
+
+    # Resampling and variance components are based on the sites (and subjects) that have values
+    df_included = df_included[df_included["n"] > 0]
+
+    # Variance components (subjects within sites, for each vendor), which account for unbalanced sites
+    reml = spinegeneric.variance.fit_reml(
+        df_included["n"], df_included["mean"], df_included["n"] * df_included["std"] ** 2, df_included["vendor"]
+    ).reindex(vendors)
+    stats["reml"] = {vendor: reml.loc[vendor].to_dict() for vendor in vendors}
+    for vendor in vendors:
+        logger.info(
+            "Variance components (REML) for {}: var_site={var_site:.4g}, var_residual={var_residual:.4g}, "
+            "ICC={icc:.4g}, COV inter={cov_inter:.4g}, COV intra={cov_intra:.4g}".format(vendor, **stats["reml"][vendor])
+        )
+    stats["n_boot"], stats["n_perm"] = n_boot, n_perm
+    if n_boot:
+        # Bootstrap confidence intervals, resampling sites within vendor
+        ci_boot = spinegeneric.stats.bootstrap_vendor(
+            df_included["mean"], df_included["cov"], df_included["vendor"], n_boot, rng
+        ).reindex(vendors)
+        stats["ci_boot"] = {vendor: ci_boot.loc[vendor].to_dict() for vendor in vendors}
+        for vendor in vendors:
+            logger.info(
+                "Bootstrap 95% CI ({} resamples) for {}: mean [{mean_ci_lower:.4g}, {mean_ci_upper:.4g}], "
+                "COV inter [{cov_inter_ci_lower:.4g}, {cov_inter_ci_upper:.4g}], COV intra [{cov_intra_ci_lower:.4g}, "
+                "{cov_intra_ci_upper:.4g}]".format(n_boot, vendor, **stats["ci_boot"][vendor])
+            )
+    if n_perm:
+        # Permutation tests: subjects are shuffled across the sites of their vendor, sites are shuffled across vendors
+        is_included = np.isin(site_values.sites, df_included.index)[site_values.site_ids]
+        site_id = site_values.site_ids[is_included]
+        site_vendor = df["vendor"].reindex(site_values.sites).values
+        pvalue_site = spinegeneric.stats.permutation_anova(
+            site_values.values[is_included],
+            site_id,
+            site_vendor[site_id],
+            n_perm,
+            rng,
+        ).reindex(vendors)
+        stats["pvalue_perm_site"] = pvalue_site.to_dict()
+        stats["pvalue_perm_vendor"] = float(
+            spinegeneric.stats.permutation_anova(
+                df_included["mean"], df_included["vendor"], np.zeros(len(df_included)), n_perm, rng
+            ).iloc[0]
+        )
+        for vendor in vendors:
+            logger.info(
+                "ANOVA[site] for {}: permutation p-value ({} permutations): {:.4g}".format(
+                    vendor, n_perm, stats["pvalue_perm_site"][vendor]
+                )
+            )
+        logger.info(
+            "ANOVA[vendor]: permutation p-value ({} permutations): {:.4g}".format(n_perm, stats["pvalue_perm_vendor"])
+        )
     # Multiple pairwise comparison with Tukey Honestly Significant Difference (HSD) test
     stats["tukey_test"] = pairwise_tukeyhsd(df["mean"], df["vendor"])
     logger.info(
@@ -501,13 +636,22 @@ def output_text(stats):
         txt += "The inter-site COVs (and inter-site ANOVA p-values) were "
 
     for count, vendor in enumerate(stats["cov_inter"].keys()):
-        cov_inter = stats["cov_inter"][vendor] * 100
-        p_val = stats["anova_site"][vendor][1]
+        cov_inter = "{:.1f}%".format(stats["cov_inter"][vendor] * 100)
+        if stats.get("n_boot"):
+            # Bootstrap 95% confidence interval
+            cov_inter += " [{:.1f}-{:.1f}%]".format(
+                stats["ci_boot"][vendor]["cov_inter_ci_lower"] * 100,
+                stats["ci_boot"][vendor]["cov_inter_ci_upper"] * 100,
+            )
+        if stats.get("n_perm"):
+            p_val = stats["pvalue_perm_site"][vendor]
+        else:
+            p_val = stats["anova_site"][vendor][1]
         p_val = format_p_value(p_val)
         if single_subject:
-            txt += "{:.1f}% for {}".format(cov_inter, vendor)
+            txt += "{} for {}".format(cov_inter, vendor)
         else:
-            txt += "{:.1f}% (p{}) for {}".format(cov_inter, p_val, vendor)
+            txt += "{} (p{}) for {}".format(cov_inter, p_val, vendor)
         if count == 0:
             txt += ", "
         elif count == 1:
@@ -515,7 +659,25 @@ def output_text(stats):
         elif count == 2:
             txt += ". "
 
-    p_val_anova = stats["anova_vendor"][1]
+    # Variance components
+    if not single_subject and "reml" in stats:
+        reml = [
+            "{:.2f} ({:.1f}%) for {}".format(stats["reml"][vendor]["icc"], stats["reml"][vendor]["cov_inter"] * 100, vendor)
+            for vendor in stats["reml"]
+        ]
+        txt += (
+            "Variance components (REML, subjects within sites) gave intra-class correlations (and inter-site COVs) "
+            "of {} and {}. ".format(", ".join(reml[:-1]), reml[-1])
+        )
+    if stats.get("n_boot"):
+        txt += "Confidence intervals (95%) were obtained with {} bootstrap resamples of the sites. ".format(
+            stats["n_boot"]
+        )
+    if stats.get("n_perm"):
+        txt += "P-values were obtained with {} permutations. ".format(stats["n_perm"])
+        p_val_anova = stats["pvalue_perm_vendor"]
+    else:
+        p_val_anova = stats["anova_vendor"][1]
     # Write post-hoc Tukey results if inter-vendor difference was significant
     if p_val_anova < 0.05:
         p_val_anova = format_p_value(p_val_anova)
@@ -560,15 +722,187 @@ def output_text(stats):
     logger.info(txt)
 
 
-def fetch_subject(filename):
+def get_stats_table(results_per_metric, age_stats):
     """
-    Get subject from filename
-    :param filename:
-    :return: subject
+    Gather the statistical results of all metrics in a single table. Each row is an entity, defined by the column
+    'level':
+      - participants: age statistics across participants (columns: median, min, max)
+      - site: statistics within site (columns: site, vendor, model, excluded, n, mean, std, cov)
+      - subject: subject removed from the statistics (columns: subject, excluded)
+      - vendor: statistics across the sites of a vendor (columns: vendor, n, mean, std, ci95, cov_intra, cov_inter)
+        and ANOVA across these sites (columns: statistic, pvalue). With -n-boot: bootstrap confidence intervals
+        (columns: mean_ci_lower, mean_ci_upper, cov_inter_ci_lower, cov_inter_ci_upper, cov_intra_ci_lower,
+        cov_intra_ci_upper). With -n-perm: permutation p-value of the ANOVA (column: pvalue_perm). Variance
+        components estimated by REML (columns: var_site, var_residual, icc, cov_inter_reml, cov_intra_reml). With
+        -harmonize: COVs of the harmonized values (columns: cov_inter_harmonized, cov_intra_harmonized)
+      - metric: ANOVA across vendors (columns: statistic, pvalue, and pvalue_perm with -n-perm)
+      - tukey: Tukey HSD test between two vendors (columns: vendor, vendor2, meandiff, p_adj, ci_lower, ci_upper,
+        reject)
+    :param results_per_metric: OrderedDict: key: metric, value: tuple (df, site_values, stats) output by run_metric()
+    :param age_stats: pandas Series output by compute_age_statistics()
+    :return: pandas DataFrame
     """
-    path, file = os.path.split(filename)
-    subject = path.split(os.sep)[-2]
-    return subject
+    import numpy as np
+    import pandas as pd
+
+    columns = [
+        "metric", "level", "site", "vendor", "vendor2", "model", "subject", "excluded", "n", "mean", "std", "cov",
+        "ci95", "cov_intra", "cov_inter", "statistic", "pvalue", "pvalue_perm", "mean_ci_lower", "mean_ci_upper",
+        "cov_inter_ci_lower", "cov_inter_ci_upper", "cov_intra_ci_lower", "cov_intra_ci_upper", "var_site",
+        "var_residual", "icc", "cov_inter_reml", "cov_intra_reml", "cov_inter_harmonized", "cov_intra_harmonized",
+        "meandiff", "p_adj", "ci_lower", "ci_upper",
+        "reject", "median", "min", "max",
+    ]
+    tables = [pd.DataFrame([dict(level="participants", **age_stats.to_dict())])]
+    for metric, (df, site_values, stats) in results_per_metric.items():
+        # Sites
+        tables.append(
+            df[["site", "vendor", "model", "exclude", "n", "mean", "std", "cov"]].rename(
+                columns={"exclude": "excluded"}
+            ).assign(metric=metric, level="site")
+        )
+        # Subjects
+        tables.append(
+            pd.DataFrame({"subject": stats["subjects_removed"], "excluded": True}).assign(
+                metric=metric, level="subject"
+            )
+        )
+        # Vendors
+        vendors = list(stats["mean"].keys())
+        table_vendors = pd.DataFrame(
+            {
+                "vendor": vendors,
+                "n": [((df["vendor"] == vendor) & ~df["exclude"]).sum() for vendor in vendors],
+                "mean": [stats["mean"][vendor] for vendor in vendors],
+                "std": [stats["std"][vendor] for vendor in vendors],
+                "ci95": [stats["95ci"][vendor] for vendor in vendors],
+                "cov_intra": [stats["cov_intra"][vendor] for vendor in vendors],
+                "cov_inter": [stats["cov_inter"][vendor] for vendor in vendors],
+                "statistic": [stats["anova_site"][vendor].statistic for vendor in vendors],
+                "pvalue": [stats["anova_site"][vendor].pvalue for vendor in vendors],
+            }
+        )
+        if "reml" in stats:
+            reml = pd.DataFrame([stats["reml"][vendor] for vendor in vendors])
+            for column in ["var_site", "var_residual", "icc"]:
+                table_vendors[column] = reml[column]
+            table_vendors["cov_inter_reml"] = reml["cov_inter"]
+            table_vendors["cov_intra_reml"] = reml["cov_intra"]
+        if "harmonized" in stats:
+            for column in ["cov_inter", "cov_intra"]:
+                table_vendors[column + "_harmonized"] = [stats["harmonized"][vendor][column] for vendor in vendors]
+        if stats.get("n_boot"):
+            table_vendors = table_vendors.join(pd.DataFrame([stats["ci_boot"][vendor] for vendor in vendors]))
+        if stats.get("n_perm"):
+            table_vendors["pvalue_perm"] = [stats["pvalue_perm_site"][vendor] for vendor in vendors]
+        tables.append(table_vendors.assign(metric=metric, level="vendor"))
+        # Across vendors
+        table_metric = pd.DataFrame(
+            [dict(statistic=stats["anova_vendor"].statistic, pvalue=stats["anova_vendor"].pvalue)]
+        )
+        if stats.get("n_perm"):
+            table_metric["pvalue_perm"] = stats["pvalue_perm_vendor"]
+        tables.append(table_metric.assign(metric=metric, level="metric"))
+        # Tukey test (pairs are in the same order as in the summary of the test)
+        tukey = stats["tukey_test"]
+        group1, group2 = np.triu_indices(len(tukey.groupsunique), 1)
+        tables.append(
+            pd.DataFrame(
+                {
+                    "vendor": tukey.groupsunique[group1],
+                    "vendor2": tukey.groupsunique[group2],
+                    "meandiff": tukey.meandiffs,
+                    "p_adj": tukey.pvalues,
+                    "ci_lower": tukey.confint[:, 0],
+                    "ci_upper": tukey.confint[:, 1],
+                    "reject": tukey.reject,
+                }
+            ).assign(metric=metric, level="tukey")
+        )
+    table = pd.concat(tables, ignore_index=True).reindex(columns=columns)
+    # Use nullable dtypes, so that missing values are kept as such in all formats
+    table = table.astype({"n": "Int64", "excluded": "boolean", "reject": "boolean"})
+    for column in ["metric", "level", "site", "vendor", "vendor2", "model", "subject"]:
+        table[column] = table[column].astype("string")
+    return table
+
+
+def get_influence_table(results_per_metric):
+    """
+    Influence of each subject and each site on the statistics of its vendor: the statistics of the vendor are
+    computed without each candidate, in closed form (see spinegeneric.stats.leave_one_out()). Sites excluded from
+    the statistics, and their subjects, are not candidates.
+    :param results_per_metric: OrderedDict: key: metric, value: tuple (df, site_values, stats) output by run_metric()
+    :return: pandas DataFrame with one row per candidate, with columns: metric, rank, removed ('subject' or 'site'),
+      subject, site, vendor, influence, and for each statistic (mean, cov_inter, cov_intra, statistic): its value
+      without the candidate and the difference with the value with the candidate (prefix 'delta_'). The influence
+      is the largest relative difference among the statistics. Rows are sorted by decreasing influence within each
+      metric (rank 1: most influential).
+    """
+    import numpy as np
+    import pandas as pd
+    import spinegeneric.stats
+
+    statistics = ["mean", "cov_inter", "cov_intra", "statistic"]
+    tables = []
+    for metric, (df, site_values, stats) in results_per_metric.items():
+        site_vendor = df["vendor"].reindex(site_values.sites).where(~df["exclude"].reindex(site_values.sites))
+        is_included = site_vendor.notna().values[site_values.site_ids]
+        site_id = site_values.site_ids[is_included]
+        vendors, candidates = spinegeneric.stats.leave_one_out(
+            site_values.values[is_included], site_id, site_vendor.where(site_values.counts > 0).values
+        )
+        is_subject = (candidates["removed"] == "subject").values
+        idx = candidates["index"].values
+        candidates["subject"] = None
+        candidates.loc[is_subject, "subject"] = site_values.subjects[is_included][idx[is_subject]]
+        idx_site = idx.copy()
+        idx_site[is_subject] = site_id[idx[is_subject]]
+        candidates["site"] = site_values.sites[idx_site]
+        # Difference with the statistics of the vendor with all subjects and sites
+        baseline = vendors.reindex(candidates["vendor"])
+        for name in statistics:
+            candidates["delta_" + name] = candidates[name].values - baseline[name].values
+        with np.errstate(divide="ignore", invalid="ignore"):
+            relative = np.abs(candidates[["delta_" + name for name in statistics]].values / baseline[statistics].values)
+        relative[~np.isfinite(relative)] = np.nan
+        candidates["influence"] = pd.DataFrame(relative).max(axis=1).values
+        candidates = candidates.sort_values("influence", ascending=False, kind="stable", na_position="last")
+        candidates["rank"] = np.arange(1, len(candidates) + 1)
+        tables.append(candidates.assign(metric=metric))
+    columns = ["metric", "rank", "removed", "subject", "site", "vendor", "influence"] + [
+        column for name in statistics for column in [name, "delta_" + name]
+    ]
+    table = pd.concat(tables, ignore_index=True).reindex(columns=columns)
+    for column in ["metric", "removed", "subject", "site", "vendor"]:
+        table[column] = table[column].astype("string")
+    return table
+
+
+def write_stats_table(table, fname):
+    """
+    Write the table output by get_stats_table() (or get_influence_table()), in a format defined by the file
+    extension (see STATS_FORMATS)
+    :param table: pandas DataFrame
+    :param fname: str: output file
+    :return:
+    """
+    import json
+    import pandas as pd
+
+    ext = os.path.splitext(fname)[1].lower()
+    if ext == ".json":
+        # One record per row, without the fields that do not apply to the row
+        records = [
+            {column: value for column, value in row.items() if not pd.isna(value)}
+            for row in table.astype(object).to_dict(orient="records")
+        ]
+        with open(fname, "w") as f:
+            json.dump(records, f, indent=2)
+    elif ext == ".parquet":
+        table.to_parquet(fname, index=False)
+    else:
+        raise ValueError("Unsupported format: {}".format(fname))
 
 
 def load_participants_file():
@@ -577,6 +911,8 @@ def load_participants_file():
     This function assumes that the file participants.tsv is present in the -path-results
     :return: participants: pandas dataframe
     """
+    import pandas as pd
+
     participants = pd.read_csv(os.path.join("participants.tsv"), sep="\t")
     return participants
 
@@ -584,7 +920,7 @@ def load_participants_file():
 def compute_age_statistics():
     """
     Compute age statistics across subjects and write them into output txt file
-    :return:
+    :return: age_stats: pandas Series with index: median, min, max
     """
     participants = load_participants_file()
     logger.info("Age statistics:")
@@ -595,20 +931,115 @@ def compute_age_statistics():
             age_stats["min"], age_stats["max"], age_stats["median"]
         )
     )
+    return age_stats
+
+
+def new_figure(figsize):
+    """
+    Create a matplotlib figure, attached to a headless Agg canvas. The figure is not registered in pyplot, so it is
+    released as soon as it is no longer referenced. In debug mode (interactive display), the figure is created with
+    pyplot instead.
+    :param figsize: tuple: size of the figure, in inches
+    :return: matplotlib Figure
+    """
+    if logger.level == logging.DEBUG:
+        import matplotlib
+        import matplotlib.pyplot as plt
+
+        matplotlib.use("TkAgg")
+        plt.ion()
+        return plt.figure(figsize=figsize)
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def save_figure(fig, fname_base, formats, dpi="figure"):
+    """
+    Write a figure in several formats
+    :param fig: matplotlib Figure
+    :param fname_base: str: output file name, without extension
+    :param formats: list of str: output formats (see FIGURE_FORMATS)
+    :param dpi: resolution of png files ('figure': use the resolution of the figure)
+    :return: list of str: output files
+    """
+    fnames = []
+    for fmt in formats:
+        if fmt == "thumb":
+            fname = fname_base + "_thumb.png"
+            fig.savefig(fname, dpi=THUMB_DPI)
+        else:
+            fname = fname_base + "." + fmt
+            fig.savefig(fname, dpi=dpi)
+        logger.info("Created: " + fname)
+        fnames.append(fname)
+    return fnames
+
+
+def get_site_summary(site_values, sites, scale=1):
+    """
+    Summarize the distribution of the values of each site, for display
+    :param site_values: SiteValues
+    :param sites: list of str: sites to summarize, in display order
+    :param scale: float: scaling factor (for display)
+    :return: dict: key: 'p5', 'q1', 'median', 'q3', 'p95', value: array of float, in the order of sites (NaN for
+      sites without values)
+    """
+    index = {site: i for i, site in enumerate(site_values.sites)}
+    idx_sites = [index[site] for site in sites]
+    return {
+        name: site_values.quantile(q)[idx_sites] * scale
+        for name, q in [("p5", 0.05), ("q1", 0.25), ("median", 0.5), ("q3", 0.75), ("p95", 0.95)]
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def get_flag(name):
+    """
+    Get the flag of a country from the folder flags, rotated for display under the xticks. Flags are decoded once
+    per process.
+    :param name Name of the country
+    :return: np.array: RGBA image
+    """
+    from scipy import ndimage
+    import matplotlib.image
+
+    with importlib.resources.as_file(importlib.resources.files(spinegeneric.flags) / f"{name}.png") as path_flag:
+        img = matplotlib.image.imread(str(path_flag))
+    img_rot = ndimage.rotate(img, 45).clip(0, 1)
+    # Cached images are shared across figures
+    img_rot.flags.writeable = False
+    return img_rot
 
 
 def generate_figure_metric(
-    df, metric, stats, display_individual_subjects, show_ci=False
+    df,
+    site_values,
+    metric,
+    stats,
+    display_individual_subjects,
+    show_ci=False,
+    formats=("png",),
+    max_subjects=MAX_SUBJECTS,
 ):
     """
     Generate bar plot across sites
     :param df:
-    :param metric:
+    :param site_values: SiteValues
+    :param metric: Metric
     :param stats:
     :param display_individual_subjects:
     :param show_ci: Bool: Show 95% confidence interval
-    :return:
+    :param formats: list of str: output formats (see FIGURE_FORMATS)
+    :param max_subjects: int: above this number of subjects, the values of each site are shown as a box plot
+    :return: list of str: output files
     """
+    import numpy as np
+    from matplotlib.artist import setp
+    from matplotlib.offsetbox import OffsetImage, AnnotationBbox
 
     def add_flag(coord, name, ax):
         """
@@ -617,20 +1048,7 @@ def generate_figure_metric(
         :param name Name of the country
         :param ax Matplotlib ax
         """
-
-        def _get_flag(name):
-            """
-            Get the flag of a country from the folder flags.
-            :param name Name of the country
-            """
-            with importlib.resources.path(
-                spinegeneric.flags, f"{name}.png"
-            ) as path_flag:
-                return plt.imread(path_flag.__str__())
-
-        img = _get_flag(name)
-        img_rot = ndimage.rotate(img, 45)
-        im = OffsetImage(img_rot.clip(0, 1), zoom=0.18)
+        im = OffsetImage(get_flag(name), zoom=0.18)
         im.image.axes = ax
 
         ab = AnnotationBbox(
@@ -660,12 +1078,6 @@ def generate_figure_metric(
             )
         return ax
 
-    if logger.level == logging._nameToLevel["DEBUG"]:
-        import matplotlib
-
-        matplotlib.use("TkAgg")
-        plt.ion()
-
     # Sort values per vendor
     # TODO: sort per model
     site_sorted = df.sort_values(by=["vendor", "model", "site"]).index.values
@@ -675,18 +1087,19 @@ def generate_figure_metric(
     model_sorted = df["model"][site_sorted].values
 
     # Scale values (for display)
-    mean_sorted = mean_sorted * scaling_factor[metric]
-    std_sorted = std_sorted * scaling_factor[metric]
+    mean_sorted = mean_sorted * metric.scale
+    std_sorted = std_sorted * metric.scale
 
     # Get color based on vendor
     list_colors = [vendor_to_color[i] for i in vendor_sorted]
 
     # Create figure and plot bar graph
     # The horizontal size of the figure is proportional to the number of sites
-    fig, ax = plt.subplots(figsize=(len(site_sorted) * 0.4, 8))
-    plt.grid(axis="y")
+    fig = new_figure(figsize=(len(site_sorted) * 0.4, 8))
+    ax = fig.add_subplot()
+    ax.grid(axis="y")
     ax.set_axisbelow(True)
-    bar_plot = plt.bar(
+    bar_plot = ax.bar(
         range(len(site_sorted)),
         height=mean_sorted,
         width=0.5,
@@ -695,26 +1108,43 @@ def generate_figure_metric(
         color=list_colors,
     )
 
-    # Display individual subjects
-    if display_individual_subjects:
-        for site in site_sorted:
-            index = list(site_sorted).index(site)
-            val = df["val"][site]
-            # Set scaling
-            val = [value * scaling_factor.get(metric) for value in val]
-            plt.plot([index] * len(val), val, "r.")
+    # Display individual subjects (all subjects are drawn at once, in a single artist), or their distribution per site
+    # for large cohorts
+    if display_individual_subjects and len(site_values.values) > max_subjects:
+        summary = get_site_summary(site_values, site_sorted, metric.scale)
+        ax.bxp(
+            [
+                {"med": summary["median"][i], "q1": summary["q1"][i], "q3": summary["q3"][i],
+                 "whislo": summary["p5"][i], "whishi": summary["p95"][i]}
+                for i in range(len(site_sorted))
+                if not np.isnan(summary["median"][i])
+            ],
+            positions=np.flatnonzero(~np.isnan(summary["median"])),
+            widths=0.3,
+            showfliers=False,
+            manage_ticks=False,
+            boxprops=dict(color="red"),
+            whiskerprops=dict(color="red"),
+            capprops=dict(color="red"),
+            medianprops=dict(color="red"),
+        )
+    elif display_individual_subjects:
+        values_sorted = [site_values[site] for site in site_sorted]
+        x = np.repeat(np.arange(len(site_sorted)), [len(val) for val in values_sorted])
+        val = np.concatenate(values_sorted) * metric.scale
+        ax.plot(x, val, "r.")
 
     # Deal with xticklabels
     # Rotate xticklabels at 45deg, align at end
-    plt.setp(ax.xaxis.get_majorticklabels(), rotation=45, ha="right")
-    plt.xlim([-1, len(site_sorted)])
+    setp(ax.xaxis.get_majorticklabels(), rotation=45, ha="right")
+    ax.set_xlim([-1, len(site_sorted)])
     # Add space after the site name to allow space for flag
     ax.set_xticklabels([s for s in site_sorted])
     ax.tick_params(labelsize=15)
 
     # plt.ylim(ylim[contrast])
     # plt.yticks(np.arange(ylim[contrast][0], ylim[contrast][1], step=ystep[contrast]))
-    plt.ylabel(metric_to_label[metric], fontsize=15)
+    ax.set_ylabel(metric.label, fontsize=15)
     ax.set_ylim(0.3 * mean_sorted.max(), 1.1 * mean_sorted.max())
 
     # Add country flag of each site
@@ -761,27 +1191,30 @@ def generate_figure_metric(
             ci=stats["95ci"][vendor],
             cov_intra=stats["cov_intra"][vendor],
             cov_inter=stats["cov_inter"][vendor],
-            f=scaling_factor[metric],
+            f=metric.scale,
             color=list_colors[x_init_vendor],
             show_ci=show_ci,
         )
         x_init_vendor += n_site
 
     # Save figure
-    plt.tight_layout()
-    fname_fig = os.path.join("fig_" + metric + ".png")
-    plt.savefig(fname_fig)
-    logger.info("Created: " + fname_fig)
+    fig.tight_layout()
+    return save_figure(fig, "fig_" + metric.name, formats)
 
 
-def generate_figure_metric_plotly(df, metric, stats):
+def get_figure_metric_plotly(df, site_values, metric, stats, max_subjects=MAX_SUBJECTS):
     """
-    Generate interactive bar plot across sites
+    Create interactive bar plot across sites
     :param df:
-    :param metric:
+    :param site_values: SiteValues
+    :param metric: Metric
     :param stats:
-    :return:
+    :param max_subjects: int: above this number of subjects, the values of each site are shown as a box plot
+    :return: plotly Figure
     """
+    import numpy as np
+    import plotly.graph_objs as go
+
     # Sort values per vendor
     site_sorted = df.sort_values(by=["vendor", "model", "site"]).index.values
     vendor_sorted = df["vendor"][site_sorted].values
@@ -790,25 +1223,42 @@ def generate_figure_metric_plotly(df, metric, stats):
     model_sorted = df["model"][site_sorted].values
 
     # Scale values (for display)
-    mean_sorted = mean_sorted * scaling_factor[metric]
-    std_sorted = std_sorted * scaling_factor[metric]
+    mean_sorted = mean_sorted * metric.scale
+    std_sorted = std_sorted * metric.scale
 
     # Get color based on vendor
     list_colors = [vendor_to_color[i] for i in vendor_sorted]
 
     fig = go.Figure()
 
-    # Display individual subjects
-    for i, site in enumerate(site_sorted):
-        val = df["val"][site]
-        val = [value * scaling_factor.get(metric) for value in val]
-        x = site_sorted[i]
+    # Display individual subjects (in a single trace), or their distribution per site for large cohorts
+    if len(site_values.values) > max_subjects:
+        summary = get_site_summary(site_values, site_sorted, metric.scale)
+        has_values = ~np.isnan(summary["median"])
+        fig.add_trace(
+            go.Box(
+                x=site_sorted[has_values],
+                q1=summary["q1"][has_values],
+                median=summary["median"][has_values],
+                q3=summary["q3"][has_values],
+                lowerfence=summary["p5"][has_values],
+                upperfence=summary["p95"][has_values],
+                width=0.3,
+                marker_color="red",
+                fillcolor="rgba(0,0,0,0)",
+            )
+        )
+    else:
+        values_sorted = [site_values[site] for site in site_sorted]
         fig.add_trace(
             go.Scatter(
-                x=[x, x, x, x, x, x], y=val, mode="markers", marker_color="red", name=x
+                x=np.repeat(site_sorted, [len(val) for val in values_sorted]),
+                y=np.concatenate(values_sorted) * metric.scale,
+                text=np.concatenate([site_values.get_subjects(site) for site in site_sorted]),
+                mode="markers",
+                marker=dict(color="red", size=4),
             )
         )
-    fig.update_traces(marker=dict(size=4))
 
     fig.add_trace(
         go.Bar(
@@ -836,7 +1286,7 @@ def generate_figure_metric_plotly(df, metric, stats):
         # ci = stats["95ci"][vendor]
         # cov_intra = stats["cov_intra"][vendor]
         # cov_inter = stats["cov_inter"][vendor]
-        f = scaling_factor[metric]
+        f = metric.scale
         color = list_colors[x_init_vendor]
 
         fig.add_trace(
@@ -862,22 +1312,56 @@ def generate_figure_metric_plotly(df, metric, stats):
 
     fig.update_layout(
         showlegend=False,
-        yaxis_title=metric_to_label_plotly[metric],
+        yaxis_title=metric.label_plotly,
         xaxis_tickangle=-45,
         bargap=0.4,
     )
+    return fig
+
+
+def generate_figure_metric_plotly(df, site_values, metric, stats, max_subjects=MAX_SUBJECTS):
+    """
+    Generate interactive bar plot across sites, in an html file which uses the shared plotly.js bundle
+    :param df:
+    :param site_values: SiteValues
+    :param metric: Metric
+    :param stats:
+    :param max_subjects: int: above this number of subjects, the values of each site are shown as a box plot
+    :return: fname_fig
+    """
+    fig = get_figure_metric_plotly(df, site_values, metric, stats, max_subjects)
+    fname_fig = metric.name + ".html"
+    fig.write_html(fname_fig, include_plotlyjs="directory")
+    return fname_fig
 
-    fig.write_html(metric + ".html")
+
+def join_per_vendor(df, site_values_1, site_values_2):
+    """
+    Pair the values of two metrics (e.g., CSA from T1w and T2w) for the subjects that have both, per vendor.
+    :param df: Pandas structure of the sites of the first metric (with column: vendor)
+    :param site_values_1: SiteValues: values of the first metric
+    :param site_values_2: SiteValues: values of the second metric
+    :return: OrderedDict: key: vendor (sorted), value: tuple of aligned np.arrays (values_1, values_2)
+    """
+    import spinegeneric.results
+
+    pairs = spinegeneric.results.join_site_values(site_values_1, site_values_2)
+    pairs["vendor"] = pairs["site"].map(df["vendor"])
+    return OrderedDict(
+        (vendor, (pairs_vendor["val_1"].values, pairs_vendor["val_2"].values))
+        for vendor, pairs_vendor in pairs.groupby("vendor", sort=True)
+    )
 
 
-def generate_figure_t1_t2(df, csa_t1, csa_t2):
+def generate_figure_t1_t2(csa_per_vendor, formats=("png",)):
     """
     Generate CSA_T1w vs. CSA_T2w
-    :param df:
-    :param csa_t1:
-    :param csa_t2:
-    :return:
+    :param csa_per_vendor: dict: CSA from T1w and T2w of each subject, per vendor (output of join_per_vendor)
+    :param formats: list of str: output formats (see FIGURE_FORMATS)
+    :return: list of str: output files
     """
+    import numpy as np
+    from sklearn.linear_model import LinearRegression
 
     def compute_regression(x, y):
         """
@@ -907,32 +1391,14 @@ def generate_figure_t1_t2(df, csa_t1, csa_t2):
         """
         return format(float(number), ".2f")
 
-    # Sort values per vendor
-    site_sorted = df.sort_values(by=["vendor", "model", "site"]).index.values
-    vendor_sorted = df["vendor"][site_sorted].values
-
-    # Create dictionary with CSA for T1w and T2w per vendors
-    CSA_dict = defaultdict(list)
-    # loop across sites
-    for index, line in enumerate(csa_t1):
-        vendor = line[1]
-        # Loop across subjects, making sure to only populate the dictionary with subjects existing both for T1 and T2
-        for subject in csa_t1[index][4]:
-            if subject in csa_t2[index, 4]:
-                CSA_dict[vendor + "_t1"].append(
-                    csa_t1[index, 3][csa_t1[index, 4].index(subject)]
-                )
-                CSA_dict[vendor + "_t2"].append(
-                    csa_t2[index, 3][csa_t2[index, 4].index(subject)]
-                )
-
     # Generate figure for T1w and T2w agreement for all vendors together
-    fig, ax = plt.subplots(figsize=(7, 7))
+    fig = new_figure(figsize=(7, 7))
+    ax = fig.add_subplot()
     # Loop across vendors
-    for vendor in list(OrderedDict.fromkeys(vendor_sorted)):
-        plt.scatter(
-            CSA_dict[vendor + "_t2"],
-            CSA_dict[vendor + "_t1"],
+    for vendor, (csa_t1, csa_t2) in csa_per_vendor.items():
+        ax.scatter(
+            csa_t2,
+            csa_t1,
             s=50,
             linewidths=2,
             facecolors="none",
@@ -940,28 +1406,26 @@ def generate_figure_t1_t2(df, csa_t1, csa_t2):
             label=vendor,
         )
     ax.tick_params(labelsize=LABELSIZE)
-    plt.plot([50, 100], [50, 100], ls="--", c=".3")  # add diagonal line
-    plt.title("CSA agreement between T1w and T2w data")
-    plt.xlim(50, 100)
-    plt.ylim(50, 100)
-    plt.gca().set_aspect("equal", adjustable="box")
-    plt.xlabel("T2w CSA", fontsize=FONTSIZE)
-    plt.ylabel("T1w CSA", fontsize=FONTSIZE)
-    plt.grid(True)
-    plt.legend(fontsize=FONTSIZE)
-    plt.tight_layout()
-    fname_fig = "fig_t1_t2_agreement.png"
-    plt.savefig(fname_fig, dpi=200)
-    logger.info("Created: " + fname_fig)
+    ax.plot([50, 100], [50, 100], ls="--", c=".3")  # add diagonal line
+    ax.set_title("CSA agreement between T1w and T2w data")
+    ax.set_xlim(50, 100)
+    ax.set_ylim(50, 100)
+    ax.set_aspect("equal", adjustable="box")
+    ax.set_xlabel("T2w CSA", fontsize=FONTSIZE)
+    ax.set_ylabel("T1w CSA", fontsize=FONTSIZE)
+    ax.grid(True)
+    ax.legend(fontsize=FONTSIZE)
+    fig.tight_layout()
+    fnames_fig = save_figure(fig, "fig_t1_t2_agreement", formats, dpi=200)
 
     # Generate figure for T1w and T2w agreement per vendor
-    plt.subplots(figsize=(15, 5))
+    fig = new_figure(figsize=(15, 5))
     # Loop across vendors (create subplot for each vendor)
-    for index, vendor in enumerate(list(OrderedDict.fromkeys(vendor_sorted))):
-        ax = plt.subplot(1, 3, index + 1)
-        x = CSA_dict[vendor + "_t2"]
-        y = CSA_dict[vendor + "_t1"]
-        plt.scatter(
+    for index, (vendor, (csa_t1, csa_t2)) in enumerate(csa_per_vendor.items()):
+        ax = fig.add_subplot(1, 3, index + 1)
+        x = csa_t2
+        y = csa_t1
+        ax.scatter(
             x,
             y,
             s=50,
@@ -981,29 +1445,29 @@ def generate_figure_t1_t2(df, csa_t1, csa_t2):
         offset = 2
         lim_min = min(min(x), min(y))
         lim_max = max(max(x), max(y))
-        plt.xlim(lim_min - offset, lim_max + offset)
-        plt.ylim(lim_min - offset, lim_max + offset)
+        ax.set_xlim(lim_min - offset, lim_max + offset)
+        ax.set_ylim(lim_min - offset, lim_max + offset)
         # Add bisection (diagonal) line
-        plt.plot(
+        ax.plot(
             [lim_min - offset, lim_max + offset],
             [lim_min - offset, lim_max + offset],
             ls="--",
             c=".3",
         )
-        plt.xlabel("T2w CSA", fontsize=FONTSIZE)
-        plt.ylabel("T1w CSA", fontsize=FONTSIZE)
+        ax.set_xlabel("T2w CSA", fontsize=FONTSIZE)
+        ax.set_ylabel("T1w CSA", fontsize=FONTSIZE)
         # Move grid to background (i.e. behind other elements)
         ax.set_axisbelow(True)
-        plt.grid(True)
+        ax.grid(True)
         # Enforce square grid
-        plt.gca().set_aspect("equal", adjustable="box")
+        ax.set_aspect("equal", adjustable="box")
         # Compute linear fit
         intercept, slope, _, r2_sc = compute_regression(
-            np.array(CSA_dict[vendor + "_t2"]).reshape(-1, 1),
-            np.array(CSA_dict[vendor + "_t1"]).reshape(-1, 1),
+            csa_t2.reshape(-1, 1),
+            csa_t1.reshape(-1, 1),
         )
         # Place regression equation to upper-left corner
-        plt.text(
+        ax.text(
             0.1,
             0.9,
             "y = {}x + {}\nR\u00b2 = {}".format(
@@ -1017,61 +1481,42 @@ def generate_figure_t1_t2(df, csa_t1, csa_t2):
             bbox=dict(boxstyle="round", facecolor="white", alpha=1),
         )  # box around equation
         # Plot linear fit
-        axes = plt.gca()
-        x_vals = np.array(axes.get_xlim())
+        x_vals = np.array(ax.get_xlim())
         y_vals = intercept + slope * x_vals
         y_vals = np.squeeze(y_vals)  # change shape from (1,N) to (N,)
-        plt.plot(x_vals, y_vals, color="red")
+        ax.plot(x_vals, y_vals, color="red")
         # Add title above middle subplot
         if index == 1:
-            plt.title(
+            ax.set_title(
                 "CSA agreement between T1w and T2w data per vendors",
                 fontsize=FONTSIZE,
                 pad=20,
             )
     # Move subplots closer to each other
-    plt.subplots_adjust(wspace=-0.5)
-    plt.tight_layout()
-    fname_fig = "fig_t1_t2_agreement_per_vendor.png"
-    plt.savefig(fname_fig, dpi=200)
-    logger.info("Created: " + fname_fig)
+    fig.subplots_adjust(wspace=-0.5)
+    fig.tight_layout()
+    fnames_fig += save_figure(fig, "fig_t1_t2_agreement_per_vendor", formats, dpi=200)
+    return fnames_fig
 
 
-def generate_figure_t1_t2_plotly(df, csa_t1, csa_t2):
+def get_figures_t1_t2_plotly(csa_per_vendor):
     """
-    Generate inteactive CSA_T1w vs. CSA_T2w figure
-    :param df:
-    :param csa_t1:
-    :param csa_t2:
-    :return:
+    Create inteactive CSA_T1w vs. CSA_T2w figures
+    :param csa_per_vendor: dict: CSA from T1w and T2w of each subject, per vendor (output of join_per_vendor)
+    :return: OrderedDict: key: figure name, value: plotly Figure
     """
-
-    # Sort values per vendor
-    site_sorted = df.sort_values(by=["vendor", "model", "site"]).index.values
-    vendor_sorted = df["vendor"][site_sorted].values
-
-    # Create dictionary with CSA for T1w and T2w per vendors
-    CSA_dict = defaultdict(list)
-    # loop across sites
-    for index, line in enumerate(csa_t1):
-        vendor = line[1]
-        # Loop across subjects, making sure to only populate the dictionary with subjects existing both for T1 and T2
-        for subject in csa_t1[index][4]:
-            if subject in csa_t2[index, 4]:
-                CSA_dict[vendor + "_t1"].append(
-                    csa_t1[index, 3][csa_t1[index, 4].index(subject)]
-                )
-                CSA_dict[vendor + "_t2"].append(
-                    csa_t2[index, 3][csa_t2[index, 4].index(subject)]
-                )
+    import numpy as np
+    from plotly.subplots import make_subplots
+    import plotly.graph_objs as go
+    from sklearn.linear_model import LinearRegression
 
     fig_v = go.Figure()
     # Loop across vendors
-    for vendor in list(OrderedDict.fromkeys(vendor_sorted)):
+    for vendor, (csa_t1, csa_t2) in csa_per_vendor.items():
         fig_v.add_trace(
             go.Scatter(
-                x=CSA_dict[vendor + "_t2"],
-                y=CSA_dict[vendor + "_t1"],
+                x=csa_t2,
+                y=csa_t1,
                 mode="markers",
                 marker=dict(symbol="circle-open", size=10),
                 marker_color=vendor_to_color[vendor],
@@ -1091,16 +1536,14 @@ def generate_figure_t1_t2_plotly(df, csa_t1, csa_t2):
     fig_v.update_xaxes(range=[50, 100])
     fig_v.update_layout(width=700, height=700)
 
-    fig_v.write_html("fig_t1_t2_agreement.html")
-
     # Figure T1w vs t2w per vendor
     fig_2 = go.Figure()
     fig_2 = make_subplots(rows=1, cols=3)
     i = 1
     # Loop across vendors (create subplot for each vendor)
-    for index, vendor in enumerate(list(OrderedDict.fromkeys(vendor_sorted))):
-        x = CSA_dict[vendor + "_t2"]
-        y = CSA_dict[vendor + "_t1"]
+    for index, (vendor, (csa_t1, csa_t2)) in enumerate(csa_per_vendor.items()):
+        x = csa_t2
+        y = csa_t1
         fig_2.add_trace(
             go.Scatter(
                 x=x,
@@ -1171,7 +1614,17 @@ def generate_figure_t1_t2_plotly(df, csa_t1, csa_t2):
         )
         i = i + 1
 
-    fig_2.write_html("fig_t1_t2_agreement_per_vendor.html")
+    return OrderedDict([("fig_t1_t2_agreement", fig_v), ("fig_t1_t2_agreement_per_vendor", fig_2)])
+
+
+def generate_figure_t1_t2_plotly(csa_per_vendor):
+    """
+    Generate inteactive CSA_T1w vs. CSA_T2w figures, in html files which use the shared plotly.js bundle
+    :param csa_per_vendor: dict: CSA from T1w and T2w of each subject, per vendor (output of join_per_vendor)
+    :return:
+    """
+    for name, fig in get_figures_t1_t2_plotly(csa_per_vendor).items():
+        fig.write_html(name + ".html", include_plotlyjs="directory")
 
 
 def get_env(file_param):
@@ -1209,28 +1662,470 @@ def get_env(file_param):
     return env
 
 
-def remove_subject(subject, metric, dict_exclude_subj):
+def process_metric(metric, dict_exclude_subj, args, results=None):
+    """
+    Run the pipeline of one metric: read csv file, aggregate per site, compute statistics and generate figures.
+    :param metric: Metric
+    :param dict_exclude_subj: dict of subjects/sites to exclude, per metric
+    :param args: parsed arguments of sg_generate_figure
+    :param results: pandas DataFrame output by load_results_csv(). By default, the csv file of the metric is read.
+    :return: df: Pandas structure with results aggregated per site
+    :return: site_values: SiteValues: values of each site
+    :return: stats: dict with statistical results
+    :return: fnames_fig: list of generated figures
+    """
+    import numpy as np
+    import spinegeneric.results
+
+    logger.info(
+        "\n{}\n====================================================".format(
+            metric.file
+        )
+    )
+
+    # Open CSV file (only the columns needed for this metric)
+    if results is None:
+        results = spinegeneric.results.load_results_csv(metric.file, metric.field)
+
+    # Keep a single measure per file, if some subjects were processed several times
+    results, duplicates = spinegeneric.results.drop_duplicate_results(results, args.duplicates, args.sct_version)
+    if len(duplicates):
+        logger.warning(
+            "Duplicated measures removed ({} rows, policy: {}), for subjects: {}".format(
+                len(duplicates),
+                args.duplicates,
+                duplicates["Filename"].str.split(os.sep).str[-3].unique().tolist(),
+            )
+        )
+
+    # Fetch mean, std, etc. per site
+    df, site_values, subjects_removed = aggregate_per_site(results, metric, dict_exclude_subj)
+
+    # Add column to DF with excluded sites
+    df["exclude"] = df.index.isin(get_exclusions(metric.name, dict_exclude_subj)[1])
+
+    # Excluded sites
+    logger.info(
+        "Sites removed: {}".format(list(df[df["exclude"] == True]["site"].values))  # noqa: E712
+    )
+
+    # Compute statistics (each metric has its own random stream, so that results do not depend on the order in
+    # which metrics are processed)
+    rng = np.random.default_rng([args.seed, zlib.crc32(metric.name.encode())])
+    df, stats = compute_statistics(df, site_values, n_boot=args.n_boot, n_perm=args.n_perm, rng=rng)
+    stats["subjects_removed"] = subjects_removed
+
+    # Write statistical results into text file
+    if args.output_text:
+        output_text(stats)
+
+    # Generate figure
+    fnames_fig = generate_figure_metric(
+        df,
+        site_values,
+        metric,
+        stats,
+        args.no_sub,
+        show_ci=args.show_ci,
+        formats=args.formats,
+        max_subjects=args.max_subjects,
+    )
+
+    if args.output_html:
+        # Generate interactive html figure
+        fnames_fig.append(generate_figure_metric_plotly(df, site_values, metric, stats, args.max_subjects))
+
+    return df, site_values, stats, fnames_fig
+
+
+def run_metric(log_level, metric, dict_exclude_subj, args):
+    """
+    Run process_metric(), possibly in a worker process, or fetch its results from the cache if its inputs did not
+    change. The log records are buffered instead of being emitted, so that the caller can write them in a
+    deterministic order (and so that they can be cached).
+    :param log_level: logging level of the caller
+    :param metric: Metric
+    :param dict_exclude_subj: dict of subjects/sites to exclude, per metric
+    :param args: parsed arguments of sg_generate_figure
+    :return: df: Pandas structure with results aggregated per site, or None if an exception was raised
+    :return: site_values: SiteValues: values of each site, or None if an exception was raised
+    :return: stats: dict with statistical results, or None if an exception was raised
+    :return: records: list of logging.LogRecord
+    :return: exc: exception raised by process_metric(), or None
+    """
+    logger.setLevel(log_level)
+
+    # The cache key covers all the inputs of the metric: csv file, participants, excluded subjects/sites, the
+    # options that change the figures, and the source of the package (modules, config files and flags), so that
+    # results are recomputed after any change of the code
+    cache = None
+    if not args.no_cache:
+        cache = spinegeneric.cache.ResultCache(CACHE_DIR)
+        key = spinegeneric.cache.hash_inputs(
+            [metric.file, "participants.tsv"]
+            + spinegeneric.cache.list_files(os.path.dirname(os.path.abspath(sg.__file__)), exclude=["tests"]),
+            (
+                sg.__version__,
+                tuple(metric),
+                sorted(str(entry) for entry in dict_exclude_subj.get(metric.name) or []),
+                args.no_sub,
+                args.show_ci,
+                args.output_text,
+                args.output_html,
+                args.formats,
+                args.max_subjects,
+                args.duplicates,
+                args.sct_version,
+                args.n_boot,
+                args.n_perm,
+                args.seed,
+                log_level,
+            ),
+        )
+        payload = cache.get(metric.name, key)
+        if payload is not None:
+            df, site_values, stats, records = payload
+            logger.debug("{}: inputs did not change, results fetched from {}".format(metric.name, CACHE_DIR))
+            return df, site_values, stats, records, None
+
+    handlers = logging.root.handlers[:]
+    for handler in handlers:
+        logging.root.removeHandler(handler)
+    buffer = logging.handlers.BufferingHandler(capacity=sys.maxsize)
+    logging.root.addHandler(buffer)
+    df, site_values, stats, fnames_fig, exc = None, None, None, [], None
+    try:
+        df, site_values, stats, fnames_fig = process_metric(metric, dict_exclude_subj, args)
+    except BaseException as e:
+        exc = e
+    finally:
+        logging.root.removeHandler(buffer)
+        for handler in handlers:
+            logging.root.addHandler(handler)
+    # Make records picklable
+    records = []
+    for record in buffer.buffer:
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        records.append(record)
+
+    if cache is not None and exc is None:
+        cache.put(metric.name, key, (df, site_values, stats, records), fnames_fig)
+    return df, site_values, stats, records, exc
+
+
+def get_cov_per_vendor(df, site_values):
+    """
+    Inter-site COV (based on the within-site means) and intra-site COV (averaged across sites) of each vendor, as in
+    compute_statistics(), for other values of the same sites (e.g. harmonized values).
+    :param df: Pandas structure output by compute_statistics()
+    :param site_values: SiteValues: values of each site
+    :return: pandas DataFrame indexed by vendor, with columns: cov_inter, cov_intra
+    """
+    import pandas as pd
+
+    vendors = ["GE", "Philips", "Siemens"]
+    per_site = pd.DataFrame(
+        {"mean": site_values.mean(), "std": site_values.std()}, index=site_values.sites
+    ).reindex(df.index)
+    per_site["vendor"] = df["vendor"]
+    per_site["cov"] = per_site["std"] / per_site["mean"]
+    per_vendor = per_site[~df["exclude"]].groupby("vendor")
+    return pd.DataFrame(
+        {
+            "cov_inter": per_vendor["mean"].std(ddof=0) / per_vendor["mean"].mean(),
+            "cov_intra": per_vendor["cov"].mean(),
+        }
+    ).reindex(vendors)
+
+
+def harmonize(results_per_metric, metrics, args):
+    """
+    Harmonize the values of all metrics across sites at once (see spinegeneric.harmonization.ComBat), with
+    parameters fitted on these values (-harmonize) or read from a file (-harmonization-params). The harmonized values
+    of each metric are written in the folder DIR_HARMONIZED (one csv file per metric, with the name of the file of the
+    metric), along with the fitted parameters. The COVs of the harmonized values are added to the statistics of each
+    metric (key 'harmonized').
+    :param results_per_metric: OrderedDict: key: metric name, value: (df, site_values, stats) output by
+      process_metric()
+    :param metrics: OrderedDict: key: metric name, value: Metric
+    :param args: parsed arguments of sg_generate_figure
+    """
+    import pandas as pd
+    import spinegeneric.harmonization
+    import spinegeneric.results
+
+    # Values of all metrics, in a single long table
+    values = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "metric": name,
+                    "subject": site_values.subjects,
+                    "site": site_values.sites[site_values.site_ids],
+                    "vendor": df["vendor"].reindex(site_values.sites).values[site_values.site_ids],
+                    "value": site_values.values,
+                }
+            )
+            for name, (df, site_values, _) in results_per_metric.items()
+        ],
+        ignore_index=True,
+    )
+    if args.harmonization_params:
+        combat = spinegeneric.harmonization.ComBat.from_json(args.harmonization_params)
+        covariates = combat.covariates
+    else:
+        combat, covariates = None, args.harmonize
+    participants = load_participants_file().drop_duplicates("participant_id").set_index("participant_id")
+    values_covariates = participants.reindex(values["subject"])[covariates].reset_index(drop=True) if covariates else None
+    os.makedirs(DIR_HARMONIZED, exist_ok=True)
+    if combat is None:
+        combat = spinegeneric.harmonization.ComBat.fit(values["metric"], values["site"], values["value"], values_covariates)
+        fname = os.path.join(DIR_HARMONIZED, FNAME_HARMONIZATION_PARAMS)
+        combat.to_json(fname)
+        logger.info("Created: " + fname)
+    values["value_harmonized"] = combat.apply(values["metric"], values["site"], values["value"], values_covariates)
+
+    logger.info(
+        "\nHarmonization across sites (covariates: {})\n====================================================".format(
+            ", ".join(covariates) or "none"
+        )
+    )
+    for name, table in values.groupby("metric", sort=False):
+        df, site_values, stats = results_per_metric[name]
+        is_harmonized = table["value_harmonized"].notna()
+        if not is_harmonized.all():
+            logger.warning(
+                "{}: values not harmonized (site not fitted, or not enough subjects per site): {}".format(
+                    name, table["subject"][~is_harmonized].tolist()
+                )
+            )
+        fname = os.path.join(DIR_HARMONIZED, metrics[name].file)
+        table[["subject", "site", "vendor", "value", "value_harmonized"]].to_csv(fname, index=False)
+        table = table[is_harmonized]
+        harmonized = spinegeneric.results.SiteValues.from_long(
+            table["site"], table["value_harmonized"], table["subject"], sites=df.index
+        )
+        cov = get_cov_per_vendor(df, harmonized)
+        stats["harmonized"] = {vendor: cov.loc[vendor].to_dict() for vendor in cov.index}
+        for vendor in cov.index:
+            logger.info(
+                "{}: COV for {} after harmonization: inter: {:.2f}% (before: {:.2f}%), intra: {:.2f}% (before: "
+                "{:.2f}%)".format(
+                    name, vendor, cov.loc[vendor, "cov_inter"] * 100, stats["cov_inter"][vendor] * 100,
+                    cov.loc[vendor, "cov_intra"] * 100, stats["cov_intra"][vendor] * 100,
+                )
+            )
+        logger.info("Created: " + fname)
+
+
+def write_outputs(results_per_metric, metrics, age_stats, args):
     """
-    Check if subject should be removed
-    :param subject:
-    :param metric:
-    :param dict_exclude_subj:
-    :return: Bool
+    Generate the outputs that combine several metrics: T1w vs. T2w figures, table of statistics and dashboard.
+    :param results_per_metric: OrderedDict: key: metric name, value: (df, site_values, stats) output by
+      process_metric()
+    :param metrics: OrderedDict: key: metric name, value: Metric
+    :param age_stats: pandas Series output by compute_age_statistics()
+    :param args: parsed arguments of sg_generate_figure
     """
-    if metric in dict_exclude_subj.keys():
-        if subject in dict_exclude_subj[metric]:
-            return True
-    return False
+    if (args.harmonize is not None or args.harmonization_params) and results_per_metric:
+        # Harmonize all metrics at once (before the table of statistics, which includes the harmonized COVs)
+        harmonize(results_per_metric, metrics, args)
+
+    csa_per_vendor = None
+    if "csa_t1" in results_per_metric and "csa_t2" in results_per_metric:
+        # Pair T1w and T2w CSA of each subject
+        df_t1, csa_t1, _ = results_per_metric["csa_t1"]
+        csa_t2 = results_per_metric["csa_t2"][1]
+        csa_per_vendor = join_per_vendor(df_t1, csa_t1, csa_t2)
+
+        # Generate T1w vs. T2w figure
+        generate_figure_t1_t2(csa_per_vendor, formats=args.formats)
+
+        if args.output_html:
+            # Generate interactive html T1w vs. T2w figure
+            generate_figure_t1_t2_plotly(csa_per_vendor)
+
+    if args.output_stats:
+        # Write statistical results of all metrics into a table
+        stats_table = get_stats_table(results_per_metric, age_stats)
+        for fname in args.output_stats:
+            write_stats_table(stats_table, fname)
+            logger.info("Created: " + fname)
+
+    if args.output_influence:
+        # Write the influence of each subject and site on the statistics of its vendor
+        write_stats_table(get_influence_table(results_per_metric), args.output_influence)
+        logger.info("Created: " + args.output_influence)
+
+    if args.output_dashboard:
+        # Gather all interactive figures in a single html page
+        figures = OrderedDict(
+            (name, get_figure_metric_plotly(df, site_values, metrics[name], stats, args.max_subjects))
+            for name, (df, site_values, stats) in results_per_metric.items()
+        )
+        if csa_per_vendor is not None:
+            figures.update(get_figures_t1_t2_plotly(csa_per_vendor))
+        spinegeneric.dashboard.write_dashboard(figures, FNAME_DASHBOARD, title="spine-generic: " + os.getcwd())
+        logger.info("Created: " + FNAME_DASHBOARD)
+
+
+def watch(dict_exclude_subj, age_stats, args):
+    """
+    Follow the csv files while they are being appended to, until interrupted (Ctrl+C). Each check only parses the
+    lines appended since the previous check (see CsvTail). The per-site statistics are updated incrementally
+    (see RunningSiteStats) and logged for the sites that received new results, and the figures and statistics of
+    all metrics are refreshed from the rows read so far (without reading the csv files again), at most every
+    args.watch_interval seconds.
+    :param dict_exclude_subj: dict of subjects/sites to exclude, per metric
+    :param age_stats: pandas Series output by compute_age_statistics()
+    :param args: parsed arguments of sg_generate_figure
+    """
+    import pandas as pd
+    import spinegeneric.results
+
+    participants = load_participants_file().drop_duplicates("participant_id").set_index("participant_id")
+    # Per metric: reader of the csv file, rows read so far, running statistics per site, and sites updated since
+    # the last refresh
+    tails, rows, running, sites_updated = {}, {}, {}, {}
+    time_refresh = None
+    logger.info(
+        "Watching csv files (refresh every {} s at most). Press Ctrl+C to stop.".format(args.watch_interval)
+    )
+    try:
+        while True:
+            # csv files of new metrics might appear
+            metrics = spinegeneric.metrics.discover_metrics()
+            for metric in metrics.values():
+                if metric.name not in tails:
+                    tails[metric.name] = spinegeneric.results.CsvTail(metric.file, metric.field)
+                try:
+                    results, is_reset = tails[metric.name].read()
+                except ValueError as e:
+                    # e.g. the csv file does not have the field of the metric
+                    logger.warning("{}: cannot be read: {}".format(metric.file, e))
+                    continue
+                if is_reset or metric.name not in rows:
+                    if is_reset:
+                        logger.warning("{} was truncated or replaced: reading it again.".format(metric.file))
+                    rows[metric.name], running[metric.name] = [], spinegeneric.results.RunningSiteStats()
+                    sites_updated[metric.name] = set()
+                if results is None:
+                    continue
+                rows[metric.name].append(results)
+                # Update the running statistics of the sites, without the excluded subjects and sites (as the
+                # statistics of process_metric())
+                subject = results["Filename"].str.split(os.sep).str[-3]
+                site = participants["institution_id"].reindex(subject.values).values
+                subjects_excluded, sites_excluded = get_exclusions(metric.name, dict_exclude_subj)
+                is_kept = (
+                    pd.notna(site) & ~subject.isin(subjects_excluded).values & ~pd.Series(site).isin(sites_excluded).values
+                )
+                # Measures are identified as in drop_duplicate_results(), so that a subject processed again (even in
+                # another folder) replaces its previous measure
+                key = spinegeneric.results.get_measure_key(results)
+                sites_updated[metric.name].update(
+                    running[metric.name].update(
+                        site[is_kept], key.values[is_kept], results[metric.field].values[is_kept]
+                    )
+                )
+
+            if any(sites_updated.values()) and (
+                time_refresh is None or time.monotonic() - time_refresh >= args.watch_interval
+            ):
+                time_refresh = time.monotonic()
+                refresh_watch(metrics, rows, running, sites_updated, dict_exclude_subj, age_stats, args)
+            time.sleep(min(WATCH_POLL_INTERVAL, args.watch_interval))
+    except KeyboardInterrupt:
+        logger.info("\nStopped watching csv files.")
+
+
+def refresh_watch(metrics, rows, running, sites_updated, dict_exclude_subj, age_stats, args):
+    """
+    Log the running statistics of the sites updated since the previous refresh, and generate the figures and
+    statistics of all metrics from the rows read so far. Errors are logged (e.g. statistics that cannot be computed
+    yet because only a few sites have results), so that watching can go on.
+    :param metrics: OrderedDict: key: metric name, value: Metric
+    :param rows: dict: key: metric name, value: list of pandas DataFrame read by CsvTail. Modified in place (the
+      DataFrames of a metric are concatenated).
+    :param running: dict: key: metric name, value: RunningSiteStats
+    :param sites_updated: dict: key: metric name, value: set of sites updated since the previous refresh. Cleared.
+    :param dict_exclude_subj: dict of subjects/sites to exclude, per metric
+    :param age_stats: pandas Series output by compute_age_statistics()
+    :param args: parsed arguments of sg_generate_figure
+    """
+    import pandas as pd
+
+    logger.info("\n{}\nRefresh: {}".format("=" * 52, time.strftime("%Y-%m-%d %H:%M:%S")))
+    for name, sites in sites_updated.items():
+        if not sites:
+            continue
+        stats_per_site = running[name].to_frame().loc[sorted(sites)]
+        logger.info("{}: running statistics of the updated sites:\n{}".format(name, stats_per_site.to_string()))
+        sites.clear()
+
+    results_per_metric = OrderedDict()
+    for name, metric in metrics.items():
+        if not rows.get(name):
+            continue
+        if len(rows[name]) > 1:
+            results = pd.concat(rows[name], ignore_index=True)
+            # Categories of the chunks differ, so they are lost by the concatenation
+            for column in results.columns.intersection(["SCT Version", "VertLevel", "Label"]):
+                results[column] = results[column].astype("category")
+            rows[name] = [results]
+        try:
+            df, site_values, stats, _ = process_metric(metric, dict_exclude_subj, args, results=rows[name][0])
+        except Exception as e:
+            logger.warning("{}: figures and statistics not refreshed: {!r}".format(name, e))
+            continue
+        results_per_metric[name] = df, site_values, stats
+    try:
+        write_outputs(results_per_metric, metrics, age_stats, args)
+    except Exception as e:
+        logger.warning("Figures and statistics across metrics not refreshed: {!r}".format(e))
 
 
 def main(argv=sys.argv[1:]):
     parser = get_parser()
     args = parser.parse_args(argv)
+    import spinegeneric.dashboard
+
+    for fname in args.output_stats or []:
+        if os.path.splitext(fname)[1].lower() not in STATS_FORMATS:
+            parser.error(
+                "Unsupported format for -output-stats: {}. Supported formats: {}".format(
+                    fname, ", ".join(STATS_FORMATS)
+                )
+            )
+    args.formats = args.formats.split(",")
+    for fmt in args.formats:
+        if fmt not in FIGURE_FORMATS:
+            parser.error("Unsupported figure format: {}. Supported formats: {}".format(fmt, ",".join(FIGURE_FORMATS)))
+    if args.duplicates == "sct-version" and args.sct_version is None:
+        parser.error("-duplicates sct-version requires -sct-version.")
+    if args.output_influence and os.path.splitext(args.output_influence)[1].lower() not in STATS_FORMATS:
+        parser.error(
+            "Unsupported format for -output-influence: {}. Supported formats: {}".format(
+                args.output_influence, ", ".join(STATS_FORMATS)
+            )
+        )
+    if args.harmonize is not None and args.harmonization_params:
+        parser.error("-harmonize and -harmonization-params are mutually exclusive.")
+    if args.harmonization_params and not os.path.isfile(args.harmonization_params):
+        parser.error("File not found: {}".format(args.harmonization_params))
+    # Output files are relative to the current folder, which might change with -path-results
+    args.output_stats = [os.path.abspath(fname) for fname in args.output_stats or []]
+    if args.output_influence:
+        args.output_influence = os.path.abspath(args.output_influence)
+    if args.harmonization_params:
+        args.harmonization_params = os.path.abspath(args.harmonization_params)
+
     if args.v:
         logger.setLevel(logging.DEBUG)
 
-    display_individual_subjects = args.no_sub
-
     # create dict with subjects to exclude if input yml config file is passed
     if args.exclude is not None:
         # check if input yml file exists
@@ -1246,7 +2141,7 @@ def main(argv=sys.argv[1:]):
         # fetch input yml file as dict
         with open(fname_yml, "r") as stream:
             try:
-                dict_exclude_subj = yaml.safe_load(stream)
+                dict_exclude_subj = yaml.safe_load(stream) or {}
             except yaml.YAMLError as exc:
                 logger.error(exc)
     else:
@@ -1268,81 +2163,66 @@ def main(argv=sys.argv[1:]):
     fh = logging.FileHandler(os.path.join(os.path.abspath(os.curdir), FNAME_LOG))
     logging.root.addHandler(fh)
 
-    # Compute age statistics and write them at the beginning of output txt file
-    compute_age_statistics()
-
-    # loop across individual *.csv files and generate figures and compute statistics
-    for csv_file in file_to_metric.keys():
-
-        # skip metric, if *.csv file does not exist
-        if not os.path.isfile(csv_file):
-            logger.info(
-                "\n{} file is missing. Skipping to the next metric.".format(csv_file)
-            )
-            continue
-
-        # Open CSV file and create dict
-        logger.info(
-            "\n{}\n====================================================".format(
-                csv_file
-            )
-        )
-        dict_results = []
-        with open(csv_file, newline="") as f_csv:
-            reader = csv.DictReader(f_csv)
-            for row in reader:
-                dict_results.append(row)
-
-        # Fetch metric name
-        _, csv_file_small = os.path.split(csv_file)
-        metric = file_to_metric[csv_file_small]
-
-        # Fetch mean, std, etc. per site
-        results_dict = aggregate_per_site(dict_results, metric, dict_exclude_subj)
-
-        # Make it a pandas structure (easier for manipulations)
-        df = pd.DataFrame.from_dict(results_dict, orient="index")
-
-        # Add column to DF with excluded sites
-        df["exclude"] = False
-        if metric in dict_exclude_subj.keys():
-            for subject in dict_exclude_subj[metric]:
-                if not subject.startswith("sub-"):
-                    df["exclude"][subject] = True
-
-        # Excluded sites
-        logger.info(
-            "Sites removed: {}".format(list(df[df["exclude"] == True]["site"].values))  # noqa: E712
-        )
+    if args.harmonize:
+        missing = [covariate for covariate in args.harmonize if covariate not in load_participants_file().columns]
+        if missing:
+            parser.error("Covariates of -harmonize not found in participants.tsv: {}".format(", ".join(missing)))
 
-        # Compute statistics
-        df, stats = compute_statistics(df)
-
-        # Write statistical results into text file
-        if args.output_text:
-            output_text(stats)
+    # Compute age statistics and write them at the beginning of output txt file
+    age_stats = compute_age_statistics()
 
-        # Generate figure
-        generate_figure_metric(
-            df, metric, stats, display_individual_subjects, show_ci=args.show_ci
-        )
+    if args.output_html:
+        # Write the plotly.js bundle shared by all html files (before metrics are processed in parallel)
+        spinegeneric.dashboard.write_plotlyjs()
 
-        if args.output_html:
-            # Generate interactive html figure
-            generate_figure_metric_plotly(df, metric, stats)
+    if args.watch:
+        watch(dict_exclude_subj, age_stats, args)
+        return
 
-        # Get T1w and T2w CSA (will be used later for another figure)
-        if metric == "csa_t1":
-            csa_t1 = df.sort_values("site").values
-        elif metric == "csa_t2":
-            csa_t2 = df.sort_values("site").values
+    # List metrics: metrics of the registry, and other csv files of the results folder
+    metrics = spinegeneric.metrics.discover_metrics()
 
-    # Generate T1w vs. T2w figure
-    generate_figure_t1_t2(df, csa_t1, csa_t2)
+    # loop across individual *.csv files and generate figures and compute statistics
+    # Metrics are independent from each other, so they can be processed in parallel. The log of each metric is
+    # buffered and written here, in the order of the metrics.
+    jobs = os.cpu_count() if args.jobs == -1 else args.jobs
+    futures = {}
+    # Results of each metric, for the dashboard
+    results_per_metric = OrderedDict()
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if jobs > 1:
+            executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=jobs))
+            for metric in metrics.values():
+                if os.path.isfile(metric.file):
+                    futures[metric.name] = executor.submit(run_metric, logger.level, metric, dict_exclude_subj, args)
 
-    if args.output_html:
-        # Generate interactive html T1w vs. T2w figure
-        generate_figure_t1_t2_plotly(df, csa_t1, csa_t2)
+        try:
+            for metric in metrics.values():
+
+                # skip metric, if *.csv file does not exist
+                if not os.path.isfile(metric.file):
+                    logger.info(
+                        "\n{} file is missing. Skipping to the next metric.".format(metric.file)
+                    )
+                    continue
+
+                if metric.name in futures:
+                    df, site_values, stats, records, exc = futures[metric.name].result()
+                else:
+                    df, site_values, stats, records, exc = run_metric(logger.level, metric, dict_exclude_subj, args)
+                for record in records:
+                    logger.handle(record)
+                if exc is not None:
+                    raise exc
+                results_per_metric[metric.name] = df, site_values, stats
+        except BaseException:
+            # Do not wait for the metrics that are not started yet
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            raise
+
+    write_outputs(results_per_metric, metrics, age_stats, args)
 
 
 if __name__ == "__main__":
@@ -12,8 +12,6 @@ import logging
 import argparse
 import importlib.resources
 
-from bids import BIDSLayout, BIDSLayoutIndexer
-
 import spinegeneric as sg
 import spinegeneric.cli
 import spinegeneric.utils
@@ -42,6 +40,8 @@ def main():
     parser = get_parser()
     args = parser.parse_args()
     data_path = args.path_in
+    # Imported here, so that the startup of the script (e.g. 'sg_params_checker -h') stays fast
+    from bids import BIDSLayout, BIDSLayoutIndexer
 
     # Initialize logging
     path_warning_log = os.path.join(data_path, "WARNING.log")
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Html output of Plotly figures: single-page dashboard, and plotly.js bundle shared across html files
+
+
+import os
+import html
+import json
+import base64
+
+import numpy as np
+
+FNAME_PLOTLYJS = "plotly.min.js"
+
+# Numeric arrays are stored as base64-encoded little-endian binary data, and decoded in the browser as JS typed arrays
+DTYPE_TO_TYPED_ARRAY = {
+    "f8": "Float64Array",
+    "f4": "Float32Array",
+    "i4": "Int32Array",
+    "u4": "Uint32Array",
+    "i2": "Int16Array",
+    "u2": "Uint16Array",
+    "i1": "Int8Array",
+    "u1": "Uint8Array",
+}
+
+TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{font-family: sans-serif; margin: 0;}}
+.tabs {{display: flex; flex-wrap: wrap; border-bottom: 1px solid #ccc; padding: 0 8px;}}
+.tabs button {{border: none; background: none; padding: 10px 14px; cursor: pointer; font-size: 14px;}}
+.tabs button.active {{border-bottom: 3px solid dodgerblue; font-weight: bold;}}
+.figure {{display: none; width: 100%; height: calc(100vh - 50px);}}
+.figure.active {{display: block;}}
+</style>
+{plotlyjs}
+</head>
+<body>
+<div class="tabs">
+{buttons}
+</div>
+{divs}
+{data}
+<script type="text/javascript">
+(function () {{
+    function decode(obj) {{
+        if (Array.isArray(obj)) {{
+            return obj.map(decode);
+        }}
+        if (obj !== null && typeof obj === "object") {{
+            if (typeof obj.bdata === "string" && typeof obj.dtype === "string") {{
+                var bin = atob(obj.bdata);
+                var bytes = new Uint8Array(bin.length);
+                for (var i = 0; i < bin.length; i++) {{
+                    bytes[i] = bin.charCodeAt(i);
+                }}
+                return new window[obj.dtype](bytes.buffer);
+            }}
+            for (var key in obj) {{
+                obj[key] = decode(obj[key]);
+            }}
+        }}
+        return obj;
+    }}
+    var rendered = {{}};
+    function show(id) {{
+        document.querySelectorAll(".tabs button").forEach(function (button) {{
+            button.classList.toggle("active", button.dataset.target === id);
+        }});
+        document.querySelectorAll(".figure").forEach(function (div) {{
+            div.classList.toggle("active", div.id === id);
+        }});
+        var div = document.getElementById(id);
+        if (!rendered[id]) {{
+            // Figures are parsed and rendered the first time their tab is opened
+            var fig = decode(JSON.parse(document.getElementById(id + "-data").textContent));
+            Plotly.newPlot(div, fig.data, fig.layout, {{responsive: true}});
+            rendered[id] = true;
+        }} else {{
+            Plotly.Plots.resize(div);
+        }}
+    }}
+    document.querySelectorAll(".tabs button").forEach(function (button) {{
+        button.addEventListener("click", function () {{ show(button.dataset.target); }});
+    }});
+    show("fig-0");
+}})();
+</script>
+</body>
+</html>
+"""
+
+
+def write_plotlyjs(path_out=os.curdir):
+    """
+    Write the plotly.js bundle in a folder, so that it can be shared by all the html files of that folder (written
+    with include_plotlyjs='directory'). If the bundle is already there, it is left unmodified.
+    :param path_out: str: output folder
+    :return: str: file name of the bundle
+    """
+    from plotly.offline import get_plotlyjs
+
+    fname = os.path.join(path_out, FNAME_PLOTLYJS)
+    if not os.path.isfile(fname):
+        # Write to a temporary file, so that a partially written bundle is never used
+        fname_tmp = "{}.{}.tmp".format(fname, os.getpid())
+        with open(fname_tmp, "w", encoding="utf-8") as f:
+            f.write(get_plotlyjs())
+        os.replace(fname_tmp, fname)
+    return fname
+
+
+def encode_arrays(obj):
+    """
+    Recursively replace the numeric numpy arrays of a figure (as output by plotly Figure.to_plotly_json()) by
+    compact binary representations: {'dtype': <JS typed array>, 'bdata': <base64 string>}.
+    :param obj: figure, or part of a figure
+    :return: figure with encoded arrays
+    """
+    if isinstance(obj, dict):
+        return {key: encode_arrays(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [encode_arrays(value) for value in obj]
+    if isinstance(obj, np.ndarray) and obj.ndim == 1 and obj.dtype.kind in "fiu":
+        dtype = obj.dtype.newbyteorder("<")
+        if dtype.str[1:] not in DTYPE_TO_TYPED_ARRAY:
+            # e.g. int64, which has no JS typed array equivalent supported by plotly.js
+            dtype = np.dtype("<f8")
+        data = np.ascontiguousarray(obj, dtype=dtype)
+        return {
+            "dtype": DTYPE_TO_TYPED_ARRAY[dtype.str[1:]],
+            "bdata": base64.b64encode(data.tobytes()).decode("ascii"),
+        }
+    return obj
+
+
+def write_dashboard(figures, fname, title="spine-generic", include_plotlyjs=True):
+    """
+    Write several Plotly figures in a single html page, with one tab per figure. The plotly.js bundle is included
+    once, numeric arrays are stored as binary data, and each figure is only rendered when its tab is first opened.
+    :param figures: OrderedDict: key: tab name, value: plotly Figure
+    :param fname: str: output html file
+    :param title: str: title of the page
+    :param include_plotlyjs: True: embed the plotly.js bundle in the page. 'directory': load the plotly.js bundle
+      from the folder of the page (see write_plotlyjs()).
+    :return: str: fname
+    """
+    from plotly.offline import get_plotlyjs
+    from plotly.utils import PlotlyJSONEncoder
+
+    if include_plotlyjs == "directory":
+        write_plotlyjs(os.path.dirname(os.path.abspath(fname)))
+        plotlyjs = '<script type="text/javascript" src="{}"></script>'.format(FNAME_PLOTLYJS)
+    elif include_plotlyjs:
+        plotlyjs = '<script type="text/javascript">{}</script>'.format(get_plotlyjs())
+    else:
+        raise ValueError("include_plotlyjs should be True or 'directory'.")
+
+    buttons, divs, data = [], [], []
+    for i, (name, fig) in enumerate(figures.items()):
+        id_fig = "fig-{}".format(i)
+        buttons.append(
+            '<button data-target="{}">{}</button>'.format(id_fig, html.escape(name))
+        )
+        divs.append('<div class="figure" id="{}"></div>'.format(id_fig))
+        fig_json = json.dumps(encode_arrays(fig.to_plotly_json()), cls=PlotlyJSONEncoder)
+        # Prevent the closing of the script element from within the data
+        fig_json = fig_json.replace("</", "<\\/")
+        data.append(
+            '<script type="application/json" id="{}-data">{}</script>'.format(id_fig, fig_json)
+        )
+
+    with open(fname, "w", encoding="utf-8") as f:
+        f.write(
+            TEMPLATE.format(
+                title=html.escape(title),
+                plotlyjs=plotlyjs,
+                buttons="\n".join(buttons),
+                divs="\n".join(divs),
+                data="\n".join(data),
+            )
+        )
+    return fname
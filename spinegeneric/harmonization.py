@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Harmonization of the metrics across sites (ComBat: location and scale of each site, with empirical Bayes shrinkage)
+
+
+import json
+
+import numpy as np
+import pandas as pd
+
+import spinegeneric.stats
+
+# Convergence of the empirical Bayes estimates: maximum change of the location (in standardized units) and relative
+# change of the scale between two iterations
+TOLERANCE = 1e-4
+N_ITER_MAX = 1000
+
+
+def _group_mean(values, group_id, n_groups):
+    """Mean of each group (NaN for groups without values)"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.bincount(group_id, weights=values, minlength=n_groups) / np.bincount(group_id, minlength=n_groups)
+
+
+def _mean_var(x, mask, axis=None):
+    """Mean and variance (ddof=1) of the values of x where mask is True, along axis"""
+    count = mask.sum(axis=axis)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(mask, x, 0).sum(axis=axis) / count
+        deviation = x - (mean if axis is None else np.expand_dims(mean, axis))
+        var = np.where(mask, deviation ** 2, 0).sum(axis=axis) / (count - 1)
+    return mean, var
+
+
+def _fill_priors(prior, prior_pooled):
+    """Replace undefined priors of sites (e.g. too few metrics) by the priors of all sites pooled"""
+    return np.where(np.isfinite(prior), prior, prior_pooled)
+
+
+class ComBat:
+    """
+    ComBat harmonization (Johnson et al., Biostatistics 2007; Fortin et al., NeuroImage 2018) of several metrics at
+    once. Each metric is modeled as value = intercept + covariates * beta + gamma(site) + delta(site) * error, where
+    the location (gamma) and scale (delta) of each site are estimated for all metrics of all sites as (site x metric)
+    matrices, and shrunk towards the mean across the metrics of the site (empirical Bayes). Harmonized values only
+    keep the effects of the intercept and covariates (e.g. age, sex). Sites with a single subject (for a metric) are
+    not harmonized.
+    The fitted parameters are kept, so that the values of new subjects of the same sites can be harmonized without
+    refitting (see apply(), to_json() and from_json()).
+
+    Attributes:
+      covariates: list of str: names of the covariates
+      metrics: pandas DataFrame indexed by metric, with columns: intercept, var_pooled (residual variance), and for
+        each covariate: beta_<covariate> (coefficient) and mean_<covariate> (used for missing covariates)
+      sites: pandas DataFrame indexed by (metric, site), with columns: n (number of subjects), gamma (location),
+        delta (scale, relative to var_pooled)
+    """
+
+    def __init__(self, covariates, metrics, sites):
+        self.covariates = list(covariates)
+        self.metrics = metrics
+        self.sites = sites
+
+    @classmethod
+    def fit(cls, metric, site, values, covariates=None):
+        """
+        Fit the harmonization of all metrics at once.
+        :param metric: array-like of str: metric of each value
+        :param site: array-like of str: site of each value
+        :param values: array-like of float: values
+        :param covariates: pandas DataFrame with one column per covariate (see spinegeneric.stats.encode_covariates),
+          in the same order as values, or None. Missing covariates are replaced by the mean of the metric.
+        :return: ComBat
+        """
+        values = np.asarray(values, dtype=np.float64)
+        metric_id, metrics = pd.factorize(np.asarray(metric))
+        site_id, sites = pd.factorize(np.asarray(site))
+        n_metrics, n_sites = len(metrics), len(sites)
+        names = [] if covariates is None else list(covariates.columns)
+        x = np.empty((len(values), 0)) if covariates is None else spinegeneric.stats.encode_covariates(covariates, names)
+
+        # Cells of the (site x metric) matrices
+        cell_id = site_id * n_metrics + metric_id
+        n_cells = n_sites * n_metrics
+        # Effect of the covariates, estimated within site (i.e., with a fixed effect per site)
+        x_mean = np.empty((n_metrics, len(names)))
+        x_cell = np.empty((n_cells, len(names)))
+        for j, column in enumerate(x.T):
+            is_missing = np.isnan(column)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                x_mean[:, j] = np.bincount(metric_id, weights=np.where(is_missing, 0, column), minlength=n_metrics) / (
+                    np.bincount(metric_id, weights=~is_missing, minlength=n_metrics)
+                )
+            x[:, j] = np.where(is_missing, x_mean[metric_id, j], column)
+            x_cell[:, j] = _group_mean(x[:, j], cell_id, n_cells)
+        y_cell = _group_mean(values, cell_id, n_cells)
+        x_within = x - x_cell[cell_id]
+        beta = spinegeneric.stats.grouped_lstsq(x_within, values - y_cell[cell_id], metric_id, n_metrics)
+        residual = values - y_cell[cell_id] - np.einsum("ij,ij->i", x_within, beta[metric_id])
+        var_pooled = _group_mean(residual ** 2, metric_id, n_metrics)
+        var_pooled[var_pooled <= 0] = np.nan
+        # Intercept: the mean of the metric, without the effect of the mean covariates
+        intercept = _group_mean(values, metric_id, n_metrics) - np.einsum("ij,ij->i", np.nan_to_num(x_mean), beta)
+
+        # Standardized values, and location/scale of each site for each metric
+        stand_mean = intercept[metric_id] + np.einsum("ij,ij->i", x, beta[metric_id])
+        z = (values - stand_mean) / np.sqrt(var_pooled[metric_id])
+        moments = spinegeneric.stats.Moments.from_values(z, cell_id, n_cells)
+        n = moments.n.reshape(n_sites, n_metrics).astype(np.float64)
+        gamma_hat = moments.mean.reshape(n_sites, n_metrics)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            delta_hat = (moments.m2 / (moments.n - 1)).reshape(n_sites, n_metrics)
+        # The location and scale of a site are only estimated with at least 2 subjects: values of the other sites are
+        # not harmonized
+        has_values = (n > 1) & np.isfinite(gamma_hat)
+        has_var = (n > 1) & np.isfinite(delta_hat)
+
+        # Priors of each site, across its metrics: normal for gamma, inverse gamma for delta (method of moments)
+        gamma_bar, t2 = _mean_var(gamma_hat, has_values, axis=1)
+        gamma_bar_pooled, t2_pooled = _mean_var(gamma_hat, has_values)
+        gamma_bar, t2 = _fill_priors(gamma_bar, gamma_bar_pooled), _fill_priors(t2, t2_pooled)
+        delta_bar, s2 = _mean_var(delta_hat, has_var, axis=1)
+        delta_bar_pooled, s2_pooled = _mean_var(delta_hat, has_var)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            a = (2 * s2 + delta_bar ** 2) / s2
+            b = (delta_bar * s2 + delta_bar ** 3) / s2
+            a_pooled = (2 * s2_pooled + delta_bar_pooled ** 2) / s2_pooled
+            b_pooled = (delta_bar_pooled * s2_pooled + delta_bar_pooled ** 3) / s2_pooled
+        is_defined = np.isfinite(a) & np.isfinite(b) & (s2 > 0)
+        a = np.where(is_defined, a, a_pooled)[:, np.newaxis]
+        b = np.where(is_defined, b, b_pooled)[:, np.newaxis]
+        gamma_bar, t2 = gamma_bar[:, np.newaxis], t2[:, np.newaxis]
+
+        # Posterior means, iterated until convergence, for all cells at once. The sum of squared deviations from the
+        # posterior location of a cell is obtained from its moments.
+        ss = np.where(has_var, moments.m2.reshape(n_sites, n_metrics), 0)
+        gamma, delta = gamma_hat, np.where(has_var, delta_hat, b / (a - 1))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for _ in range(N_ITER_MAX):
+                gamma_new = (n * t2 * gamma_hat + delta * gamma_bar) / (n * t2 + delta)
+                gamma_new = np.where(np.isfinite(gamma_new), gamma_new, gamma_hat)
+                delta_new = (b + 0.5 * (ss + n * (gamma_hat - gamma_new) ** 2)) / (n / 2 + a - 1)
+                delta_new = np.where(np.isfinite(delta_new), delta_new, np.where(has_var, delta_hat, 1))
+                # Change of the location (in standardized units) and relative change of the scale
+                change = np.max(
+                    np.fmax(np.abs(gamma_new - gamma), np.abs(delta_new - delta) / delta)[has_values], initial=0
+                )
+                gamma, delta = gamma_new, delta_new
+                if not change > TOLERANCE:
+                    break
+
+        table_metrics = pd.DataFrame({"intercept": intercept, "var_pooled": var_pooled}, index=metrics)
+        for j, name in enumerate(names):
+            table_metrics["beta_" + name] = beta[:, j]
+            table_metrics["mean_" + name] = x_mean[:, j]
+        is_cell = has_values.ravel()
+        table_sites = pd.DataFrame(
+            {"n": n.ravel()[is_cell].astype(np.int64), "gamma": gamma.ravel()[is_cell], "delta": delta.ravel()[is_cell]},
+            index=pd.MultiIndex.from_arrays(
+                [
+                    np.tile(np.asarray(metrics), n_sites)[is_cell],
+                    np.repeat(np.asarray(sites), n_metrics)[is_cell],
+                ],
+                names=["metric", "site"],
+            ),
+        )
+        return cls(names, table_metrics, table_sites)
+
+    def apply(self, metric, site, values, covariates=None):
+        """
+        Harmonize values with the fitted parameters (the values do not need to be the ones used for the fit).
+        :param metric: array-like of str: metric of each value
+        :param site: array-like of str: site of each value
+        :param values: array-like of float: values
+        :param covariates: pandas DataFrame with (at least) a column per covariate of the fit, in the same order as
+          values, or None if the fit has no covariates. Missing covariates are replaced by their mean in the fit.
+        :return: array of float: harmonized values (NaN for the metrics and sites that were not fitted)
+        """
+        values = np.asarray(values, dtype=np.float64)
+        params_metric = self.metrics.reindex(np.asarray(metric))
+        params_site = self.sites.reindex(pd.MultiIndex.from_arrays([np.asarray(metric), np.asarray(site)]))
+        stand_mean = params_metric["intercept"].values.copy()
+        if self.covariates:
+            x = spinegeneric.stats.encode_covariates(covariates, self.covariates)
+            x_mean = params_metric[["mean_" + name for name in self.covariates]].values
+            beta = params_metric[["beta_" + name for name in self.covariates]].values
+            stand_mean += np.einsum("ij,ij->i", np.where(np.isnan(x), x_mean, x), beta)
+        std_pooled = np.sqrt(params_metric["var_pooled"].values)
+        z = (values - stand_mean) / std_pooled
+        z = (z - params_site["gamma"].values) / np.sqrt(params_site["delta"].values)
+        return z * std_pooled + stand_mean
+
+    def to_json(self, fname):
+        """
+        Write the fitted parameters in a json file.
+        :param fname: str: output file
+        """
+        params = {
+            "covariates": self.covariates,
+            "metrics": {
+                metric: row.to_dict() for metric, row in self.metrics.astype(object).where(self.metrics.notna()).iterrows()
+            },
+            "sites": [
+                dict(metric=metric, site=site, n=int(row["n"]), gamma=row["gamma"], delta=row["delta"])
+                for (metric, site), row in self.sites.iterrows()
+            ],
+        }
+        with open(fname, "w") as f:
+            json.dump(params, f, indent=2)
+
+    @classmethod
+    def from_json(cls, fname):
+        """
+        Read the parameters written by to_json().
+        :param fname: str: json file
+        :return: ComBat
+        """
+        with open(fname, "r") as f:
+            params = json.load(f)
+        table_metrics = pd.DataFrame.from_dict(params["metrics"], orient="index").astype(np.float64)
+        table_sites = pd.DataFrame(params["sites"], columns=["metric", "site", "n", "gamma", "delta"]).astype(
+            {"n": np.int64, "gamma": np.float64, "delta": np.float64}
+        )
+        return cls(params["covariates"], table_metrics, table_sites.set_index(["metric", "site"]))
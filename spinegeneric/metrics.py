@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Registry of the metrics output by process_data.sh (one csv file per metric)
+
+
+import os
+import csv
+import json
+import logging
+import importlib.resources
+from collections import OrderedDict, namedtuple
+
+import spinegeneric.config
+
+# Description of a metric:
+#   name: name of the metric, used for output files and as key of the exclusion file. Example: 'csa_t1'
+#   file: csv file output by process_data.sh. Example: 'csa-SC_T1w.csv'
+#   field: column of the csv file holding the metric. Example: 'MEAN(area)'
+#   label: axis label, with Latex (for matplotlib)
+#   label_plotly: axis label, with html (for Plotly, which does not understand Latex)
+#   scale: scaling factor (for display)
+Metric = namedtuple("Metric", ["name", "file", "field", "label", "label_plotly", "scale"])
+
+# Fields output by sct_process_segmentation and sct_extract_metric, used for csv files that are not in the registry
+DEFAULT_FIELDS = ["MEAN(area)", "WA()"]
+
+
+def format_label(label, unit):
+    return "{} [{}]".format(label, unit) if unit else label
+
+
+def load_registry():
+    """
+    Load the registry of metrics from the file config/metrics.json
+    :return: OrderedDict: key: metric name, value: Metric
+    """
+    entries = json.loads(importlib.resources.files(spinegeneric.config).joinpath("metrics.json").read_text())
+    return OrderedDict(
+        (
+            entry["name"],
+            Metric(
+                name=entry["name"],
+                file=entry["file"],
+                field=entry["field"],
+                label=format_label(entry["label"], entry["unit"]),
+                label_plotly=format_label(entry["label"], entry["unit_html"]),
+                scale=entry["scale"],
+            ),
+        )
+        for entry in entries
+    )
+
+
+def discover_metrics(path_results=os.curdir, registry=None):
+    """
+    List the metrics of a results folder: the metrics of the registry, and the csv files of the folder that are not
+    in the registry but have a known field (see DEFAULT_FIELDS). The latter are described with default settings.
+    :param path_results: str: results folder
+    :param registry: OrderedDict output by load_registry(). By default, the registry is loaded.
+    :return: OrderedDict: key: metric name, value: Metric. Metrics of the registry come first (in the order of the
+      registry, including metrics whose csv file is missing), followed by the other csv files (sorted by name).
+    """
+    metrics = load_registry() if registry is None else OrderedDict(registry)
+    files_registry = {metric.file for metric in metrics.values()}
+    for file in sorted(os.listdir(path_results)):
+        if not file.endswith(".csv") or file in files_registry:
+            continue
+        with open(os.path.join(path_results, file), newline="") as f:
+            header = next(csv.reader(f), [])
+        fields = [field for field in DEFAULT_FIELDS if field in header]
+        if "Filename" not in header or not fields:
+            continue
+        name = os.path.splitext(file)[0].lower().replace("-", "_")
+        if name in metrics:
+            continue
+        logging.debug("{}: not in the registry of metrics, processed as metric '{}'".format(file, name))
+        label = os.path.splitext(file)[0]
+        metrics[name] = Metric(name=name, file=file, field=fields[0], label=label, label_plotly=label, scale=1)
+    return metrics
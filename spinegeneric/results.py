@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Tools to read the csv results output by sct_process_segmentation and sct_extract_metric
+
+
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+import spinegeneric.stats
+
+
+# Columns that identify a measure, used to detect duplicated measures (e.g., after processing a subject again with
+# '-append 1'). Label is only output by sct_extract_metric.
+KEY_COLUMNS = ["Filename", "VertLevel", "Label"]
+# Columns that identify the run that output a measure
+RUN_COLUMNS = ["Timestamp", "SCT Version"]
+DUPLICATE_POLICIES = ["latest", "sct-version", "error"]
+
+
+def load_results_csv(fname, fields):
+    """
+    Load a csv file output by sct_process_segmentation or sct_extract_metric, as a compact columnar table.
+    Only the columns that identify a measure (see KEY_COLUMNS and RUN_COLUMNS) and the requested metric fields are
+    parsed (the other columns are skipped by the parser), metric fields are parsed as float and "None" values as NaN.
+    :param fname: str: Path to the csv file, or binary file object
+    :param fields: str or list of str: Metric field(s) to read. Example: 'MEAN(area)', 'WA()'
+    :return: pandas DataFrame with columns: <RUN_COLUMNS and KEY_COLUMNS present in the file>, <fields>
+    """
+    if isinstance(fields, str):
+        fields = [fields]
+    header = pd.read_csv(fname, nrows=0).columns
+    if hasattr(fname, "seek"):
+        fname.seek(0)
+    columns = [column for column in RUN_COLUMNS + KEY_COLUMNS if column in header] + fields
+    dtype = {field: np.float64 for field in fields}
+    dtype.update({"Filename": str, "Timestamp": str, "SCT Version": "category", "VertLevel": "category",
+                  "Label": "category"})
+    results = pd.read_csv(
+        fname,
+        usecols=columns,
+        dtype={column: dtype[column] for column in columns},
+        na_values=["None"],
+        # Parse floats the same way as Python does, so that values are identical to float(str)
+        float_precision="round_trip",
+    )
+    return results[columns]
+
+
+def get_file_key(filename):
+    """
+    Identify the file of each measure by subject and file name, rather than by the full path (which changes if the
+    results are output in another folder). Each unique path is only processed once.
+    :param filename: pandas Series of str: paths of the files (column 'Filename')
+    :return: pandas Series of str, with the same index as filename
+    """
+    codes, filenames = pd.factorize(filename)
+    parts = pd.Series(filenames).str.split(os.sep)
+    file_key = (parts.str[-3] + os.sep + parts.str[-1]).fillna(pd.Series(filenames))
+    return pd.Series(file_key.values[codes], index=filename.index)
+
+
+def get_measure_key(results):
+    """
+    Identify each measure by subject, file name, vertebral levels and label, as drop_duplicate_results().
+    :param results: pandas DataFrame output by load_results_csv()
+    :return: pandas Series of str, with the same index as results
+    """
+    key = get_file_key(results["Filename"])
+    for column in KEY_COLUMNS[1:]:
+        if column in results:
+            key = key + "|" + results[column].astype(str)
+    return key
+
+
+def drop_duplicate_results(results, policy="latest", sct_version=None):
+    """
+    Keep a single measure per (subject, file, vertebral levels, label), when the same file was processed several
+    times (csv files output with '-append 1').
+    :param results: pandas DataFrame output by load_results_csv()
+    :param policy: str: how to select the measure to keep among duplicates:
+      - latest: keep the most recent measure (by Timestamp, and by order in the file for equal Timestamps)
+      - sct-version: only keep the measures output by the SCT version sct_version (the most recent one if there
+        are several)
+      - error: raise a ValueError if there are duplicates
+    :param sct_version: str: SCT version (see column 'SCT Version'), only used with policy='sct-version'
+    :return: results: pandas DataFrame without duplicates, in the same order as the input
+    :return: dropped: pandas DataFrame of the rows that were dropped
+    """
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError("Unknown policy '{}'. Choices are: {}".format(policy, DUPLICATE_POLICIES))
+    is_kept = np.ones(len(results), dtype=bool)
+    if policy == "sct-version":
+        if sct_version is None:
+            raise ValueError("Policy 'sct-version' requires sct_version.")
+        is_kept &= (results["SCT Version"] == sct_version).values
+
+    # Identify a measure by subject and file name (see get_file_key()), vertebral levels and label
+    file_id = pd.factorize(get_file_key(results["Filename"]))[0]
+    keys = [pd.Series(file_id)] + [
+        results[column].reset_index(drop=True) for column in KEY_COLUMNS[1:] if column in results
+    ]
+    # Sort by time (stable, so that the order in the file decides between equal timestamps), and keep the last
+    # measure of each key
+    if "Timestamp" in results:
+        timestamp = pd.to_datetime(results["Timestamp"], format="%Y-%m-%d %H:%M:%S", errors="coerce")
+        order = np.argsort(timestamp.values.astype(np.int64)[is_kept], kind="stable")
+    else:
+        order = np.arange(is_kept.sum())
+    candidates = np.flatnonzero(is_kept)[order]
+    is_duplicated = pd.MultiIndex.from_arrays([key.values[candidates] for key in keys]).duplicated(keep="last")
+    if policy == "error" and is_duplicated.any():
+        duplicates = results.iloc[np.sort(candidates[is_duplicated])]
+        raise ValueError(
+            "{} duplicated measures found (e.g. {}). Use another policy to select the measures to keep.".format(
+                len(duplicates), duplicates["Filename"].unique()[:5].tolist()
+            )
+        )
+    is_kept[candidates[is_duplicated]] = False
+    return results[is_kept], results[~is_kept]
+
+
+class CsvTail:
+    """
+    Incremental reader of a csv file that is being appended to (e.g. by process_data.sh while sct_run_batch is
+    running): each call to read() only parses the lines appended since the previous call. The last line is only
+    parsed once it is complete (i.e. ends with a newline), so that a line being written is never read partially.
+    """
+
+    def __init__(self, fname, fields):
+        """
+        :param fname: str: Path to the csv file (it does not need to exist yet)
+        :param fields: str or list of str: Metric field(s) to read (see load_results_csv())
+        """
+        self.fname = fname
+        self.fields = fields
+        self.offset = 0
+        self.header = None
+        self._inode = None
+
+    def read(self):
+        """
+        Parse the lines appended since the previous call.
+        :return: results: pandas DataFrame of the new rows (see load_results_csv()), or None if there are no new rows
+        :return: is_reset: bool: True if the file was truncated or replaced since the previous call. In that case,
+          the file is read from the start, and the rows returned by previous calls should be discarded.
+        """
+        try:
+            stat = os.stat(self.fname)
+        except FileNotFoundError:
+            return None, False
+        is_reset = stat.st_size < self.offset or (self._inode is not None and stat.st_ino != self._inode)
+        if is_reset:
+            self.offset, self.header = 0, None
+        self._inode = stat.st_ino
+        if stat.st_size == self.offset:
+            return None, is_reset
+        with open(self.fname, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(stat.st_size - self.offset)
+        # Only consume complete lines
+        data = data[:data.rfind(b"\n") + 1]
+        if not data:
+            # No complete line yet (e.g. the header line is being written)
+            return None, is_reset
+        self.offset += len(data)
+        if self.header is None:
+            end_header = data.find(b"\n") + 1
+            self.header, data = data[:end_header], data[end_header:]
+        if not data:
+            return None, is_reset
+        return load_results_csv(io.BytesIO(self.header + data), self.fields), is_reset
+
+
+class RunningSiteStats:
+    """
+    Number of values, mean and standard deviation per site, updated incrementally (Welford's algorithm, see
+    spinegeneric.stats.Moments) as measures arrive. A new measure of a key that was already seen (e.g. a subject
+    processed again) replaces the previous one: the previous value is subtracted from the moments of its site.
+    """
+
+    def __init__(self):
+        self.sites = pd.Index([], dtype=object)
+        self.moments = spinegeneric.stats.Moments([], [], [])
+        # Current measure of each key: site index and value
+        self._measures = pd.DataFrame({"site_id": np.zeros(0, dtype=np.int64), "val": np.zeros(0)})
+
+    def update(self, site, key, value):
+        """
+        Add measures. NaN values remove the previous measure of their key, if any.
+        :param site: array of str: site of each measure
+        :param key: array of str: key of each measure (e.g. file name). The last measure of a key is kept.
+        :param value: array of float: value of each measure
+        :return: array of str: sites whose statistics changed
+        """
+        batch = pd.DataFrame({"site": np.asarray(site, dtype=object), "val": np.asarray(value, dtype=np.float64)},
+                             index=pd.Index(key))
+        batch = batch[~batch.index.duplicated(keep="last")]
+        # Register new sites
+        sites_new = pd.Index(batch["site"].unique()).difference(self.sites, sort=False)
+        if len(sites_new):
+            self.sites = self.sites.append(sites_new)
+            self.moments = spinegeneric.stats.Moments(
+                np.concatenate([self.moments.n, np.zeros(len(sites_new))]),
+                np.concatenate([self.moments.mean, np.full(len(sites_new), np.nan)]),
+                np.concatenate([self.moments.m2, np.zeros(len(sites_new))]),
+            )
+        batch["site_id"] = self.sites.get_indexer(batch["site"])
+        # Remove the previous measures of the keys, then add the new ones
+        previous = self._measures[self._measures.index.isin(batch.index)]
+        self.moments = self.moments.subtract(
+            spinegeneric.stats.Moments.from_values(previous["val"].values, previous["site_id"].values, len(self.sites))
+        )
+        batch = batch[batch["val"].notna()]
+        self.moments = self.moments.combine(
+            spinegeneric.stats.Moments.from_values(batch["val"].values, batch["site_id"].values, len(self.sites))
+        )
+        self._measures = pd.concat([self._measures.drop(previous.index), batch[["site_id", "val"]]])
+        return np.unique(np.concatenate([self.sites[previous["site_id"].values], self.sites[batch["site_id"].values]]))
+
+    def to_frame(self):
+        """
+        :return: pandas DataFrame indexed by site, with columns: n, mean, std, cov (std with ddof=0, as in
+          SiteValues.std(); NaN for sites without values)
+        """
+        std = np.sqrt(self.moments.var())
+        return pd.DataFrame(
+            {"n": self.moments.n.astype(np.int64), "mean": self.moments.mean, "std": std,
+             "cov": std / self.moments.mean},
+            index=self.sites,
+        )
+
+
+class SiteValues:
+    """
+    Values of a metric for each subject, grouped per site, stored as a ragged array: the values (and subjects) of
+    all sites are stored in contiguous arrays, and the values of the i-th site are values[offsets[i]:offsets[i+1]].
+    Per-site values are views on the contiguous array, and per-site reductions are vectorized across sites.
+    """
+
+    __slots__ = ("sites", "values", "subjects", "offsets", "_index")
+
+    def __init__(self, sites, values, subjects, offsets):
+        """
+        :param sites: array of str: site labels, of length n_site
+        :param values: array of float: values of all subjects, ordered per site
+        :param subjects: array of str: subjects corresponding to values
+        :param offsets: array of int: start of each site in values, of length n_site + 1
+        """
+        self.sites = np.asarray(sites, dtype=object)
+        self.values = np.ascontiguousarray(values, dtype=np.float64)
+        self.subjects = np.asarray(subjects, dtype=str)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self._index = {site: i for i, site in enumerate(self.sites)}
+
+    @classmethod
+    def from_long(cls, site, value, subject, sites=None):
+        """
+        Build from a long-format table (one row per subject).
+        :param site: array of str: site of each subject
+        :param value: array of float: value of each subject
+        :param subject: array of str: subject
+        :param sites: array of str: site labels, which defines the order of the sites (sites without values are
+          kept, with an empty set of values). By default: by order of appearance in site.
+        :return: SiteValues
+        """
+        site = pd.Index(site)
+        if sites is None:
+            sites = site.unique()
+        site_id = pd.Index(sites).get_indexer(site)
+        if (site_id == -1).any():
+            raise ValueError("Sites {} are not listed in sites.".format(list(site[site_id == -1].unique())))
+        # Stable sort, so that subjects keep their order within each site
+        order = np.argsort(site_id, kind="stable")
+        counts = np.bincount(site_id, minlength=len(sites))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        return cls(sites, np.asarray(value)[order], np.asarray(subject)[order], offsets)
+
+    def __len__(self):
+        return len(self.sites)
+
+    def __contains__(self, site):
+        return site in self._index
+
+    def __getitem__(self, site):
+        """Values of a site (view, not a copy)"""
+        i = self._index[site]
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getstate__(self):
+        return self.sites, self.values, self.subjects, self.offsets
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def get_subjects(self, site):
+        """Subjects of a site (view, not a copy)"""
+        i = self._index[site]
+        return self.subjects[self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def counts(self):
+        """Number of values per site"""
+        return np.diff(self.offsets)
+
+    @property
+    def site_ids(self):
+        """Index of the site of each value"""
+        return np.repeat(np.arange(len(self.sites)), self.counts)
+
+    def sum(self):
+        """Sum of values per site"""
+        return np.bincount(self.site_ids, weights=self.values, minlength=len(self.sites))
+
+    def mean(self):
+        """Mean of values per site (NaN for sites without values)"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.sum() / self.counts
+
+    def std(self, ddof=0):
+        """Standard deviation of values per site (NaN for sites without enough values)"""
+        deviation = self.values - self.mean()[self.site_ids]
+        ssd = np.bincount(self.site_ids, weights=deviation ** 2, minlength=len(self.sites))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.sqrt(ssd / (self.counts - ddof))
+
+    def quantile(self, q):
+        """
+        Quantile of values per site, with linear interpolation (same as numpy.quantile)
+        :param q: float: quantile, between 0 and 1
+        :return: array of float: quantile of each site (NaN for sites without values)
+        """
+        return spinegeneric.stats.grouped_quantile(self.values, self.site_ids, len(self.sites), q)
+
+    def to_frame(self):
+        """
+        Long-format table (one row per subject).
+        :return: pandas DataFrame with columns: site, subject, val
+        """
+        return pd.DataFrame(
+            {"site": self.sites[self.site_ids], "subject": self.subjects, "val": self.values}
+        )
+
+
+def join_site_values(site_values_1, site_values_2, suffixes=("_1", "_2")):
+    """
+    Pair the values of two metrics (e.g., csa_t1 and csa_t2) by (site, subject), with a hash join. Only the subjects
+    that have a value for both metrics are kept, so sites that are present for only one metric are dropped. If a
+    subject has several values at the same site, the first one is used.
+    :param site_values_1: SiteValues
+    :param site_values_2: SiteValues
+    :param suffixes: tuple of str: suffixes appended to 'val' to name the values of each metric
+    :return: pandas DataFrame with columns: site, subject, val<suffix_1>, val<suffix_2>, sorted by site
+    """
+    frames = [
+        site_values.to_frame().drop_duplicates(["site", "subject"])
+        for site_values in [site_values_1, site_values_2]
+    ]
+    pairs = frames[0].merge(frames[1], on=["site", "subject"], how="inner", suffixes=suffixes)
+    return pairs.sort_values("site", kind="stable").reset_index(drop=True)
@@ -0,0 +1,466 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Statistical tools operating on grouped data (e.g., subjects within sites, sites within vendors)
+
+
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+# Survival function of the F distribution (scipy.special is much faster to import than scipy.stats)
+from scipy.special import fdtrc
+
+# Same fields (and repr) as the output of scipy.stats.f_oneway
+F_onewayResult = namedtuple("F_onewayResult", ["statistic", "pvalue"])
+# Maximum number of elements of the arrays of a chunk of resamples (bootstrap, permutations), to bound memory
+MAX_ELEMENTS = 2 ** 22
+
+
+def anova_oneway(n, mean, ssw, anova_id):
+    """
+    One-way ANOVA computed from the sufficient statistics of each group, for several independent ANOVAs at once.
+    This gives the same results as scipy.stats.f_oneway, without having to build the list of samples of each group.
+    :param n: array: number of values in each group
+    :param mean: array: mean of each group
+    :param ssw: array: sum of squared deviations from the mean, within each group
+    :param anova_id: array: ANOVA that each group belongs to
+    :return: pandas DataFrame indexed by anova_id, with columns: statistic, pvalue. The statistic is NaN if there
+      are less than two groups, if a group is empty, or if there are no degrees of freedom within groups.
+    """
+    groups = pd.DataFrame(
+        {"n": np.asarray(n, dtype=float), "mean": np.asarray(mean, dtype=float), "ssw": np.asarray(ssw, dtype=float)}
+    )
+    groups["sum"] = (groups["n"] * groups["mean"]).fillna(0)
+    groups["anova_id"] = np.asarray(anova_id)
+    grouped = groups.groupby("anova_id", sort=False)
+    total = grouped.agg(
+        n=("n", "sum"), n_min=("n", "min"), k=("n", "size"), sum=("sum", "sum"), ssw=("ssw", "sum")
+    )
+    # Sum of squared deviations between groups
+    grand_mean = groups["anova_id"].map(total["sum"] / total["n"])
+    ssb = (groups["n"] * (groups["mean"] - grand_mean) ** 2).groupby(groups["anova_id"], sort=False).sum()
+    df_between = total["k"] - 1
+    df_within = total["n"] - total["k"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        statistic = (ssb / df_between) / (total["ssw"] / df_within)
+    statistic[(total["k"] < 2) | (total["n_min"] == 0) | (df_within <= 0)] = np.nan
+    pvalue = fdtrc(df_between, df_within, statistic)
+    return pd.DataFrame({"statistic": statistic, "pvalue": pvalue}, index=total.index)
+
+
+class Moments:
+    """
+    Number of values, mean and sum of squared deviations from the mean (M2) of groups of values, as accumulated by
+    Welford's online algorithm. Moments of disjoint sets of values can be combined (Chan et al.), e.g. to aggregate
+    sites into vendors, and the moments of a subset of values can be subtracted in closed form, which gives
+    leave-one-out statistics without going through the values again. All operations are vectorized across groups.
+    """
+
+    __slots__ = ("n", "mean", "m2")
+
+    def __init__(self, n, mean, m2):
+        """
+        :param n: array: number of values of each group
+        :param mean: array: mean of each group (NaN for empty groups)
+        :param m2: array: sum of squared deviations from the mean, within each group
+        """
+        self.n = np.asarray(n, dtype=np.float64)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.m2 = np.asarray(m2, dtype=np.float64)
+
+    @classmethod
+    def from_values(cls, values, group_id, n_groups):
+        """
+        :param values: array of float: values
+        :param group_id: array of int: group of each value, between 0 and n_groups - 1
+        :param n_groups: int: number of groups
+        :return: Moments of each group
+        """
+        values = np.asarray(values, dtype=np.float64)
+        n = np.bincount(group_id, minlength=n_groups).astype(np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.bincount(group_id, weights=values, minlength=n_groups) / n
+        m2 = np.bincount(group_id, weights=(values - mean[group_id]) ** 2, minlength=n_groups)
+        return cls(n, mean, m2)
+
+    def __len__(self):
+        return len(self.n)
+
+    def __getitem__(self, index):
+        return Moments(self.n[index], self.mean[index], self.m2[index])
+
+    def var(self, ddof=0):
+        """Variance of each group (NaN for groups without enough values)"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.m2 / (self.n - ddof)
+
+    def combine(self, other):
+        """
+        Moments of the union of the values of self and other (group by group). With a single value per group in
+        other, this is the update step of Welford's algorithm.
+        :param other: Moments
+        :return: Moments
+        """
+        n = self.n + other.n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            delta = other.mean - self.mean
+            mean = self.mean + delta * other.n / n
+            m2 = self.m2 + other.m2 + delta ** 2 * self.n * other.n / n
+        mean = np.where(self.n == 0, other.mean, np.where(other.n == 0, self.mean, mean))
+        m2 = np.where(self.n == 0, other.m2, np.where(other.n == 0, self.m2, m2))
+        return Moments(n, mean, m2)
+
+    def subtract(self, other):
+        """
+        Moments of the values of self without the values of other (group by group), which must be a subset of the
+        values of self.
+        :param other: Moments
+        :return: Moments
+        """
+        n = self.n - other.n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = self.mean + (self.mean - other.mean) * other.n / n
+            m2 = self.m2 - other.m2 - (other.mean - mean) ** 2 * n * other.n / self.n
+        mean = np.where(other.n == 0, self.mean, np.where(n == 0, np.nan, mean))
+        # Rounding errors might make M2 slightly negative
+        m2 = np.where(other.n == 0, self.m2, np.where(n == 0, 0, np.maximum(m2, 0)))
+        return Moments(n, mean, m2)
+
+    def group(self, group_id, n_groups):
+        """
+        Combine groups into larger groups (e.g. sites into vendors).
+        :param group_id: array of int: larger group of each group, between 0 and n_groups - 1
+        :param n_groups: int: number of larger groups
+        :return: Moments of each larger group
+        """
+        n = np.bincount(group_id, weights=self.n, minlength=n_groups)
+        total = np.bincount(group_id, weights=np.where(self.n > 0, self.n * self.mean, 0), minlength=n_groups)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = total / n
+        deviation = np.where(self.n > 0, self.n * (self.mean - mean[group_id]) ** 2, 0)
+        m2 = np.bincount(group_id, weights=self.m2 + deviation, minlength=n_groups)
+        return Moments(n, mean, m2)
+
+
+def _vendor_statistics(n_site, site_means, sum_cov, pooled, ssw):
+    """
+    Statistics across the sites of a vendor, as computed by sg_generate_figure (std with ddof=0), from sufficient
+    statistics.
+    :param n_site: array: number of sites
+    :param site_means: Moments of the means of the sites
+    :param sum_cov: array: sum of the COVs of the sites
+    :param pooled: Moments of the values of all the subjects of the vendor
+    :param ssw: array: sum of the M2 of the sites
+    :return: dict of arrays: mean, cov_inter, cov_intra, statistic (F of the ANOVA across sites)
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        std = np.sqrt(site_means.m2 / n_site)
+        df_between = n_site - 1
+        df_within = pooled.n - n_site
+        statistic = ((pooled.m2 - ssw) / df_between) / (ssw / df_within)
+        statistic[(df_between < 1) | (df_within <= 0)] = np.nan
+        return {
+            "mean": site_means.mean,
+            "cov_inter": std / site_means.mean,
+            "cov_intra": sum_cov / n_site,
+            "statistic": statistic,
+        }
+
+
+def leave_one_out(values, site_id, site_vendor):
+    """
+    Statistics across the sites of each vendor (mean of the site means, inter-site COV, mean intra-site COV and F of
+    the ANOVA across sites, see compute_statistics() in sg_generate_figure), and how they change when a single
+    subject or a single site is removed. The statistics of all the candidates are computed at once, in closed form,
+    from the moments of each site and vendor. A subject that is the only one of its site is a site removal.
+    :param values: array of float: value of each subject
+    :param site_id: array of int: site of each subject (index in site_vendor)
+    :param site_vendor: array: vendor of each site. Sites without values are ignored.
+    :return: vendors: pandas DataFrame indexed by vendor, with columns: mean, cov_inter, cov_intra, statistic
+    :return: candidates: pandas DataFrame with one row per subject (in the order of values) then one row per site
+      with values (in the order of site_vendor), with columns: removed ('subject' or 'site'), index (index of the
+      subject in values, or of the site in site_vendor), vendor, and the statistics of the vendor without the
+      candidate: mean, cov_inter, cov_intra, statistic
+    """
+    values = np.asarray(values, dtype=np.float64)
+    site_id = np.asarray(site_id)
+    vendor_id, vendor_names = pd.factorize(pd.Series(site_vendor))
+    n_vendor = len(vendor_names)
+    sites = Moments.from_values(values, site_id, len(vendor_id))
+    has_values = sites.n > 0
+    # Sites without values are not part of their vendor
+    vendor_id = np.where(has_values, vendor_id, n_vendor)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        site_cov = np.sqrt(sites.var()) / sites.mean
+
+    # Sufficient statistics of each vendor
+    n_site = np.bincount(vendor_id, minlength=n_vendor + 1).astype(np.float64)
+    site_means = Moments.from_values(np.where(has_values, sites.mean, 0), vendor_id, n_vendor + 1)
+    sum_cov = np.bincount(vendor_id, weights=np.where(has_values, site_cov, 0), minlength=n_vendor + 1)
+    pooled = sites.group(vendor_id, n_vendor + 1)
+    ssw = np.bincount(vendor_id, weights=sites.m2, minlength=n_vendor + 1)
+    vendors = pd.DataFrame(
+        _vendor_statistics(n_site, site_means, sum_cov, pooled, ssw), index=vendor_names.append(pd.Index([None]))
+    ).iloc[:n_vendor]
+
+    # Remove one site
+    v = vendor_id
+    site_one = Moments(np.ones(len(sites)), sites.mean, np.zeros(len(sites)))
+    without_site = _vendor_statistics(
+        n_site[v] - 1,
+        site_means[v].subtract(site_one),
+        sum_cov[v] - site_cov,
+        pooled[v].subtract(sites),
+        ssw[v] - sites.m2,
+    )
+
+    # Remove one subject: the moments of its site change, and so do the mean and the COV of the site
+    s, v = site_id, vendor_id[site_id]
+    subject_one = Moments(np.ones(len(values)), values, np.zeros(len(values)))
+    site_new = sites[s].subtract(subject_one)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        site_cov_new = np.sqrt(site_new.var()) / site_new.mean
+    without_subject = _vendor_statistics(
+        n_site[v],
+        site_means[v].subtract(site_one[s]).combine(Moments(np.ones(len(values)), site_new.mean, np.zeros(len(values)))),
+        sum_cov[v] - site_cov[s] + site_cov_new,
+        pooled[v].subtract(subject_one),
+        ssw[v] - sites.m2[s] + site_new.m2,
+    )
+    is_last = site_new.n == 0
+    for name, stat in without_subject.items():
+        stat[is_last] = without_site[name][s[is_last]]
+
+    idx_sites = np.flatnonzero(has_values)
+    candidates = pd.concat(
+        [
+            pd.DataFrame(dict(removed="subject", index=np.arange(len(values)), vendor=vendor_names[v], **without_subject)),
+            pd.DataFrame(
+                dict(
+                    removed="site",
+                    index=idx_sites,
+                    vendor=vendor_names[vendor_id[idx_sites]],
+                    **{name: stat[idx_sites] for name, stat in without_site.items()},
+                )
+            ),
+        ],
+        ignore_index=True,
+    )
+    return vendors, candidates
+
+
+def _chunk_sizes(n_resamples, n_columns, max_elements=MAX_ELEMENTS):
+    """Split n_resamples resamples of n_columns values into chunks of at most max_elements values"""
+    size = max(1, max_elements // max(n_columns, 1))
+    return [min(size, n_resamples - start) for start in range(0, n_resamples, size)]
+
+
+def bootstrap_vendor(site_mean, site_cov, site_vendor, n_boot, rng, confidence=0.95, max_elements=MAX_ELEMENTS):
+    """
+    Bootstrap confidence intervals (percentile method) of the statistics across the sites of each vendor: mean of
+    the site means, inter-site COV (std of the site means, with ddof=0, divided by their mean) and intra-site COV
+    (mean of the COVs of the sites). Sites are resampled with replacement within their vendor. The resamples of a
+    chunk are drawn as a single index matrix (one row per resample), and reduced with grouped sums.
+    :param site_mean: array of float: mean of each site
+    :param site_cov: array of float: COV of each site
+    :param site_vendor: array: vendor of each site
+    :param n_boot: int: number of resamples
+    :param rng: numpy.random.Generator
+    :param confidence: float: confidence level
+    :param max_elements: int: maximum number of values of a chunk of resamples
+    :return: pandas DataFrame indexed by vendor, with columns: <statistic>_ci_lower, <statistic>_ci_upper, for
+      statistic in: mean, cov_inter, cov_intra
+    """
+    vendor_id, vendors = pd.factorize(pd.Series(site_vendor))
+    order = np.argsort(vendor_id, kind="stable")
+    site_mean = np.asarray(site_mean, dtype=np.float64)[order]
+    site_cov = np.asarray(site_cov, dtype=np.float64)[order]
+    vendor_id = vendor_id[order]
+    n_site = np.bincount(vendor_id, minlength=len(vendors))
+    start = np.concatenate([[0], np.cumsum(n_site)[:-1]])
+    resamples = {name: [] for name in ["mean", "cov_inter", "cov_intra"]}
+    for size in _chunk_sizes(n_boot, len(site_mean), max_elements):
+        # Column j of a resample is a site drawn among the sites of the vendor of the j-th site
+        idx = start[vendor_id] + (rng.random((size, len(site_mean))) * n_site[vendor_id]).astype(np.int64)
+        means = site_mean[idx]
+        mean = np.add.reduceat(means, start, axis=1) / n_site
+        std = np.sqrt(np.add.reduceat((means - mean[:, vendor_id]) ** 2, start, axis=1) / n_site)
+        resamples["mean"].append(mean)
+        resamples["cov_inter"].append(std / mean)
+        resamples["cov_intra"].append(np.add.reduceat(site_cov[idx], start, axis=1) / n_site)
+    ci = {}
+    for name, values in resamples.items():
+        values = np.concatenate(values)
+        ci[name + "_ci_lower"], ci[name + "_ci_upper"] = np.quantile(
+            values, [(1 - confidence) / 2, (1 + confidence) / 2], axis=0
+        )
+    return pd.DataFrame(ci, index=vendors)
+
+
+def permutation_anova(values, group_id, stratum_id, n_perm, rng, max_elements=MAX_ELEMENTS):
+    """
+    p-values of one-way ANOVAs by permutation, for several independent ANOVAs (strata) at once: the group labels are
+    shuffled within each stratum. The total sum of squares of a stratum does not depend on the labels, so the F
+    statistic is an increasing function of sum_g(S_g ** 2 / n_g) (S_g: sum of the values of group g, n_g: number of
+    values), which is computed for all the permutations of a chunk with grouped sums.
+    :param values: array of float: values
+    :param group_id: array: group of each value (groups of different strata must have different ids)
+    :param stratum_id: array: ANOVA (stratum) that each value belongs to
+    :param n_perm: int: number of permutations
+    :param rng: numpy.random.Generator
+    :param max_elements: int: maximum number of values of a chunk of permutations
+    :return: pandas Series indexed by stratum: (1 + number of permutations with a statistic at least as large as the
+      observed one) / (1 + n_perm). NaN if there are less than two groups, or no degrees of freedom within groups
+      (same as anova_oneway()).
+    """
+    group_code, groups = pd.factorize(pd.Series(group_id))
+    stratum_code, strata = pd.factorize(pd.Series(stratum_id))
+    # Sort values by stratum, so that shuffling sorted random keys offset by the stratum keeps labels in their stratum
+    order = np.argsort(stratum_code, kind="stable")
+    values = np.asarray(values, dtype=np.float64)[order]
+    group_code, stratum_code = group_code[order], stratum_code[order]
+    n_group = np.bincount(group_code, minlength=len(groups))
+    group_stratum = np.zeros(len(groups), dtype=np.int64)
+    group_stratum[group_code] = stratum_code
+    # Sum of the statistic of the groups of each stratum, as a matrix product
+    to_stratum = np.zeros((len(groups), len(strata)))
+    to_stratum[np.arange(len(groups)), group_stratum] = 1
+
+    def statistic(sums):
+        return (sums ** 2 / n_group) @ to_stratum
+
+    observed = statistic(np.bincount(group_code, weights=values, minlength=len(groups))[np.newaxis])[0]
+    # Tolerance for rounding errors, so that permutations equivalent to the observed labels are counted
+    threshold = observed - 1e-12 * np.abs(observed)
+    count = np.zeros(len(strata))
+    n = len(values)
+    for size in _chunk_sizes(n_perm, n, max_elements):
+        permutation = np.argsort(stratum_code + rng.random((size, n)), axis=1)
+        labels = np.arange(size)[:, np.newaxis] * len(groups) + group_code[permutation]
+        sums = np.bincount(
+            labels.ravel(), weights=np.broadcast_to(values, (size, n)).ravel(), minlength=size * len(groups)
+        ).reshape(size, len(groups))
+        count += (statistic(sums) >= threshold).sum(axis=0)
+    pvalue = (1 + count) / (1 + n_perm)
+    k = np.bincount(group_stratum, minlength=len(strata))
+    n_stratum = np.bincount(stratum_code, minlength=len(strata))
+    pvalue[(k < 2) | (n_stratum - k <= 0)] = np.nan
+    return pd.Series(pvalue, index=strata)
+
+
+def grouped_quantile(values, group_id, n_groups, q):
+    """
+    Quantile of the values of each group, with linear interpolation (same as numpy.quantile), for all groups at once.
+    :param values: array of float: values
+    :param group_id: array of int: group of each value, between 0 and n_groups - 1
+    :param n_groups: int: number of groups
+    :param q: float: quantile, between 0 and 1
+    :return: array of float: quantile of each group (NaN for groups without values)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    # Sort values within each group: the values of the i-th group are then sorted_values[start[i]:start[i+1]]
+    order = np.lexsort((values, group_id))
+    sorted_values = values[order]
+    counts = np.bincount(group_id, minlength=n_groups)
+    start = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    position = np.maximum(counts - 1, 0) * q
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, np.maximum(counts - 1, 0))
+    quantile = np.full(n_groups, np.nan)
+    has_values = counts > 0
+    value_lower = sorted_values[(start + lower)[has_values]]
+    value_upper = sorted_values[(start + upper)[has_values]]
+    fraction = (position - lower)[has_values]
+    quantile[has_values] = value_lower + (value_upper - value_lower) * fraction
+    return quantile
+
+
+def robust_zscore(values, group_id, n_groups, min_count=1):
+    """
+    Robust z-score of each value within its group: (value - median) / (1.4826 * MAD), where MAD is the median
+    absolute deviation from the median of the group (scaled to match the std of normally distributed values).
+    :param values: array of float: values
+    :param group_id: array of int: group of each value, between 0 and n_groups - 1
+    :param n_groups: int: number of groups
+    :param min_count: int: groups with less values have NaN z-scores
+    :return: zscore: array of float: z-score of each value (NaN if the MAD of its group is zero)
+    :return: median: array of float: median of each group
+    :return: mad: array of float: scaled MAD of each group
+    """
+    values = np.asarray(values, dtype=np.float64)
+    median = grouped_quantile(values, group_id, n_groups, 0.5)
+    mad = 1.4826 * grouped_quantile(np.abs(values - median[group_id]), group_id, n_groups, 0.5)
+    mad[np.bincount(group_id, minlength=n_groups) < min_count] = np.nan
+    with np.errstate(divide="ignore", invalid="ignore"):
+        zscore = (values - median[group_id]) / mad[group_id]
+    zscore[~np.isfinite(zscore)] = np.nan
+    return zscore, median, mad
+
+
+def encode_covariates(table, covariates):
+    """
+    Numeric matrix of covariates of participants (e.g. columns of participants.tsv). Sex is encoded as 1 for male
+    and 0 for female (case-insensitive 'M'/'F'), other covariates are parsed as numbers. Other values are missing.
+    :param table: pandas DataFrame with a column per covariate
+    :param covariates: list of str: covariates
+    :return: array (n_rows, n_covariates) of float, NaN for missing values
+    """
+    columns = [
+        table[covariate].astype("string").str.upper().map({"M": 1.0, "F": 0.0})
+        if covariate == "sex" else pd.to_numeric(table[covariate], errors="coerce")
+        for covariate in covariates
+    ]
+    return np.stack([np.asarray(column, dtype=np.float64) for column in columns], axis=1).reshape(len(table), -1)
+
+
+def grouped_lstsq(x, y, group_id, n_groups):
+    """
+    Least squares coefficients of y on x (without intercept: x and y are usually centered) within each group, for
+    all groups at once, by solving the normal equations of the groups as a single batch.
+    :param x: array (n_values, n_covariates): regressors
+    :param y: array of float: values
+    :param group_id: array of int: group of each value, between 0 and n_groups - 1
+    :param n_groups: int: number of groups
+    :return: array (n_groups, n_covariates): coefficients. Regressors that are zero within a group (e.g. a
+      covariate that does not vary) have a zero coefficient, as do groups with less than two values.
+    """
+    n_cov = x.shape[1]
+    if n_cov == 0:
+        return np.zeros((n_groups, 0))
+    products = x[:, :, np.newaxis] * x[:, np.newaxis, :]
+    xtx = np.stack(
+        [np.bincount(group_id, weights=products[:, i, j], minlength=n_groups) for i in range(n_cov) for j in range(n_cov)],
+        axis=1,
+    ).reshape(n_groups, n_cov, n_cov)
+    xty = np.stack([np.bincount(group_id, weights=x[:, j] * y, minlength=n_groups) for j in range(n_cov)], axis=1)
+    xtx += np.eye(n_cov) * (np.diagonal(xtx, axis1=1, axis2=2) == 0)[:, np.newaxis, :]
+    coef = np.linalg.solve(xtx, xty[:, :, np.newaxis])[:, :, 0]
+    coef[np.bincount(group_id, minlength=n_groups) < 2] = 0
+    return coef
+
+
+def adjust_covariates(values, covariates, group_id, n_groups):
+    """
+    Remove the linear effect of covariates (e.g. age, sex), estimated by least squares within each group (e.g. each
+    metric), for all groups at once. Covariates are centered within each group, so that adjusted values keep the
+    mean (and units) of the group. Missing covariates are replaced by the mean of the group (no adjustment).
+    :param values: array of float: values
+    :param covariates: array (n_values, n_covariates): covariates
+    :param group_id: array of int: group of each value, between 0 and n_groups - 1
+    :param n_groups: int: number of groups
+    :return: array of float: adjusted values
+    """
+    values = np.asarray(values, dtype=np.float64)
+    covariates = np.asarray(covariates, dtype=np.float64).reshape(len(values), -1)
+    # Center covariates (and fill missing covariates with 0 after centering)
+    is_missing = np.isnan(covariates)
+    covariates = np.where(is_missing, 0, covariates)
+    count = np.stack([np.bincount(group_id, weights=~is_missing[:, j], minlength=n_groups)
+                      for j in range(covariates.shape[1])], axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.stack([np.bincount(group_id, weights=covariates[:, j], minlength=n_groups)
+                         for j in range(covariates.shape[1])], axis=1) / count
+    covariates = np.where(is_missing, 0, covariates - mean[group_id])
+    # Covariates that do not vary within a group (e.g. all subjects of the same sex) are not adjusted for
+    coef = grouped_lstsq(covariates, values, group_id, n_groups)
+    return values - np.einsum("ij,ij->i", covariates, coef[group_id])
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Test script for create_mosaic
+
+import itertools
+import subprocess
+
+import cv2
+
+import nibabel as nib
+import nibabel.orientations
+import numpy as np
+import pytest
+
+from spinegeneric.cli.create_mosaic import MosaicWriter, get_mosaic, read_mid_slice, save_mosaic
+
+# Orientations of SCT, and the corresponding axis codes of nibabel
+ORIENTATIONS = {"RPI": ("L", "A", "S"), "RSP": ("L", "I", "A")}
+
+
+@pytest.mark.parametrize("orientation, axis", [("RPI", 2), ("RSP", 0)])
+def test_read_mid_slice(tmp_path, orientation, axis):
+    """Check the mid-slice against the slice of the whole reoriented volume, for all orientations of the file"""
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(7, 6, 5)).astype(np.float32)
+    for axes in itertools.permutations(range(3)):
+        for flip in itertools.product([1, -1], repeat=3):
+            affine = np.diag([0.5, 0.8, 1.2, 1])
+            affine = np.eye(4)[list(axes) + [3]].T @ affine @ np.diag(list(flip) + [1])
+            fname = tmp_path / "image.nii.gz"
+            nib.save(nib.Nifti1Image(data, affine), fname)
+            mid_slice, affine_out, zooms = read_mid_slice(str(fname), orientation, axis)
+            nii = nib.load(fname).as_reoriented(
+                nib.orientations.ornt_transform(
+                    nib.orientations.io_orientation(affine),
+                    nib.orientations.axcodes2ornt(ORIENTATIONS[orientation]),
+                )
+            )
+            expected = np.take(nii.get_fdata(), nii.shape[axis] // 2, axis=axis)
+            assert np.array_equal(mid_slice, expected)
+            assert np.allclose(affine_out, nii.affine)
+            assert np.allclose(zooms, np.delete(nii.header.get_zooms(), axis))
+
+
+def test_get_mosaic():
+    """Check that tiles are arranged row by row, and that missing tiles are blank"""
+    images = np.arange(1, 6, dtype=np.uint8)[np.newaxis, np.newaxis, :] * np.ones((2, 3, 1), dtype=np.uint8)
+    mosaic = get_mosaic(images, n_col=3, n_row=2)
+    assert mosaic.shape == (4, 9) and mosaic.dtype == np.uint8
+    assert np.array_equal(mosaic[::2, ::3], [[1, 2, 3], [4, 5, 0]])
+
+
+def test_mosaic_writer(tmp_path):
+    """Check that each page is written as soon as it is full"""
+    writer = MosaicWriter(str(tmp_path / "mosaic.png"), n_col=2, n_row=2, n_tiles=5)
+    for i in range(5):
+        writer.add(np.full((3, 4), i, dtype=np.uint8))
+        assert (tmp_path / "mosaic_000.png").exists() == (i >= 3)
+    assert not (tmp_path / "mosaic_001.png").exists()
+    writer.flush()
+    assert (tmp_path / "mosaic_001.png").exists()
+
+
+@pytest.mark.parametrize("ext", [".png", ".webp"])
+def test_save_mosaic_direct(tmp_path, ext):
+    """Check that the direct renderer is lossless (with upscale) and byte-reproducible"""
+    mosaic = np.random.default_rng(0).integers(0, 256, (30, 50), dtype=np.uint8)
+    fnames = [str(tmp_path / "mosaic{}{}".format(i, ext)) for i in range(2)]
+    for fname in fnames:
+        save_mosaic(mosaic, fname, renderer="direct", upscale=3)
+    data = cv2.imread(fnames[0], cv2.IMREAD_GRAYSCALE)
+    assert data.shape == (90, 150)
+    assert np.array_equal(data[::3, ::3], mosaic) and np.array_equal(data[2::3, 2::3], mosaic)
+    with open(fnames[0], "rb") as f0, open(fnames[1], "rb") as f1:
+        assert f0.read() == f1.read()
+
+
+def test_create_mosaic_max_memory(tmp_path):
+    """Check that the mosaic is created with -jobs and the memory limit suggested in the help, and that a subject
+    that needs more memory than the limit stops the script with a MemoryError (instead of hanging)"""
+    for subject in ["sub-01", "sub-02", "sub-03"]:
+        path_anat = tmp_path / "data" / subject / "anat"
+        path_anat.mkdir(parents=True)
+        nib.save(
+            nib.Nifti1Image(np.ones((8, 1000, 1000), dtype=np.float32), np.diag([1.0, 1.0, 1.0, 1.0])),
+            str(path_anat / "{}_T1w.nii.gz".format(subject)),
+        )
+    command = ["sg_create_mosaic", "-i", "*_T1w.nii.gz", "-ifolder", "data", "-p", "sag", "-col", "3", "-row", "1",
+               "-jobs", "2", "-renderer", "direct", "-o", "mosaic.png", "-max-memory"]
+    subprocess.run(command + ["1024"], cwd=tmp_path, check=True, timeout=300)
+    assert cv2.imread(str(tmp_path / "mosaic.png"), cv2.IMREAD_GRAYSCALE).shape == (1000, 3000)
+    result = subprocess.run(command + ["4"], cwd=tmp_path, capture_output=True, text=True, timeout=300)
+    assert result.returncode != 0 and "MemoryError" in result.stderr
@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Test script for dashboard
+
+import base64
+
+import numpy as np
+
+import spinegeneric.dashboard
+
+
+def test_encode_arrays():
+    """Check that numeric arrays are encoded as binary data, and that other values are kept as is"""
+    fig = {"data": [{"x": ["amu", "ucl"], "y": np.array([70.5, 65.25]), "marker": {"size": np.array([4, 5])}}]}
+    encoded = spinegeneric.dashboard.encode_arrays(fig)
+    trace = encoded["data"][0]
+    assert trace["x"] == ["amu", "ucl"]
+    assert trace["y"]["dtype"] == "Float64Array"
+    assert np.frombuffer(base64.b64decode(trace["y"]["bdata"]), dtype="<f8").tolist() == [70.5, 65.25]
+    # int64 has no typed array equivalent in plotly.js
+    assert trace["marker"]["size"]["dtype"] == "Float64Array"
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Test script for detect_outliers
+
+import shutil
+import subprocess
+from pathlib import Path
+
+import yaml
+
+
+def test_detect_outliers_dummy(tmp_path):
+    """Check that the candidates are written in a file accepted by 'sg_generate_figure -exclude', along with the
+    subjects and sites already excluded"""
+    path_results = tmp_path / "results"
+    shutil.copytree(Path(__file__).parent / "results_dummy", path_results)
+    fname_exclude = tmp_path / "exclude.yml"
+    fname_exclude.write_text("csa_t2:\n    - sub-douglas\n")
+    fname_out = tmp_path / "exclude_candidates.yml"
+    subprocess.run(
+        [
+            "sg_detect_outliers", "-path-results", path_results, "-exclude", fname_exclude, "-threshold", "1.5",
+            "-adjust", "age", "sex", "-o", fname_out,
+        ],
+        check=True,
+    )
+    candidates = yaml.safe_load(fname_out.read_text())
+    assert "oxfordFmrib" in candidates["csa_t1"]
+    assert "sub-douglas" in candidates["csa_t2"]
+    assert "# site: median=" in fname_out.read_text()
+    subprocess.run(["sg_generate_figure", "-path-results", path_results, "-exclude", fname_out], check=True)
+
+
+def test_detect_outliers_no_results(tmp_path):
+    """Check that a results folder without csv files (e.g. the processing failed) gives a file without candidates,
+    still accepted by 'sg_generate_figure -exclude'"""
+    path_results = tmp_path / "results"
+    path_results.mkdir()
+    shutil.copy(Path(__file__).parent / "results_dummy" / "participants.tsv", path_results)
+    fname_out = tmp_path / "exclude_candidates.yml"
+    subprocess.run(["sg_detect_outliers", "-path-results", path_results, "-o", fname_out], check=True)
+    assert fname_out.read_text().startswith("# Candidate subjects and sites to exclude")
+    assert not yaml.safe_load(fname_out.read_text())
+    shutil.copytree(Path(__file__).parent / "results_dummy", tmp_path / "results_dummy")
+    subprocess.run(
+        ["sg_generate_figure", "-path-results", tmp_path / "results_dummy", "-exclude", fname_out], check=True
+    )
@@ -3,6 +3,9 @@
 # Test script for generate_figure
 
 import os
+import time
+import shutil
+import signal
 import subprocess
 from pathlib import Path
 
@@ -13,9 +16,10 @@ def test_generate_figure_help():
     assert result.returncode == 0
 
 
-def test_generate_figure_dummy():
+def test_generate_figure_dummy(tmp_path):
     """Check if figures are generated using dummy csv results"""
-    path_results = Path(__file__).parent / "results_dummy"
+    path_results = tmp_path / "results"
+    shutil.copytree(Path(__file__).parent / "results_dummy", path_results)
     result = subprocess.run(["sg_generate_figure", "-path-results", path_results])
     assert result.returncode == 0
     files = [
@@ -26,3 +30,222 @@ def test_generate_figure_dummy():
     ]
     is_file_created = [os.path.isfile(path_results.joinpath(file)) for file in files]
     assert all(is_file_created)
+
+
+def test_generate_figure_jobs(tmp_path):
+    """Check that processing metrics in parallel outputs the same log as processing them sequentially (including
+    the results of the bootstrap and permutations, which are seeded)"""
+    path_results = Path(__file__).parent / "results_dummy"
+    logs = []
+    for jobs in ["1", "2"]:
+        path_out = tmp_path / jobs
+        shutil.copytree(path_results, path_out)
+        result = subprocess.run(
+            ["sg_generate_figure", "-path-results", path_out, "-jobs", jobs, "-n-boot", "100", "-n-perm", "100"]
+        )
+        assert result.returncode == 0
+        logs.append((path_out / "log_stats.txt").read_text())
+    assert logs[0] == logs[1]
+    assert "permutation p-value (100 permutations)" in logs[0]
+
+
+def test_generate_figure_jobs_error(tmp_path):
+    """Check that the error of a metric processed in parallel is raised, without outputs across metrics"""
+    path_results = tmp_path / "results"
+    shutil.copytree(Path(__file__).parent / "results_dummy", path_results)
+    fname_csv = path_results / "csa-SC_T1w.csv"
+    fname_csv.write_text(fname_csv.read_text().replace("MEAN(area)", "MEAN(areaX)", 1))
+    result = subprocess.run(
+        ["sg_generate_figure", "-path-results", path_results, "-jobs", "2"], stderr=subprocess.PIPE, text=True
+    )
+    assert result.returncode != 0
+    assert "MEAN(area)" in result.stderr
+    assert not os.path.isfile(path_results / "fig_t1_t2_agreement.png")
+
+
+def test_generate_figure_cache(tmp_path):
+    """Check that a second run fetches statistics and figures from the cache"""
+    path_results = tmp_path / "results"
+    shutil.copytree(Path(__file__).parent / "results_dummy", path_results)
+    subprocess.run(["sg_generate_figure", "-path-results", path_results], check=True)
+    log = (path_results / "log_stats.txt").read_text()
+    assert os.path.isdir(path_results / ".cache_sg_generate_figure" / "csa_t1")
+    os.remove(path_results / "fig_csa_t1.png")
+    subprocess.run(["sg_generate_figure", "-path-results", path_results], check=True)
+    assert os.path.isfile(path_results / "fig_csa_t1.png")
+    assert (path_results / "log_stats.txt").read_text() == log
+
+
+def test_list_files():
+    """Check that the source files hashed in the cache key cover the modules and config files of the package"""
+    import spinegeneric
+    import spinegeneric.cache
+
+    path_package = os.path.dirname(spinegeneric.__file__)
+    fnames = spinegeneric.cache.list_files(path_package, exclude=["tests"])
+    assert fnames == spinegeneric.cache.list_files(path_package, exclude=["tests"])
+    names = [os.path.relpath(fname, path_package) for fname in fnames]
+    for name in ["stats.py", "variance.py", "harmonization.py", "results.py", "metrics.py",
+                 os.path.join("config", "metrics.json"), os.path.join("cli", "generate_figure.py")]:
+        assert name in names
+    assert not any(name.startswith("tests") or name.endswith(".pyc") for name in names)
+
+
+def test_generate_figure_html(tmp_path):
+    """Check that html figures share a single plotly.js bundle, and that the dashboard is generated"""
+    path_results = tmp_path / "results"
+    shutil.copytree(Path(__file__).parent / "results_dummy", path_results)
+    subprocess.run(
+        ["sg_generate_figure", "-path-results", path_results, "-output-html", "-output-dashboard"], check=True
+    )
+    assert os.path.isfile(path_results / "plotly.min.js")
+    for file in ["csa_t1.html", "csa_t2.html", "fig_t1_t2_agreement.html", "fig_t1_t2_agreement_per_vendor.html"]:
+        # The bundle is not embedded in each file
+        assert os.path.getsize(path_results / file) < 100000
+    dashboard = (path_results / "dashboard.html").read_text()
+    assert dashboard.count('<div class="figure"') == 4
+
+
+def test_generate_figure_output_stats(tmp_path):
+    """Check that statistics are exported in json and parquet, with the same content, and the influence table"""
+    import pandas as pd
+
+    path_results = tmp_path / "results"
+    shutil.copytree(Path(__file__).parent / "results_dummy", path_results)
+    subprocess.run(
+        ["sg_generate_figure", "-path-results", path_results, "-output-stats", "stats.json", "stats.parquet",
+         "-output-influence", "influence.parquet"],
+        check=True, cwd=tmp_path,
+    )
+    stats_parquet = pd.read_parquet(tmp_path / "stats.parquet")
+    stats_json = pd.read_json(tmp_path / "stats.json")
+    assert len(stats_json) == len(stats_parquet)
+    vendors = stats_parquet[(stats_parquet["metric"] == "csa_t1") & (stats_parquet["level"] == "vendor")]
+    assert list(vendors["vendor"]) == ["GE", "Philips", "Siemens"]
+    assert vendors["n"].sum() == 19
+    assert (stats_parquet["level"] == "tukey").sum() == 6
+    # One candidate per subject and per site, most influential first
+    influence = pd.read_parquet(tmp_path / "influence.parquet")
+    influence = influence[influence["metric"] == "csa_t1"]
+    assert (influence["removed"] == "subject").sum() == 19
+    assert influence["influence"].is_monotonic_decreasing
+
+
+def test_get_flag():
+    """Check that flags are decoded once, and cannot be modified by a figure"""
+    from spinegeneric.cli.generate_figure import get_flag
+
+    flag = get_flag("canada")
+    assert flag is get_flag("canada")
+    assert flag.ndim == 3 and not flag.flags.writeable
+
+
+def test_generate_figure_formats(tmp_path):
+    """Check that figures are written in all requested formats"""
+    path_results = tmp_path / "results"
+    shutil.copytree(Path(__file__).parent / "results_dummy", path_results)
+    subprocess.run(
+        ["sg_generate_figure", "-path-results", path_results, "-formats", "png,svg,pdf,thumb"], check=True
+    )
+    for fname in ["fig_csa_t1", "fig_t1_t2_agreement_per_vendor"]:
+        for suffix in [".png", ".svg", ".pdf", "_thumb.png"]:
+            assert os.path.isfile(path_results / (fname + suffix))
+    result = subprocess.run(["sg_generate_figure", "-path-results", path_results, "-formats", "png,jpg"])
+    assert result.returncode != 0
+
+
+def test_generate_figure_max_subjects(tmp_path):
+    """Check that large cohorts are summarized per site instead of drawing each subject"""
+    path_results = tmp_path / "results"
+    shutil.copytree(Path(__file__).parent / "results_dummy", path_results)
+    subprocess.run(
+        ["sg_generate_figure", "-path-results", path_results, "-max-subjects", "5", "-output-dashboard"], check=True
+    )
+    assert os.path.isfile(path_results / "fig_csa_t1.png")
+    dashboard = (path_results / "dashboard.html").read_text()
+    assert '"type": "box"' in dashboard
+
+
+def test_generate_figure_harmonize(tmp_path):
+    """Check that harmonized values, fitted parameters and harmonized COVs are written, and that the parameters can
+    be applied by another run"""
+    import pandas as pd
+
+    path_results = tmp_path / "results"
+    shutil.copytree(Path(__file__).parent / "results_dummy", path_results)
+    subprocess.run(
+        ["sg_generate_figure", "-path-results", path_results, "-harmonize", "age", "sex", "-output-stats",
+         "stats.parquet"],
+        check=True, cwd=tmp_path,
+    )
+    harmonized = pd.read_csv(path_results / "harmonized" / "csa-SC_T1w.csv")
+    assert list(harmonized.columns) == ["subject", "site", "vendor", "value", "value_harmonized"]
+    assert len(harmonized) == 19
+    stats = pd.read_parquet(tmp_path / "stats.parquet")
+    assert "cov_inter_harmonized" in stats.columns
+    fname_params = tmp_path / "harmonization.json"
+    shutil.move(path_results / "harmonized" / "harmonization.json", fname_params)
+    subprocess.run(
+        ["sg_generate_figure", "-path-results", path_results, "-harmonization-params", fname_params], check=True
+    )
+    assert not (path_results / "harmonized" / "harmonization.json").exists()
+
+
+def test_generate_figure_watch(tmp_path):
+    """Check that -watch follows a csv file written in several steps, and that the running statistics of the sites
+    leave out the excluded subjects and sites, and count a subject processed again once, as the statistics of a
+    normal run"""
+    path_results = tmp_path / "results"
+    shutil.copytree(Path(__file__).parent / "results_dummy", path_results)
+    fname_csv = path_results / "csa-SC_T1w.csv"
+    content = fname_csv.read_text()
+    # The header line is not complete when watching starts
+    fname_csv.write_text(content[:20])
+    fname_exclude = tmp_path / "exclude.yml"
+    fname_exclude.write_text("csa_t1:\n  - sub-ucl\n  - oxfordFmrib\n")
+    process = subprocess.Popen(
+        ["sg_generate_figure", "-path-results", path_results, "-watch", "-watch-interval", "0.5", "-exclude",
+         fname_exclude],
+        stdout=subprocess.DEVNULL,
+    )
+    fname_log = path_results / "log_stats.txt"
+
+    def wait_refresh(n_refreshes):
+        """Wait until the running statistics of csa_t1 were logged n_refreshes times, and the figures refreshed"""
+        time_start = time.monotonic()
+        while (
+            fname_log.read_text().count("csa_t1: running statistics") < n_refreshes
+            and time.monotonic() - time_start < 120
+        ):
+            time.sleep(0.5)
+        time.sleep(5)
+
+    try:
+        # The rest of the header and the rows are appended in two steps
+        end_rows = content.index("\n", content.index("\n") + 1) + 1
+        for chunk in [content[20:end_rows], content[end_rows:]]:
+            time.sleep(2)
+            with open(fname_csv, "a") as f:
+                f.write(chunk)
+        wait_refresh(1)
+        # A subject is processed again, and its results are output in another folder
+        line = next(line for line in content.splitlines() if "/sub-douglas/" in line)
+        with open(fname_csv, "a") as f:
+            f.write(line.replace("2020-", "2021-", 1).replace("/results/results/", "/results_rerun/") + "\n")
+        wait_refresh(fname_log.read_text().count("csa_t1: running statistics") + 1)
+    finally:
+        process.send_signal(signal.SIGINT)
+        assert process.wait(timeout=60) == 0
+    log = fname_log.read_text()
+    assert "cannot be read" not in log
+    # Sites of all the refreshes
+    blocks = [
+        running.split("\n\n")[0].splitlines()[1:]
+        for running in log.split("csa_t1: running statistics of the updated sites:\n")[1:]
+    ]
+    sites = set(line.split()[0] for block in blocks for line in block)
+    assert len(sites) == 17 and "douglas" in sites
+    # The measure of the subject processed again replaces its previous measure
+    assert [line.split()[:2] for line in blocks[-1]] == [["douglas", "1"]]
+    assert "ucl" not in sites and "oxfordFmrib" not in sites
+    assert os.path.isfile(path_results / "fig_csa_t1.png")
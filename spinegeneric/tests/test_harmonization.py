@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Test script for harmonization
+
+import numpy as np
+import pandas as pd
+
+import spinegeneric.harmonization
+
+
+def combat_dense(y, site, x):
+    """
+    Harmonized values of y (n_metrics, n_subjects), all metrics measured on all subjects, following the original
+    implementation of ComBat (one regression per metric, one empirical Bayes fit per site)
+    """
+    n_sites = site.max() + 1
+    site_design = np.eye(n_sites)[site]
+    design = np.hstack([site_design, x])
+    coef = np.linalg.lstsq(design, y.T, rcond=None)[0]
+    grand_mean = site_design.mean(axis=0) @ coef[:n_sites]
+    var_pooled = ((y - (design @ coef).T) ** 2).mean(axis=1)
+    stand_mean = grand_mean[:, np.newaxis] + (x @ coef[n_sites:]).T
+    z = (y - stand_mean) / np.sqrt(var_pooled)[:, np.newaxis]
+    harmonized = np.empty_like(y)
+    gamma_hat = np.stack([z[:, site == i].mean(axis=1) for i in range(n_sites)])
+    delta_hat = np.stack([z[:, site == i].var(axis=1, ddof=1) for i in range(n_sites)])
+    for i in range(n_sites):
+        n = (site == i).sum()
+        m, s2 = delta_hat[i].mean(), delta_hat[i].var(ddof=1)
+        a, b = (2 * s2 + m ** 2) / s2, (m * s2 + m ** 3) / s2
+        gamma, delta = gamma_hat[i], delta_hat[i]
+        for _ in range(1000):
+            t2 = gamma_hat[i].var(ddof=1)
+            gamma = (t2 * n * gamma_hat[i] + delta * gamma_hat[i].mean()) / (t2 * n + delta)
+            delta = (0.5 * ((z[:, site == i] - gamma[:, np.newaxis]) ** 2).sum(axis=1) + b) / (n / 2 + a - 1)
+        harmonized[:, site == i] = (z[:, site == i] - gamma[:, np.newaxis]) / np.sqrt(delta[:, np.newaxis])
+    return harmonized * np.sqrt(var_pooled)[:, np.newaxis] + stand_mean
+
+
+def simulate(rng, n_sites=6, n_subjects=10, n_metrics=4):
+    site = np.repeat(np.arange(n_sites), n_subjects)
+    age = rng.uniform(20, 60, len(site))
+    sex = rng.integers(0, 2, len(site))
+    y = np.stack(
+        [
+            mean + 0.3 * age - 2 * sex + 3 * rng.normal(0, 1, n_sites)[site]
+            + 2 * rng.uniform(0.5, 2, n_sites)[site] * rng.normal(0, 1, len(site))
+            for mean in np.linspace(40, 80, n_metrics)
+        ]
+    )
+    return y, site, age, sex
+
+
+def test_combat():
+    """Check harmonized values against the original implementation, when all metrics are measured on all subjects"""
+    y, site, age, sex = simulate(np.random.default_rng(1))
+    n_metrics = len(y)
+    covariates = pd.DataFrame({"age": np.tile(age, n_metrics), "sex": np.tile(np.where(sex, "M", "F"), n_metrics)})
+    metric = np.repeat(["metric{}".format(i) for i in range(n_metrics)], len(site))
+    site = np.tile(site, n_metrics).astype(str)
+    combat = spinegeneric.harmonization.ComBat.fit(metric, site, y.ravel(), covariates)
+    harmonized = combat.apply(metric, site, y.ravel(), covariates)
+    expected = combat_dense(y, site[: y.shape[1]].astype(int), np.stack([age, sex], axis=1))
+    assert np.allclose(harmonized, expected.ravel(), atol=1e-4)
+
+
+def test_combat_json(tmp_path):
+    """Check that saved parameters harmonize new subjects without refitting, and that unknown sites are left out"""
+    y, site, age, _ = simulate(np.random.default_rng(2), n_metrics=2)
+    metric = np.repeat(["csa_t1", "csa_t2"], len(site))
+    site = np.tile(site, 2).astype(str)
+    covariates = pd.DataFrame({"age": np.tile(age, 2)})
+    combat = spinegeneric.harmonization.ComBat.fit(metric, site, y.ravel(), covariates)
+    combat.to_json(tmp_path / "harmonization.json")
+    loaded = spinegeneric.harmonization.ComBat.from_json(tmp_path / "harmonization.json")
+    assert np.allclose(loaded.apply(metric, site, y.ravel(), covariates), combat.apply(metric, site, y.ravel(), covariates))
+    # New subjects: one of a fitted site (with a missing age), one of an unknown site
+    harmonized = loaded.apply(["csa_t1", "csa_t1"], ["0", "unknown"], [70.0, 70.0], pd.DataFrame({"age": [np.nan, 30]}))
+    assert np.isfinite(harmonized[0]) and np.isnan(harmonized[1])
+
+
+def test_combat_single_subject():
+    """Check that a site with a single subject is not fitted, and that its value is not harmonized"""
+    y, site, age, _ = simulate(np.random.default_rng(3), n_metrics=2)
+    metric = np.append(np.repeat(["csa_t1", "csa_t2"], len(site)), "csa_t1")
+    site = np.append(np.tile(site, 2).astype(str), "single")
+    values = np.append(y.ravel(), 70.0)
+    covariates = pd.DataFrame({"age": np.append(np.tile(age, 2), 40)})
+    combat = spinegeneric.harmonization.ComBat.fit(metric, site, values, covariates)
+    assert "single" not in combat.sites.index.get_level_values("site")
+    harmonized = combat.apply(metric, site, values, covariates)
+    assert np.isnan(harmonized[-1]) and np.isfinite(harmonized[:-1]).all()
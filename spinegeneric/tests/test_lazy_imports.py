@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Test that the console scripts do not import heavy libraries at startup
+
+import subprocess
+import sys
+
+import pytest
+
+HEAVY_MODULES = [
+    "pandas", "matplotlib", "scipy", "sklearn", "statsmodels", "plotly", "skimage", "nibabel", "bids",
+    "spinalcordtoolbox",
+]
+
+
+@pytest.mark.parametrize("module", [
+    "spinegeneric.cli.generate_figure",
+    "spinegeneric.cli.create_mosaic",
+    "spinegeneric.cli.params_checker",
+    "spinegeneric.cli.check_data_consistency",
+    "spinegeneric.cli.detect_outliers",
+])
+def test_import_cli(module):
+    """Check that importing the module of a console script, and displaying its help, does not load heavy libraries"""
+    code = (
+        "import sys, runpy\n"
+        "sys.argv = ['{0}', '-h']\n"
+        "try:\n"
+        "    runpy.run_module('{0}', run_name='__main__')\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "print(','.join(m for m in {1} if m in sys.modules))\n"
+    ).format(module, HEAVY_MODULES)
+    out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    assert out.splitlines()[-1] == ""
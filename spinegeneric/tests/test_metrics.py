@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Test script for metrics
+
+import shutil
+from pathlib import Path
+
+import spinegeneric.metrics
+
+path_results = Path(__file__).parent / "results_dummy"
+
+
+def test_load_registry():
+    """Check that each metric is described, and that labels include units"""
+    registry = spinegeneric.metrics.load_registry()
+    assert list(registry)[:3] == ["csa_t1", "csa_t2", "csa_gm"]
+    assert len({metric.file for metric in registry.values()}) == len(registry)
+    assert registry["csa_t1"].label == "Cord CSA from T1w [$mm^2$]"
+    assert registry["dti_md"].label_plotly == "Mean diffusivity [mm<sup>2</sup>s<sup>-1</sup>]"
+    assert registry["dti_fa"].label == "Fractional anisotropy"
+    assert registry["t1"].scale == 1000
+
+
+def test_discover_metrics(tmp_path):
+    """Check that csv files that are not in the registry are added with default settings"""
+    shutil.copy(path_results / "csa-SC_T1w.csv", tmp_path / "csa-SC_T1w.csv")
+    shutil.copy(path_results / "csa-SC_T1w.csv", tmp_path / "csa-SC_C5.csv")
+    (tmp_path / "other.csv").write_text("a,b\n1,2\n")
+    metrics = spinegeneric.metrics.discover_metrics(tmp_path)
+    assert list(metrics)[-1] == "csa_sc_c5"
+    assert metrics["csa_sc_c5"].field == "MEAN(area)"
+    assert "other" not in metrics
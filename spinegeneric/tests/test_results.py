@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Test script for results
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import spinegeneric.results
+
+path_results = Path(__file__).parent / "results_dummy"
+
+
+def test_load_results_csv():
+    """Check that only the requested columns are loaded, with a numeric dtype"""
+    results = spinegeneric.results.load_results_csv(path_results / "csa-SC_T1w.csv", "MEAN(area)")
+    assert list(results.columns) == ["Timestamp", "SCT Version", "Filename", "VertLevel", "MEAN(area)"]
+    assert results["MEAN(area)"].dtype == np.float64
+    assert len(results) == 19
+
+
+def test_load_results_csv_none(tmp_path):
+    """Check that "None" values are parsed as NaN"""
+    fname = tmp_path / "MTR.csv"
+    fname.write_text(
+        "Timestamp,SCT Version,Filename,VertLevel,Label,WA(),STD()\n"
+        "2020-07-08 18:28:30,5.0,/data/sub-01/anat/sub-01_mtr.nii.gz,2:5,white matter,50.1,1.0\n"
+        "2020-07-08 18:28:31,5.0,/data/sub-02/anat/sub-02_mtr.nii.gz,2:5,white matter,None,None\n"
+    )
+    results = spinegeneric.results.load_results_csv(fname, "WA()")
+    assert results["WA()"].iloc[0] == 50.1
+    assert np.isnan(results["WA()"].iloc[1])
+
+
+def test_drop_duplicate_results(tmp_path):
+    """Check the selection of measures among duplicates, for each policy"""
+    fname = tmp_path / "csa-SC_T1w.csv"
+    fname.write_text(
+        "Timestamp,SCT Version,Filename,VertLevel,MEAN(area)\n"
+        "2020-07-08 18:28:30,5.0,/old/data/sub-01/anat/sub-01_T1w_seg.nii.gz,2:3,70.0\n"
+        "2020-07-08 18:28:31,5.0,/old/data/sub-02/anat/sub-02_T1w_seg.nii.gz,2:3,71.0\n"
+        "2020-07-08 18:28:31,5.0,/old/data/sub-02/anat/sub-02_T1w_seg.nii.gz,3:4,61.0\n"
+        "2021-01-01 10:00:00,5.2,/new/data/sub-01/anat/sub-01_T1w_seg.nii.gz,2:3,72.0\n"
+        "2020-09-01 10:00:00,5.1,/new/data/sub-01/anat/sub-01_T1w_seg.nii.gz,2:3,73.0\n"
+    )
+    results = spinegeneric.results.load_results_csv(fname, "MEAN(area)")
+    kept, dropped = spinegeneric.results.drop_duplicate_results(results, "latest")
+    assert list(kept["MEAN(area)"]) == [71.0, 61.0, 72.0]
+    assert list(dropped["MEAN(area)"]) == [70.0, 73.0]
+    kept, dropped = spinegeneric.results.drop_duplicate_results(results, "sct-version", sct_version="5.0")
+    assert list(kept["MEAN(area)"]) == [70.0, 71.0, 61.0]
+    with pytest.raises(ValueError):
+        spinegeneric.results.drop_duplicate_results(results, "error")
+    kept, dropped = spinegeneric.results.drop_duplicate_results(results.iloc[:3], "error")
+    assert len(dropped) == 0
+
+
+def test_site_values():
+    """Check per-site access and reductions of SiteValues"""
+    site_values = spinegeneric.results.SiteValues.from_long(
+        site=["amu", "ucl", "amu", "amu"],
+        value=[1.0, 5.0, 2.0, 6.0],
+        subject=["sub-amu01", "sub-ucl01", "sub-amu02", "sub-amu03"],
+        sites=["ucl", "amu", "mgh"],
+    )
+    assert list(site_values["amu"]) == [1.0, 2.0, 6.0]
+    assert list(site_values.get_subjects("amu")) == ["sub-amu01", "sub-amu02", "sub-amu03"]
+    assert list(site_values.counts) == [1, 3, 0]
+    assert np.allclose(site_values.mean()[:2], [5.0, 3.0])
+    assert np.allclose(site_values.std()[:2], [0.0, np.std([1.0, 2.0, 6.0])])
+    assert np.isnan(site_values.mean()[2])
+    assert np.allclose(site_values.quantile(0.25)[:2], [5.0, np.quantile([1.0, 2.0, 6.0], 0.25)])
+    assert np.isnan(site_values.quantile(0.5)[2])
+    # Per-site values are views on the contiguous array
+    assert np.shares_memory(site_values["amu"], site_values.values)
+
+
+def test_join_site_values():
+    """Check that values are paired by (site, subject), including sites present for only one metric"""
+    csa_t1 = spinegeneric.results.SiteValues.from_long(
+        site=["amu", "ucl", "amu", "mgh"],
+        value=[70.0, 65.0, 72.0, 60.0],
+        subject=["sub-amu01", "sub-ucl01", "sub-amu02", "sub-mgh01"],
+    )
+    csa_t2 = spinegeneric.results.SiteValues.from_long(
+        site=["ucl", "amu", "amu", "douglas"],
+        value=[66.0, 73.0, 71.0, 80.0],
+        subject=["sub-ucl01", "sub-amu02", "sub-amu01", "sub-douglas01"],
+    )
+    pairs = spinegeneric.results.join_site_values(csa_t1, csa_t2, suffixes=("_t1", "_t2"))
+    assert list(pairs["subject"]) == ["sub-amu01", "sub-amu02", "sub-ucl01"]
+    assert list(pairs["val_t1"]) == [70.0, 72.0, 65.0]
+    assert list(pairs["val_t2"]) == [71.0, 73.0, 66.0]
+
+
+def test_csv_tail(tmp_path):
+    """Check that only complete lines appended since the previous read are parsed"""
+    fname = tmp_path / "csa-SC_T1w.csv"
+    tail = spinegeneric.results.CsvTail(fname, "MEAN(area)")
+    assert tail.read() == (None, False)
+    fname.write_text(
+        "Timestamp,SCT Version,Filename,VertLevel,MEAN(area)\n"
+        "2020-07-08 18:28:30,5.0,/data/sub-01/anat/sub-01_T1w_seg.nii.gz,2:3,70.0\n"
+        "2020-07-08 18:28:31,5.0,/data/sub-02/anat/sub-02_T1w_seg.nii.gz,2:3,7"
+    )
+    results, is_reset = tail.read()
+    assert list(results["MEAN(area)"]) == [70.0] and not is_reset
+    with open(fname, "a") as f:
+        f.write("1.0\n")
+    results, is_reset = tail.read()
+    assert list(results["MEAN(area)"]) == [71.0]
+    assert tail.read() == (None, False)
+    # The file is replaced by a shorter one
+    fname.write_text("Filename,MEAN(area)\n/data/sub-03/anat/sub-03_T1w_seg.nii.gz,72.0\n")
+    results, is_reset = tail.read()
+    assert list(results["MEAN(area)"]) == [72.0] and is_reset
+
+
+def test_csv_tail_partial_header(tmp_path):
+    """Check that rows are parsed once the header line, written in several steps, is complete"""
+    fname = tmp_path / "csa-SC_T1w.csv"
+    tail = spinegeneric.results.CsvTail(fname, "MEAN(area)")
+    fname.write_text("Timestamp,SCT Version,Filename,")
+    assert tail.read() == (None, False)
+    with open(fname, "a") as f:
+        f.write("VertLevel,MEAN(area)\n")
+    assert tail.read() == (None, False)
+    with open(fname, "a") as f:
+        f.write("2020-07-08 18:28:30,5.0,/data/sub-01/anat/sub-01_T1w_seg.nii.gz,2:3,70.0\n")
+    results, is_reset = tail.read()
+    assert list(results["MEAN(area)"]) == [70.0] and not is_reset
+
+
+def test_running_site_stats():
+    """Check that running statistics match the statistics of the current measures"""
+    running = spinegeneric.results.RunningSiteStats()
+    running.update(["amu", "ucl", "amu"], ["sub-amu01", "sub-ucl01", "sub-amu02"], [1.0, 5.0, 2.0])
+    # sub-amu01 is processed again, and a new subject is added
+    sites = running.update(["amu", "amu"], ["sub-amu01", "sub-amu03"], [3.0, 7.0])
+    assert list(sites) == ["amu"]
+    stats = running.to_frame()
+    assert list(stats["n"]) == [3, 1]
+    assert np.allclose(stats.loc["amu", ["mean", "std"]], [4.0, np.std([3.0, 2.0, 7.0])])
+    assert stats.loc["ucl", "std"] == 0
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Test script for stats
+
+import numpy as np
+from scipy.stats import f_oneway
+
+import spinegeneric.stats
+
+
+def test_anova_oneway():
+    """Check that ANOVAs computed from sufficient statistics match scipy.stats.f_oneway"""
+    rng = np.random.default_rng(0)
+    samples = {
+        "a": [rng.normal(70, 5, size) for size in [4, 6, 5]],
+        "b": [rng.normal(60, 3, size) for size in [3, 8]],
+    }
+    n, mean, ssw, anova_id = [], [], [], []
+    for key, groups in samples.items():
+        for group in groups:
+            n.append(len(group))
+            mean.append(np.mean(group))
+            ssw.append(np.sum((group - np.mean(group)) ** 2))
+            anova_id.append(key)
+    anova = spinegeneric.stats.anova_oneway(n, mean, ssw, anova_id)
+    for key, groups in samples.items():
+        assert np.allclose(anova.loc[key], f_oneway(*groups))
+
+
+def test_anova_oneway_undefined():
+    """Check that ANOVAs without degrees of freedom within groups are NaN"""
+    anova = spinegeneric.stats.anova_oneway([1, 1, 1], [70.0, 72.0, 69.0], [0, 0, 0], [0, 0, 0])
+    assert anova["statistic"].isna().all()
+
+
+def test_moments():
+    """Check that combined and subtracted moments match the moments computed from the values"""
+    rng = np.random.default_rng(0)
+    values = rng.normal(70, 5, 20)
+    group_id = np.repeat([0, 1, 2], [8, 12, 0])
+    moments = spinegeneric.stats.Moments.from_values(values, group_id, 3)
+    assert np.allclose(moments.n, [8, 12, 0])
+    assert np.allclose(moments.var()[:2], [np.var(values[:8]), np.var(values[8:])])
+    # Welford's update, one value at a time
+    running = spinegeneric.stats.Moments([0], [np.nan], [0])
+    for value in values[:8]:
+        running = running.combine(spinegeneric.stats.Moments([1], [value], [0]))
+    assert np.allclose([running.mean[0], running.m2[0]], [moments.mean[0], moments.m2[0]])
+    # Leave one out
+    without_first = moments[[0]].subtract(spinegeneric.stats.Moments([1], values[:1], [0]))
+    assert np.allclose([without_first.mean[0], without_first.var()[0]], [np.mean(values[1:8]), np.var(values[1:8])])
+    pooled = moments.group(np.array([0, 0, 0]), 1)
+    assert np.allclose([pooled.mean[0], pooled.var()[0]], [np.mean(values), np.var(values)])
+
+
+def test_leave_one_out():
+    """Check that the statistics without each candidate match the statistics computed without it"""
+    rng = np.random.default_rng(0)
+    site_vendor = np.array(["GE", "Siemens", "GE", "Siemens", "GE", "Siemens"])
+    site_id = np.repeat(np.arange(6), [3, 4, 1, 5, 4, 2])
+    values = rng.normal(70, 5, len(site_id))
+
+    def vendor_statistics(values, site_id, vendor):
+        is_vendor = site_vendor[site_id] == vendor
+        sites = [values[is_vendor & (site_id == i)] for i in np.unique(site_id[is_vendor])]
+        means = np.array([np.mean(site) for site in sites])
+        covs = [np.std(site) / np.mean(site) for site in sites]
+        return [np.mean(means), np.std(means) / np.mean(means), np.mean(covs), f_oneway(*sites).statistic]
+
+    vendors, candidates = spinegeneric.stats.leave_one_out(values, site_id, site_vendor)
+    assert np.allclose(vendors.loc["GE"], vendor_statistics(values, site_id, "GE"))
+    assert len(candidates) == len(values) + 6
+    for candidate in candidates.itertuples():
+        if candidate.removed == "subject":
+            is_kept = np.arange(len(values)) != candidate.index
+        else:
+            is_kept = site_id != candidate.index
+        expected = vendor_statistics(values[is_kept], site_id[is_kept], candidate.vendor)
+        assert np.allclose(
+            [candidate.mean, candidate.cov_inter, candidate.cov_intra, candidate.statistic], expected
+        )
+
+
+def test_permutation_anova():
+    """Check permutation p-values against the exact p-value of a small design"""
+    # The observed labels (and their mirror) give the largest difference between groups among the 6 distinct
+    # labelings of the first stratum: p = 1/3. The second stratum has a single group.
+    values = [0.0, 1.0, 10.0, 11.0, 5.0, 6.0]
+    group_id = ["a", "a", "b", "b", "c", "c"]
+    stratum_id = [0, 0, 0, 0, 1, 1]
+    pvalue = spinegeneric.stats.permutation_anova(values, group_id, stratum_id, 20000, np.random.default_rng(0))
+    assert abs(pvalue[0] - 1 / 3) < 0.02
+    assert np.isnan(pvalue[1])
+    # Chunks do not change the p-value beyond sampling noise
+    pvalue_chunked = spinegeneric.stats.permutation_anova(
+        values, group_id, stratum_id, 20000, np.random.default_rng(0), max_elements=1000
+    )
+    assert abs(pvalue_chunked[0] - 1 / 3) < 0.02
+
+
+def test_bootstrap_vendor():
+    """Check that bootstrap confidence intervals are reproducible and contain the estimates"""
+    site_mean = np.array([70.0, 72.0, 68.0, 60.0, 61.0])
+    site_cov = np.array([0.05, 0.04, 0.06, 0.03, 0.02])
+    site_vendor = ["GE", "GE", "GE", "Siemens", "Siemens"]
+    ci = spinegeneric.stats.bootstrap_vendor(site_mean, site_cov, site_vendor, 1000, np.random.default_rng(0))
+    assert ci.equals(
+        spinegeneric.stats.bootstrap_vendor(site_mean, site_cov, site_vendor, 1000, np.random.default_rng(0))
+    )
+    assert ci.loc["GE", "mean_ci_lower"] <= 70.0 <= ci.loc["GE", "mean_ci_upper"]
+    assert 68.0 <= ci.loc["GE", "mean_ci_lower"] and ci.loc["GE", "mean_ci_upper"] <= 72.0
+    assert ci.loc["Siemens", "cov_intra_ci_lower"] >= 0.02 and ci.loc["Siemens", "cov_intra_ci_upper"] <= 0.03
+
+
+def test_robust_zscore():
+    """Check the median, MAD and robust z-scores of each group"""
+    values = np.array([1.0, 2.0, 3.0, 4.0, 100.0, 5.0, 5.0, 5.0, 7.0])
+    group_id = np.array([0, 0, 0, 0, 0, 1, 1, 1, 2])
+    zscore, median, mad = spinegeneric.stats.robust_zscore(values, group_id, 4, min_count=2)
+    assert np.allclose(median[:2], [3.0, 5.0])
+    assert np.isnan(median[3])
+    assert np.isclose(mad[0], 1.4826)
+    assert np.allclose(zscore[:5], (values[:5] - 3.0) / 1.4826)
+    # No dispersion, or less than min_count values
+    assert np.isnan(zscore[5:]).all()
+    assert np.allclose(
+        spinegeneric.stats.grouped_quantile(values, group_id, 4, 0.25)[:3], [2.0, 5.0, 7.0]
+    )
+
+
+def test_adjust_covariates():
+    """Check that the linear effect of the covariates is removed within each group, keeping the group mean"""
+    rng = np.random.default_rng(0)
+    age = rng.uniform(20, 60, 40)
+    sex = rng.integers(0, 2, 40).astype(float)
+    group_id = np.repeat([0, 1], 20)
+    noise = rng.normal(0, 0.1, 40)
+    values = np.where(group_id == 0, 70 + 0.5 * age - 3 * sex, 50 - 0.2 * age + 1 * sex) + noise
+    adjusted = spinegeneric.stats.adjust_covariates(values, np.stack([age, sex], axis=1), group_id, 2)
+    for group in range(2):
+        is_group = group_id == group
+        assert np.isclose(adjusted[is_group].mean(), values[is_group].mean())
+        assert np.std(adjusted[is_group]) < 0.15
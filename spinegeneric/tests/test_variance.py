@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Test script for variance
+
+import numpy as np
+from scipy.optimize import minimize
+
+import spinegeneric.stats
+import spinegeneric.variance
+
+
+def reml_dense(values, site):
+    """REML estimates of (var_site, var_residual), by numerical optimization of the likelihood of all values"""
+    def objective(log_var):
+        var_site, var_residual = np.exp(log_var)
+        cov = var_residual * np.eye(len(values)) + var_site * (site[:, np.newaxis] == site[np.newaxis, :])
+        cov_inv = np.linalg.inv(cov)
+        sum_inv = cov_inv.sum()
+        residual = values - cov_inv.sum(axis=0) @ values / sum_inv
+        return np.linalg.slogdet(cov)[1] + np.log(sum_inv) + residual @ cov_inv @ residual
+
+    result = minimize(objective, [0, 1], method="Nelder-Mead", options=dict(xatol=1e-10, fatol=1e-12, maxiter=5000))
+    return np.exp(result.x)
+
+
+def test_fit_reml():
+    """Check REML estimates against the numerical optimization of the likelihood, with unbalanced sites"""
+    rng = np.random.default_rng(1)
+    n, mean, m2, fit_id, expected = [], [], [], [], []
+    for fit in range(3):
+        site = np.repeat(np.arange(8), rng.integers(1, 10, 8))
+        values = 70 + rng.normal(0, 2, 8)[site] + rng.normal(0, 3, len(site))
+        moments = spinegeneric.stats.Moments.from_values(values, site, 8)
+        n.append(moments.n)
+        mean.append(moments.mean)
+        m2.append(moments.m2)
+        fit_id.append(np.full(8, fit))
+        expected.append(reml_dense(values, site))
+    reml = spinegeneric.variance.fit_reml(*[np.concatenate(x) for x in [n, mean, m2, fit_id]])
+    assert np.allclose(reml[["var_site", "var_residual"]].values, expected, rtol=1e-4)
+    assert np.allclose(reml["icc"], reml["var_site"] / (reml["var_site"] + reml["var_residual"]))
+
+
+def test_fit_reml_boundary():
+    """Check that the variance across sites is zero when site means are equal, and undefined with a single site"""
+    reml = spinegeneric.variance.fit_reml(
+        n=[3, 5, 4, 6], mean=[70.0, 70.0, 70.0, 65.0], m2=[20.0, 30.0, 25.0, 30.0], fit_id=["a", "a", "a", "b"]
+    )
+    assert reml.loc["a", "icc"] == 0 and np.isclose(reml.loc["a", "var_residual"], 75.0 / 11)
+    assert np.isnan(reml.loc["b", "icc"]) and reml.loc["b", "mean"] == 65.0
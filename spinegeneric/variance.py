@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Variance components (subjects within sites) estimated by REML from the sufficient statistics of each site
+
+
+import numpy as np
+import pandas as pd
+
+# Grid of ratios var_site / (var_site + var_residual) (i.e. ICC) used to bracket the REML optimum, before refining
+# it with a golden-section search
+ICC_GRID = np.concatenate([[0], 1 / (1 + np.logspace(6, -6, 63))])
+N_ITER_GOLDEN = 60
+
+
+def _reml_objective(icc, n, mean, fit_id, starts, n_total, ssw):
+    """
+    -2 * restricted log-likelihood (up to a constant) of the random-intercept model, profiled over the residual
+    variance, for several values of the ICC of each fit.
+    :param icc: array (n_fits, n_values): ICC of each fit
+    :param n, mean: arrays of the sites, sorted by fit
+    :param fit_id: array of int: fit of each site
+    :param starts: array of int: index of the first site of each fit
+    :param n_total: array: number of subjects of each fit
+    :param ssw: array: sum of squared deviations from the site means, of each fit
+    :return: objective: array (n_fits, n_values)
+    :return: grand_mean: array (n_fits, n_values): generalized least squares estimate of the mean
+    :return: var_residual: array (n_fits, n_values): REML estimate of the residual variance for this ICC
+    """
+    # Ratio var_site / var_residual
+    with np.errstate(divide="ignore"):
+        ratio = icc / (1 - icc)
+    ratio = ratio[fit_id]
+    # Weight of each site mean in the estimate of the grand mean (inverse of its variance, times var_residual)
+    weight = n[:, np.newaxis] / (1 + n[:, np.newaxis] * ratio)
+    sum_weight = np.add.reduceat(weight, starts, axis=0)
+    grand_mean = np.add.reduceat(weight * mean[:, np.newaxis], starts, axis=0) / sum_weight
+    ssb = np.add.reduceat(weight * (mean[:, np.newaxis] - grand_mean[fit_id]) ** 2, starts, axis=0)
+    var_residual = (ssw[:, np.newaxis] + ssb) / (n_total[:, np.newaxis] - 1)
+    log_det = np.add.reduceat(np.log1p(n[:, np.newaxis] * ratio), starts, axis=0)
+    objective = (n_total[:, np.newaxis] - 1) * np.log(var_residual) + log_det + np.log(sum_weight)
+    return objective, grand_mean, var_residual
+
+
+def fit_reml(n, mean, m2, fit_id):
+    """
+    Fit the random-intercept model value = mean + site + residual (site ~ N(0, var_site), residual ~ N(0,
+    var_residual)) by restricted maximum likelihood (REML), for many independent fits at once (e.g. each vendor of
+    each metric, or each bootstrap resample). The restricted likelihood only depends on the number of subjects, mean
+    and sum of squared deviations (M2) of each site, and is profiled over the residual variance, so that each fit is
+    a one-dimensional optimization over the ICC, vectorized across fits. Unlike the ratios of the std of site means,
+    the estimates account for unbalanced numbers of subjects across sites.
+    :param n: array: number of subjects of each site
+    :param mean: array: mean of each site
+    :param m2: array: sum of squared deviations from the mean of each site
+    :param fit_id: array: fit that each site belongs to. Sites without subjects are ignored.
+    :return: pandas DataFrame indexed by fit, with columns: n_site, n, mean (generalized least squares estimate),
+      var_site, var_residual, icc (var_site / (var_site + var_residual)), cov_inter (sqrt(var_site) / mean),
+      cov_intra (sqrt(var_residual) / mean). The variance components are NaN if there are less than two sites, or
+      no subjects sharing a site.
+    """
+    n = np.asarray(n, dtype=np.float64)
+    has_subjects = n > 0
+    fit_code, fits = pd.factorize(pd.Series(np.asarray(fit_id)[has_subjects]))
+    order = np.argsort(fit_code, kind="stable")
+    fit_code = fit_code[order]
+    n = n[has_subjects][order]
+    mean = np.asarray(mean, dtype=np.float64)[has_subjects][order]
+    m2 = np.asarray(m2, dtype=np.float64)[has_subjects][order]
+    n_fits = len(fits)
+    n_site = np.bincount(fit_code, minlength=n_fits)
+    starts = np.concatenate([[0], np.cumsum(n_site)[:-1]]).astype(np.int64)
+    n_total = np.bincount(fit_code, weights=n, minlength=n_fits)
+    ssw = np.bincount(fit_code, weights=m2, minlength=n_fits)
+    args = n, mean, fit_code, starts, n_total, ssw
+
+    # Bracket the optimum on a grid, then refine it with a golden-section search
+    grid = np.broadcast_to(ICC_GRID, (n_fits, len(ICC_GRID)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        i_min = np.argmin(np.nan_to_num(_reml_objective(grid, *args)[0], nan=np.inf), axis=1)
+    lower = ICC_GRID[np.maximum(i_min - 1, 0)]
+    upper = ICC_GRID[np.minimum(i_min + 1, len(ICC_GRID) - 1)]
+    inv_phi = (np.sqrt(5) - 1) / 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for _ in range(N_ITER_GOLDEN):
+            icc = np.stack([upper - inv_phi * (upper - lower), lower + inv_phi * (upper - lower)], axis=1)
+            objective = _reml_objective(icc, *args)[0]
+            is_left = objective[:, 0] <= objective[:, 1]
+            upper = np.where(is_left, icc[:, 1], upper)
+            lower = np.where(is_left, lower, icc[:, 0])
+        # The optimum might be on the boundary (no variance across sites)
+        icc = np.stack([ICC_GRID[np.maximum(i_min - 1, 0)], (lower + upper) / 2], axis=1)
+        objective, grand_mean, var_residual = _reml_objective(icc, *args)
+        best = np.where(objective[:, 0] <= objective[:, 1], 0, 1)
+        rows = np.arange(n_fits)
+        icc, grand_mean, var_residual = icc[rows, best], grand_mean[rows, best], var_residual[rows, best]
+        var_site = var_residual * icc / (1 - icc)
+        results = pd.DataFrame(
+            {
+                "n_site": n_site,
+                "n": n_total,
+                "mean": grand_mean,
+                "var_site": var_site,
+                "var_residual": var_residual,
+                "icc": icc,
+                "cov_inter": np.sqrt(var_site) / grand_mean,
+                "cov_intra": np.sqrt(var_residual) / grand_mean,
+            },
+            index=fits,
+        )
+    is_undefined = (n_site < 2) | (n_total - n_site < 1)
+    results.loc[is_undefined, ["var_site", "var_residual", "icc", "cov_inter", "cov_intra"]] = np.nan
+    results.loc[is_undefined, "mean"] = (
+        np.bincount(fit_code, weights=n * mean, minlength=n_fits) / n_total
+    )[is_undefined]
+    return results